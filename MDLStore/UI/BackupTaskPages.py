@@ -8,7 +8,7 @@ from datetime import timedelta, date, datetime
 from PyQt5.QtCore import QVariant, Qt, QDate, QThreadPool, QTimer
 from PyQt5.QtGui import QStandardItemModel, QStandardItem, QPainter, QColor
 from PyQt5.QtWidgets import QWidget, QDialog, QVBoxLayout, QMessageBox, QDialogButtonBox, QLabel, QComboBox, \
-    QButtonGroup, QGridLayout, QRadioButton, QPushButton
+    QButtonGroup, QGridLayout, QRadioButton, QPushButton, QCheckBox
 
 from MDLStore.UI.EmailAccountPages import MyObject
 from MDLStore.UI.THEMES import LISTVIEW_TASK_ALL, LISTVIEW_TASK_CUR
@@ -18,9 +18,10 @@ from MDLStore.database.config_database_setup import SessionManager
 from MDLStore.database.entities import BackupTask
 from MDLStore.database.service import BackupTaskManager, EmailAccountManager
 from MDLStore.dialogs import ProgressWidget, Worker
-from MDLStore.execute import backupEmailToTmpArea, extractEmailData, long_running_task
+from MDLStore.execute import backupEmailToTmpArea, extractEmailData
 from MDLStore.mailclients import IMAPClientFactory
 from MDLStore.storage import StorageManager
+from MDLStore.syncdaemon import run_backup_tasks
 from MDLStore.ui_utils import APP_Signals
 from MDLStore.utils import ServerUtils
 
@@ -65,6 +66,9 @@ class BackupTaskPage(QWidget, Ui_BackupTaskPage):
 
         self.button_tar.clicked.connect(self.show_disk_selection_dialog)
         self.button_exec.clicked.connect(self.start_exec_backup_task)
+        # 备份完成后为这些任务保持IMAP长连接，新邮件到达后立即备份，程序退出时停止
+        self.checkBox_continuous = QCheckBox('备份完成后持续同步', self.groupBox_4)
+        self.horizontalLayout_8.insertWidget(2, self.checkBox_continuous)
 
         # self.label_date_to.setFixedWidth(10)
         # self.comboBox_date.setFixedWidth(120)
@@ -461,7 +465,8 @@ class BackupTaskPage(QWidget, Ui_BackupTaskPage):
         # account_manager = EmailAccountManager(session)
         print(f'当前任务列表{self.cur_tasks}')
         self.progress_widget = ProgressWidget(label="备份任务执行...")
-        worker = Worker(long_running_task, self.cur_tasks, self.target_drive, self.on_change)
+        worker = Worker(run_backup_tasks, self.cur_tasks, self.target_drive, self.on_change,
+                        self.checkBox_continuous.isChecked())
         worker.signals.progress.connect(self.update_progress)
         worker.signals.detail.connect(self.update_detail)
         worker.signals.info.connect(self.update_info)
@@ -1,4 +1,5 @@
 import configparser
+import multiprocessing
 import os
 import pickle
 import sys
@@ -15,6 +16,8 @@ from MDLStore.UI.MainApp import MainApp
 import MDLStore.images_rc
 from MDLStore.database.config_database_setup import SessionManager
 from MDLStore.database.service import EmailAccountManager
+from MDLStore.execute import shutdown_parse_executor
+from MDLStore.syncdaemon import stop_sync_daemons
 from MDLStore.ui_utils import APP_Signals
 
 homepath = os.path.expanduser("~")
@@ -368,12 +371,17 @@ def main():
     # 禁用 DPI 缩放
     QApplication.setAttribute(Qt.AA_DisableHighDpiScaling)
 
+    # 退出时停止持续同步，断开IMAP长连接，并关闭解析邮件的进程池
+    app.aboutToQuit.connect(stop_sync_daemons)
+    app.aboutToQuit.connect(shutdown_parse_executor)
     aw = Application(**args)
     aw.show()
     app.exec_()
 
 
 if __name__ == '__main__':
+    # 打包为exe后，解析邮件的进程池子进程从这里启动，需要先交给multiprocessing处理
+    multiprocessing.freeze_support()
     try:
         main()
     except Exception as e:
@@ -0,0 +1,669 @@
+import asyncio
+import email
+import itertools
+import re
+import ssl
+import tempfile
+import threading
+from dataclasses import dataclass, field
+from email import policy
+from typing import Optional
+
+from MDLStore.mailclients import IMAPClientFactory, TempAreaSink, FolderSyncMark, RetryPolicy, ServerThrottled, \
+    FETCH_UID_RE, MAX_BATCH_DIVISOR, is_throttle_message, is_retryable_error, \
+    account_connection_budget
+from MDLStore.utils import SearchQuery
+
+# 响应行末尾的literal长度，如b'* 12 FETCH (UID 345 RFC822 {2048}\r\n'
+LITERAL_RE = re.compile(rb'\{(\d+)\}\r\n$')
+# 带标签的结束响应，如b'A3 OK UID FETCH completed'
+TAGGED_RE = re.compile(rb'^(\S+) (OK|NO|BAD)(?: (.*))?$', re.S)
+# 带序号的未标记响应，如b'* 12 FETCH (...)'、b'* 3 EXISTS'
+UNTAGGED_STATUS_RE = re.compile(rb'^\* (\d+) ([A-Za-z-]+)(?: (.*))?$', re.S)
+# 其余未标记响应，如b'* SEARCH 1 2 3'、b'* OK [UIDVALIDITY 7] ok'
+UNTAGGED_RE = re.compile(rb'^\* ([A-Za-z-]+)(?: (.*))?$', re.S)
+# 状态响应中的响应码，如b'[UIDVALIDITY 7]'
+RESPONSE_CODE_RE = re.compile(rb'^\[([A-Za-z-]+)(?: ([^\]]*))?\]')
+
+LINE_LIMIT = 16 * 1024 * 1024  # 单行响应的最大长度，大文件夹的SEARCH结果可能很长
+
+
+class AsyncIMAPError(Exception):
+    pass
+
+
+@dataclass
+class PendingCommand:
+    """已发送、等待结束响应的命令"""
+    name: str  # 期望的未标记响应名称，如'FETCH'、'SEARCH'
+    uids: Optional[set] = None  # UID FETCH的UID集合，用于把流水线中多条FETCH的响应分给各自的命令
+    data: list = field(default_factory=list)
+    future: Optional[asyncio.Future] = None
+
+
+class AsyncIMAPClient:
+    """
+    基于asyncio的IMAP客户端，与IMAPClientBase的接口对应：connect、login、get_mailbox_list、search_folder、
+    save_emails。一个连接上的多条命令连续发送、不等待前一条完成（流水线），响应由后台读取协程按标签分发。
+    服务商相关的行为（ID命令、批量参数、搜索方式）取自IMAPClientFactory创建的同步客户端profile，不重复定义
+    """
+    pipeline_depth = 2  # 同一连接上同时在途的UID FETCH批次数
+
+    def __init__(self, profile, rate_limiter=None):
+        """
+        :param profile: IMAPClientFactory.get_client返回的未连接的IMAPClientBase实例
+        :param rate_limiter: 下载带宽预算，utils.RateLimiter
+        """
+        self.profile = profile
+        self.username = profile.username
+        self.rate_limiter = rate_limiter
+        self.reader = None
+        self.writer = None
+        self.responses = {}  # 未分给命令的未标记响应和响应码，如{'UIDVALIDITY': [b'7']}
+        self._tags = itertools.count(1)
+        self._pending = {}
+        self._write_lock = None
+        self._continuation = None
+        self._read_task = None
+
+    async def connect(self):
+        context = ssl.create_default_context() if self.profile.ssl else None
+        self.reader, self.writer = await asyncio.open_connection(self.profile.server, self.profile.port,
+                                                                 ssl=context, limit=LINE_LIMIT)
+        greeting = await self.read_response()
+        if not greeting[0].startswith((b'* OK', b'* PREAUTH')):
+            raise AsyncIMAPError(f'服务器拒绝连接: {greeting[0]}')
+        self._write_lock = asyncio.Lock()
+        self._read_task = asyncio.create_task(self.read_loop())
+
+    @property
+    def closed(self):
+        """连接已关闭或后台读取协程已退出（服务器断开了连接），此后的命令不会再有响应"""
+        return self.writer is None or self._read_task is None or self._read_task.done()
+
+    async def login(self):
+        status, data, text = await self.command('LOGIN', self.quote(self.profile.username),
+                                                self.quote(self.profile.password))
+        if status != 'OK':
+            raise AsyncIMAPError(f'登录失败: {text}')
+        if self.profile.get_imap_id() is not None:
+            await self.command('ID', self.profile.format_imap_id(), expect='ID')
+
+    async def disconnect(self):
+        if self.writer is None:
+            return
+        if not self.closed:
+            try:
+                await asyncio.wait_for(self.command('LOGOUT'), timeout=5)
+            except Exception as e:
+                print(f'LOGOUT失败: {e}')
+        self.writer.close()
+        self._read_task.cancel()
+        self.writer = None
+
+    @staticmethod
+    def quote(value):
+        """ASCII字符串加引号发送，其余以literal发送"""
+        return SearchQuery.quote(value) if value.isascii() else value.encode('utf-8')
+
+    async def read_response(self):
+        """
+        读取一条完整的响应，包括其中的literal
+        :return: 与imaplib相同的结构：无literal时为[行]，否则为[(前缀, literal), ..., 结尾]，行不含CRLF
+        """
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError('服务器关闭了连接')
+        items = []
+        while True:
+            match = LITERAL_RE.search(line)
+            if match is None:
+                items.append(line.rstrip(b'\r\n'))
+                return items
+            literal = await self.reader.readexactly(int(match.group(1)))
+            items.append((line.rstrip(b'\r\n'), literal))
+            line = await self.reader.readline()
+
+    async def read_loop(self):
+        """后台读取协程：把响应分发给等待中的命令，连接断开时让全部等待中的命令失败"""
+        try:
+            while True:
+                items = await self.read_response()
+                head = items[0][0] if isinstance(items[0], tuple) else items[0]
+                if head.startswith(b'+'):
+                    if self._continuation is not None and not self._continuation.done():
+                        self._continuation.set_result(head)
+                elif head.startswith(b'* '):
+                    self.dispatch_untagged(head, items)
+                else:
+                    match = TAGGED_RE.match(head)
+                    command = self._pending.pop(match.group(1), None) if match else None
+                    if command is not None and not command.future.done():
+                        command.future.set_result((match.group(2).decode(), command.data,
+                                                   (match.group(3) or b'').decode('utf-8', 'replace')))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            for command in self._pending.values():
+                if not command.future.done():
+                    command.future.set_exception(ConnectionError(f'连接中断: {e}'))
+            self._pending.clear()
+            if self._continuation is not None and not self._continuation.done():
+                self._continuation.set_exception(ConnectionError(f'连接中断: {e}'))
+
+    def dispatch_untagged(self, head, items):
+        """
+        把未标记响应转为imaplib的数据格式（去掉'* '和响应名称），交给期望该响应的命令；
+        多条UID FETCH在途时按UID分配
+        """
+        match = UNTAGGED_STATUS_RE.match(head)
+        if match:
+            name = match.group(2).decode().upper()
+            data = match.group(1) + (b' ' + match.group(3) if match.group(3) else b'')
+        else:
+            match = UNTAGGED_RE.match(head)
+            if match is None:
+                return
+            name = match.group(1).decode().upper()
+            data = match.group(2) or b''
+        items[0] = (data, items[0][1]) if isinstance(items[0], tuple) else data
+
+        code = RESPONSE_CODE_RE.match(data) if name in ('OK', 'NO', 'BAD') else None
+        if code:
+            self.responses[code.group(1).decode().upper()] = [code.group(2)]
+        command = self.find_command(name, items)
+        if command is not None:
+            command.data.extend(items)
+        else:
+            self.responses.setdefault(name, []).extend(items)
+
+    def find_command(self, name, items):
+        candidates = [command for command in self._pending.values() if command.name == name]
+        if name == 'FETCH' and len(candidates) > 1:
+            for item in items:
+                match = FETCH_UID_RE.search(item[0] if isinstance(item, tuple) else item)
+                if match:
+                    uid = int(match.group(1))
+                    for command in candidates:
+                        if command.uids is not None and uid in command.uids:
+                            return command
+                    break
+        return candidates[0] if candidates else None
+
+    async def command(self, name, *args, expect=None, uids=None):
+        """
+        发送一条命令并等待结束响应。多个协程可以同时调用，命令依次写出而不等待前一条完成
+        :param name: 命令，如'UID FETCH'
+        :param args: 参数，str直接拼接，bytes以literal发送
+        :param expect: 期望的未标记响应名称，默认为命令的最后一个词
+        :param uids: UID FETCH的UID列表
+        :return: (status, 响应数据列表, 结束响应文本)
+        """
+        if self.closed:
+            # read_loop已退出，新登记的命令不会被分发响应
+            raise ConnectionError(f'{name}失败: 连接已关闭')
+        loop = asyncio.get_running_loop()
+        tag = f'M{next(self._tags)}'.encode()
+        command = PendingCommand((expect or name.split()[-1]).upper(), set(uids) if uids else None,
+                                 future=loop.create_future())
+        self._pending[tag] = command
+        async with self._write_lock:
+            line = tag + b' ' + name.encode()
+            for arg in args:
+                if isinstance(arg, bytes):
+                    # literal需要等服务器的继续响应'+'，服务器也可能直接以NO拒绝
+                    self._continuation = loop.create_future()
+                    self.writer.write(line + f' {{{len(arg)}}}\r\n'.encode())
+                    await self.writer.drain()
+                    await asyncio.wait([self._continuation, command.future], return_when=asyncio.FIRST_COMPLETED)
+                    if command.future.done():
+                        break
+                    line = arg
+                else:
+                    line += b' ' + arg.encode()
+            else:
+                self.writer.write(line + b'\r\n')
+                await self.writer.drain()
+        status, data, text = await command.future
+        if status != 'OK' and is_throttle_message(text):
+            raise ServerThrottled(f'{name}被限流: {text}')
+        return status, data, text
+
+    async def get_mailbox_list(self):
+        mailboxes = []
+        status, mailbox_list, text = await self.command('LIST', '""', '"*"')
+        for mailbox in mailbox_list:
+            if isinstance(mailbox, tuple):
+                # 文件夹名以literal返回时换成带引号的形式
+                mailbox = re.sub(rb'\{\d+\}$', lambda m: b'"' + mailbox[1] + b'"', mailbox[0])
+            parts = mailbox.decode().split(' "/" ')
+            if len(parts) > 1:
+                mailboxes.append(self.profile.decode_modified_utf7(parts[1]))
+        return mailboxes
+
+    async def select_folder(self, folder, readonly=True):
+        """
+        选中文件夹，与IMAPClientBase.search_folder使用相同的文件夹名编码
+        :return: (status, uid_validity)
+        """
+        self.responses.pop('UIDVALIDITY', None)
+        status, data, text = await self.command('EXAMINE' if readonly else 'SELECT',
+                                                self.profile.mailbox_name(folder))
+        uid_validity = self.responses.get('UIDVALIDITY', [None])[-1]
+        return status, int(uid_validity) if uid_validity else None
+
+    async def get_capabilities(self):
+        """登录后的能力列表，只查询一次"""
+        if self.profile.capabilities is None:
+            status, data, text = await self.command('CAPABILITY')
+            self.profile.capabilities = data[-1].decode().upper().split() if status == 'OK' and data else []
+        return self.profile.capabilities
+
+    async def folder_status(self, folder):
+        """与IMAPClientBase.folder_status相同，不选中文件夹获取STATUS"""
+        items = ['MESSAGES', 'UIDNEXT', 'UIDVALIDITY']
+        capabilities = await self.get_capabilities()
+        if 'CONDSTORE' in capabilities or 'QRESYNC' in capabilities:
+            items.append('HIGHESTMODSEQ')
+        status, data, text = await self.command('STATUS', self.profile.mailbox_name(folder), f'({" ".join(items)})')
+        if status != 'OK' or not data or not isinstance(data[-1], bytes):
+            print(f"STATUS失败: {text}")
+            return None
+        return self.profile.parse_status(data[-1])
+
+    async def search_folder(self, folder, criteria, sync_mark=None):
+        """
+        与IMAPClientBase.search_folder相同，始终使用UID搜索
+        :return: (status, 大于last_uid的UID整数列表, uid_validity, last_uid)
+        """
+        status, uid_validity = await self.select_folder(folder)
+        if status != 'OK':
+            return status, [], uid_validity, 0
+        last_uid = 0
+        uid_range = None
+        if sync_mark is not None:
+            if sync_mark.uid_validity is not None and sync_mark.uid_validity != uid_validity:
+                print(f'文件夹{folder}的UIDVALIDITY已变化，全量同步')
+            elif sync_mark.last_uid:
+                last_uid = sync_mark.last_uid
+                uid_range = f'{last_uid + 1}:*'
+                print(f'增量同步，从UID {last_uid + 1}开始')
+        status, uids = await self.search_messages(criteria, uid_range)
+        return status, [uid for uid in uids if uid > last_uid], uid_validity, last_uid
+
+    async def search_messages(self, query, uid_range=None):
+        """
+        与IMAPClientBase.search_messages相同。不受imaplib每条命令一个literal的限制，全部非ASCII条件一次发送
+        :return: (status, UID整数列表)
+        """
+        if isinstance(query, SearchQuery):
+            criteria = query.ascii_criteria()
+            text_terms = query.non_ascii_terms()
+        else:
+            criteria = query
+            text_terms = []
+        if uid_range:
+            criteria = f'UID {uid_range} {criteria}'
+        if not text_terms:
+            return await self.uid_search(criteria)
+
+        if self.profile.search_charset:
+            args = [criteria]
+            for key, value in text_terms:
+                args += [key, value.encode('utf-8')]
+            status, uids = await self.uid_search(*args, charset='UTF-8')
+            if status == 'OK' and uids:
+                return status, uids
+            print(f'CHARSET UTF-8搜索失败或无结果，改为在本地校验邮件头: {status}')
+
+        status, uids = await self.uid_search(criteria)
+        if status != 'OK':
+            return status, []
+        return status, await self.filter_by_headers(uids, query)
+
+    async def uid_search(self, *args, charset=None):
+        if charset:
+            args = ('CHARSET', charset) + args
+        status, data, text = await self.command('UID SEARCH', *args)
+        if status != 'OK':
+            print(f"UID SEARCH失败: {text}")
+            return status, []
+        return status, [int(uid) for item in data if isinstance(item, bytes) for uid in item.split()]
+
+    async def filter_by_headers(self, uids, query):
+        """与IMAPClientBase.filter_by_headers相同，各批次流水线发送"""
+        async def fetch_headers(chunk):
+            status, data, text = await self.command('UID FETCH', self.profile.compact_uid_set(chunk),
+                                                    '(BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)])', uids=chunk)
+            if status != 'OK':
+                print(f"Failed to fetch headers: {text}")
+                return chunk
+            matched_ = []
+            for uid, header in self.profile.iter_fetch_literals(data):
+                msg = email.message_from_bytes(header, policy=policy.default)
+                if query.matches(str(msg.get('From', '')), str(msg.get('Subject', ''))):
+                    matched_.append(uid)
+            return matched_
+
+        size = self.profile.size_batch_size
+        results = await asyncio.gather(*(fetch_headers(uids[start:start + size])
+                                         for start in range(0, len(uids), size)))
+        matched = sorted(uid for chunk in results for uid in chunk)
+        print(f'本地校验邮件头，{len(uids)}封候选邮件中{len(matched)}封匹配')
+        return matched
+
+    async def fetch_message_sizes(self, uids):
+        """与IMAPClientBase.fetch_message_sizes相同，各批次流水线发送"""
+        async def fetch_sizes(chunk):
+            status, data, text = await self.command('UID FETCH', self.profile.compact_uid_set(chunk),
+                                                    '(RFC822.SIZE)', uids=chunk)
+            if status != 'OK':
+                print(f"Failed to fetch RFC822.SIZE: {text}")
+                return {}
+            return self.profile.parse_message_sizes(data)
+
+        size = self.profile.size_batch_size
+        sizes = {}
+        for result in await asyncio.gather(*(fetch_sizes(uids[start:start + size])
+                                             for start in range(0, len(uids), size))):
+            sizes.update(result)
+        return sizes
+
+    async def fetch_full_messages(self, uids, message_handler):
+        """
+        获取邮件全文，批次划分与IMAPClientBase.fetch_full_messages相同。最多pipeline_depth个批次同时在途，
+        前一批交给message_handler处理时后一批的响应已在后台读取。message_handler是阻塞函数，在线程池中执行
+        :param message_handler: 以(UID, 邮件原始数据bytes或二进制文件对象)调用
+        :return: 成功获取的UID列表
+        """
+        profile = self.profile
+        sizes = await self.fetch_message_sizes(uids)
+        large_uids = [uid for uid in uids if sizes.get(uid, 0) > profile.large_message_bytes]
+        large = set(large_uids)
+        batches = profile.plan_fetch_batches([uid for uid in uids if uid not in large], sizes)
+        print(f'共{len(uids)}封邮件，分{len(batches)}批流水线获取，{len(large_uids)}封大邮件分块获取')
+        in_flight = asyncio.Semaphore(self.pipeline_depth)
+        fetched = []
+
+        async def fetch_batch(batch):
+            # 处理完一批才释放名额，在途和待处理的数据合计不超过pipeline_depth批
+            async with in_flight:
+                status, data, text = await self.command('UID FETCH', profile.compact_uid_set(batch), '(RFC822)',
+                                                        uids=batch)
+                if status != 'OK':
+                    print(f"Failed to fetch batch: {text}")
+                    return
+                for uid, raw_email in profile.iter_fetch_literals(data):
+                    await asyncio.to_thread(message_handler, uid, raw_email)
+                    fetched.append(uid)
+
+        await asyncio.gather(*(fetch_batch(batch) for batch in batches))
+        for uid in large_uids:
+            spool = await self.fetch_large_message(uid, sizes[uid])
+            if spool is None:
+                continue
+            with spool:
+                await asyncio.to_thread(message_handler, uid, spool)
+            fetched.append(uid)
+        if len(fetched) != len(uids):
+            missing = set(uids) - set(fetched)
+            print(f"Failed to fetch email uids: {sorted(missing)}")
+        return fetched
+
+    async def fetch_large_message(self, uid, size):
+        """与IMAPClientBase.fetch_large_message相同，分块获取一封大邮件"""
+        chunk_bytes = self.profile.fetch_chunk_bytes
+        spool = tempfile.SpooledTemporaryFile(max_size=chunk_bytes)
+        offset = 0
+        while True:
+            status, data, text = await self.command('UID FETCH', str(uid), f'(BODY.PEEK[]<{offset}.{chunk_bytes}>)',
+                                                    uids=[uid])
+            if status != 'OK':
+                print(f"Failed to fetch email uid {uid} at offset {offset}: {text}")
+                spool.close()
+                return None
+            chunk = self.profile.partial_body_chunk(data)
+            if chunk is None or (not chunk and offset == 0):
+                print(f"Failed to fetch email uid {uid} at offset {offset}: 响应中没有邮件内容")
+                spool.close()
+                return None
+            if chunk:
+                if self.rate_limiter:
+                    await asyncio.to_thread(self.rate_limiter.consume, len(chunk))
+                spool.write(chunk)
+                offset += len(chunk)
+            if len(chunk) < chunk_bytes:
+                break
+        if offset != size:
+            print(f'邮件uid {uid}实际大小{offset}字节，RFC822.SIZE为{size}字节')
+        spool.seek(0)
+        return spool
+
+    async def fetch_message_keys(self, uids):
+        """与IMAPClientBase.fetch_message_keys相同，各批次流水线发送"""
+        await self.get_capabilities()  # profile.message_key_items根据缓存的能力列表选择数据项
+        items = self.profile.message_key_items()
+
+        async def fetch_keys(chunk):
+            status, data, text = await self.command('UID FETCH', self.profile.compact_uid_set(chunk), items,
+                                                    uids=chunk)
+            if status != 'OK':
+                print(f"Failed to fetch Message-ID: {text}")
+                return {}
+            return self.profile.parse_message_keys(data)
+
+        size = self.profile.size_batch_size
+        keys = {}
+        for result in await asyncio.gather(*(fetch_keys(uids[start:start + size])
+                                             for start in range(0, len(uids), size))):
+            keys.update(result)
+        return keys
+
+    async def save_emails(self, folder, criteria, progress_callback=None, info_callback=None, sync_mark=None,
+                          message_sink=None, deduper=None):
+        """
+        与IMAPClientBase.saveEmails的批量模式相同：搜索文件夹并获取邮件全文，逐封交给message_sink
+        :param deduper: MessageDeduper，跳过已在其他文件夹获取的邮件
+        :return: 保存完毕返回True
+        """
+        folder_status = None
+        if sync_mark is not None:
+            folder_status = await self.folder_status(folder)
+            if self.profile.skip_unchanged_folder(folder, sync_mark, folder_status):
+                return True
+        status, uids, uid_validity, last_uid = await self.search_folder(folder, criteria, sync_mark)
+        if status != 'OK':
+            print(f"Failed to search emails with criteria: {criteria}")
+            return False
+        if message_sink is None:
+            message_sink = TempAreaSink(self.username)
+        total_count = len(uids)
+        print(f'共搜索到邮件{total_count}封')
+        saved_uids = []
+
+        def store(uid, raw_email):
+            if self.rate_limiter and isinstance(raw_email, bytes):
+                self.rate_limiter.consume(len(raw_email))
+            message_sink(folder, uid, raw_email)
+            saved_uids.append(uid)
+            # 在线程池中发出进度，pyqtSignal跨线程emit时由Qt排队到界面线程
+            if progress_callback and info_callback and total_count:
+                progress_callback.emit(int(len(saved_uids) / total_count * 100))
+                info_callback.emit(f'已获取邮件{len(saved_uids)}封/{total_count}封')
+
+        wanted_uids = uids
+        if deduper is not None and uids:
+            keys = await self.fetch_message_keys(uids)
+            wanted_uids = [uid for uid in uids if deduper.claim(folder, uid, *keys.get(uid, (None, None)))]
+            if len(wanted_uids) < len(uids):
+                print(f'文件夹{folder}中{len(uids) - len(wanted_uids)}封邮件已在其他文件夹获取，跳过')
+            # 由其他文件夹下载的副本视为已保存
+            wanted = set(wanted_uids)
+            saved_uids += [uid for uid in uids if uid not in wanted]
+        try:
+            if wanted_uids:
+                await self.fetch_full_messages(wanted_uids, store)
+        finally:
+            if sync_mark is not None:
+                # 连接中途断开时也记录检查点，重连后从检查点继续
+                sync_mark.uid_validity = uid_validity
+                sync_mark.last_uid = self.profile.get_checkpoint_uid(uids, saved_uids, last_uid)
+                sync_mark.record_status(folder_status if set(uids) <= set(saved_uids) else None)
+        print(f"Emails saved from {folder}")
+        return True
+
+
+async def open_client(client_type, email_account, rate_limiter=None):
+    """创建、连接并登录一个AsyncIMAPClient"""
+    profile = IMAPClientFactory.get_client(client_type, email_account.server_address, email_account.port,
+                                           email_account.username, email_account.password,
+                                           email_account.ssl_encryption)
+    client = AsyncIMAPClient(profile, rate_limiter)
+    await client.connect()
+    try:
+        await client.login()
+    except Exception:
+        await client.disconnect()
+        raise
+    print(f'账户{email_account.username}新建异步连接')
+    return client
+
+
+async def backup_account(client_type, email_account, criteria, jobs, message_sink=None, rate_limiter=None,
+                         deduper=None, retry_policy=None):
+    """
+    获取一个邮箱账户多个文件夹的邮件，与execute.backupEmailToTmpArea的连接池模式对应。
+    同时打开的连接数不超过服务商的max_connections，与该账户的其他连接池（如持续同步）共享
+    AccountConnectionBudget名额，每个连接上的命令流水线发送。连接断开或限流时
+    按retry_policy退避后重连，从检查点继续；限流时同时降低连接数和每批获取的数量
+    :param client_type: 客户端类型，如'qmail'
+    :param email_account: EmailAccount
+    :param criteria: SearchQuery
+    :param jobs: [(文件夹, FolderSyncMark或None, 进度通道, 信息通道)]，通道可以为None
+    :param message_sink: 邮件接收端，为None时保存到临时数据区
+    :param rate_limiter: 下载带宽预算
+    :param deduper: MessageDeduper，各文件夹之间下载前去重
+    :param retry_policy: mailclients.RetryPolicy，默认使用RetryPolicy()
+    :return: 获取完成返回True，连接失败返回None
+    """
+    budget = account_connection_budget(client_type, email_account.server_address, email_account.username)
+    opened = []
+
+    async def connect():
+        # 名额不足时在线程中阻塞等待，不阻塞事件循环
+        granted = asyncio.get_running_loop().run_in_executor(None, budget.acquire)
+        try:
+            await asyncio.shield(granted)
+        except asyncio.CancelledError:
+            granted.add_done_callback(lambda future: budget.release())
+            raise
+        try:
+            client = await open_client(client_type, email_account, rate_limiter)
+        except BaseException:
+            budget.release()
+            raise
+        opened.append(client)
+        return client
+
+    async def close(client):
+        if client not in opened:
+            return
+        opened.remove(client)
+        budget.release()
+        await client.disconnect()
+
+    try:
+        first = await connect()
+    except Exception as e:
+        print(f'任务失败{e}')
+        return None
+    retry_policy = retry_policy or RetryPolicy()
+    idle = [first]
+    max_connections = max(1, IMAPClientFactory.get_provider_options(client_type)['max_connections'])
+    slots = asyncio.Semaphore(max_connections)
+    # 限流状态：当前连接数上限、每批获取数量的缩小倍数，以及为降低连接数而永久占用的名额
+    limits = {'connections': max_connections, 'batch_divisor': 1}
+    reserved = []
+
+    def throttle():
+        if limits['connections'] > 1:
+            limits['connections'] -= 1
+            reserved.append(asyncio.ensure_future(slots.acquire()))
+        limits['batch_divisor'] = min(MAX_BATCH_DIVISOR, limits['batch_divisor'] * 2)
+        for client in opened:
+            client.profile.batch_divisor = limits['batch_divisor']
+        print(f'账户{email_account.username}被限流，连接数降为{limits["connections"]}，'
+              f'每批获取数量缩小为1/{limits["batch_divisor"]}')
+
+    async def fetch_folder(folder, sync_mark, progress, info):
+        if sync_mark is None:
+            sync_mark = FolderSyncMark(folder)
+        attempt = 0
+        last_uid = sync_mark.last_uid
+        async with slots:
+            while True:
+                client = None
+                try:
+                    while idle and idle[-1].closed:
+                        # 空闲期间被服务器断开的连接
+                        await close(idle.pop())
+                    if idle:
+                        client = idle.pop()
+                    else:
+                        client = await connect()
+                        client.profile.batch_divisor = limits['batch_divisor']
+                    await client.save_emails(folder, criteria, progress, info, sync_mark, message_sink, deduper)
+                    if client.closed:
+                        await close(client)
+                    else:
+                        idle.append(client)
+                    break
+                except Exception as e:
+                    if client is not None:
+                        await close(client)
+                    if not is_retryable_error(e):
+                        raise
+                    if isinstance(e, ServerThrottled) or is_throttle_message(str(e)):
+                        throttle()
+                    attempt = 1 if sync_mark.last_uid != last_uid else attempt + 1
+                    last_uid = sync_mark.last_uid
+                    if attempt > retry_policy.max_retries:
+                        raise
+                    delay = retry_policy.delay(attempt)
+                    print(f'文件夹{folder}获取中断{e}，{delay:.1f}秒后第{attempt}次重连')
+                    await asyncio.sleep(delay)
+        if progress:
+            progress.emit(100)
+
+    try:
+        await asyncio.gather(*(fetch_folder(*job) for job in jobs))
+    finally:
+        for future in reserved:
+            future.cancel()
+        for client in list(opened):
+            await close(client)
+    return True
+
+
+class AsyncIMAPEngine:
+    """
+    在后台线程中运行的事件循环。各备份线程通过run()提交协程，全部账户、全部文件夹的IMAP连接都在这一个事件循环上
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='AsyncIMAPEngine', daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def instance(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def run(self, coro):
+        """在引擎的事件循环上执行协程，阻塞调用线程直到完成并返回结果"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
@@ -0,0 +1,291 @@
+import os
+import pickle
+import random
+import shutil
+import threading
+import time
+from argparse import ArgumentParser
+from dataclasses import dataclass, field, replace
+from datetime import date
+from typing import List
+
+from MDLStore import execute, htmltext
+from MDLStore.database.entities import BackupTask, EmailAccount
+from MDLStore.imapserver import LocalIMAPServer, ServerProfile, generate_corpus
+from MDLStore.mailclients import IMAPClientFactory, FolderSyncMark, temp_dir
+from MDLStore.utils import EmailUtils
+
+# 各客户端类型使用的测试账户，ServerUtils.get_client_type按域名选择客户端
+BENCHMARK_USERS = {'gmail': 'bench@gmail.com', 'netease': 'bench@163.com', 'nete126': 'bench@126.com',
+                   'rucmail': 'bench@ruc.edu.cn', 'qmail': 'bench@qq.com', 'outlook': 'bench@outlook.com',
+                   'sina': 'bench@sina.com', 'mail139': 'bench@139.com', 'mail189': 'bench@189.cn',
+                   'sohu': 'bench@sohu.com'}
+
+
+@dataclass
+class BenchmarkScenario:
+    """一个基准测试场景：邮件语料、模拟的网络条件和获取方式"""
+    name: str
+    messages: int = 500  # 邮件总数，平均分到各文件夹
+    body_bytes: int = 4096
+    attachment_bytes: int = 64 * 1024
+    folders: List[str] = field(default_factory=lambda: ['INBOX', '已发送'])
+    client_type: str = 'gmail'
+    engine: str = 'thread'  # client：单个IMAPClientFactory客户端；thread、asyncio：backupEmailToTmpArea的两种引擎
+    latency: float = 0  # 秒，模拟往返时间
+    bandwidth: int = 0  # 字节/秒，0表示不限速
+    throttle_every: int = 0  # 每N条FETCH被限流一次
+    compress: bool = True
+    temp_area: bool = False  # 为True时保存到临时数据区，包含写磁盘的开销；否则只计数不保存
+
+    def profile(self):
+        return ServerProfile(latency=self.latency, bandwidth=self.bandwidth, throttle_every=self.throttle_every,
+                             compress=self.compress, gmail=self.client_type == 'gmail')
+
+
+@dataclass
+class BenchmarkResult:
+    scenario: BenchmarkScenario
+    messages: int  # 获取到的邮件数
+    bytes: int  # 获取到的邮件原始数据字节数
+    seconds: float
+    server_stats: dict
+
+    @property
+    def messages_per_second(self):
+        return self.messages / self.seconds if self.seconds else 0
+
+    @property
+    def megabytes_per_second(self):
+        return self.bytes / 1024 / 1024 / self.seconds if self.seconds else 0
+
+    @property
+    def round_trips_per_message(self):
+        """服务器处理的命令数除以邮件数，流水线发送的命令也按条计算"""
+        return self.server_stats['commands'] / self.messages if self.messages else 0
+
+    def describe(self):
+        stats = self.server_stats
+        return (f'{self.scenario.name:<16}{self.scenario.engine:<9}{self.messages:>7}{self.seconds:>9.2f}'
+                f'{self.messages_per_second:>10.1f}{self.megabytes_per_second:>9.2f}'
+                f'{self.round_trips_per_message:>9.3f}{stats["sessions"]:>6}{stats["throttled"]:>6}'
+                f'{stats["wire_bytes_out"] / max(1, stats["bytes_out"]):>8.2f}')
+
+
+RESULT_HEADER = (f'{"场景":<14}{"引擎":<7}{"邮件数":>4}{"秒":>8}{"封/秒":>7}{"MB/秒":>7}{"往返/封":>6}'
+                 f'{"连接":>4}{"限流":>4}{"压缩比":>5}')
+
+DEFAULT_SCENARIOS = [
+    BenchmarkScenario('lan'),
+    BenchmarkScenario('lan', engine='asyncio'),
+    BenchmarkScenario('lan', engine='client', folders=['INBOX']),
+    BenchmarkScenario('wan-50ms', latency=0.05),
+    BenchmarkScenario('wan-50ms', latency=0.05, engine='asyncio'),
+    BenchmarkScenario('bandwidth-2MB', bandwidth=2 * 1024 * 1024, messages=200),
+    BenchmarkScenario('throttled', client_type='netease', latency=0.02, throttle_every=3),
+    BenchmarkScenario('throttled', client_type='netease', latency=0.02, throttle_every=3, engine='asyncio'),
+]
+
+
+class CountingSink:
+    """代替保存邮件的message_sink，只统计邮件数和字节数"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.bytes = 0
+
+    def __call__(self, folder, uid, raw_email):
+        if hasattr(raw_email, 'read'):
+            # 大邮件以临时文件的形式交给message_sink
+            raw_email.seek(0, os.SEEK_END)
+            size = raw_email.tell()
+        else:
+            size = len(raw_email)
+        with self.lock:
+            self.messages += 1
+            self.bytes += size
+
+
+def build_corpus(scenario):
+    """按文件夹平均分配的邮件语料"""
+    folders = {}
+    per_folder = -(-scenario.messages // len(scenario.folders))
+    for index, folder in enumerate(scenario.folders):
+        count = max(0, min(per_folder, scenario.messages - index * per_folder))
+        folders[folder] = generate_corpus(count, scenario.body_bytes, scenario.attachment_bytes,
+                                          first_index=index * per_folder)
+    return folders
+
+
+def count_temp_area(username):
+    """临时数据区中保存的邮件数和字节数"""
+    messages, size = 0, 0
+    for root, _, files in os.walk(os.path.join(temp_dir, username)):
+        for name in files:
+            messages += 1
+            size += os.path.getsize(os.path.join(root, name))
+    return messages, size
+
+
+def run_benchmark(scenario, corpus=None):
+    """
+    启动本地IMAP服务器并完整获取一遍全部文件夹
+    :param corpus: build_corpus的结果，多个场景使用相同语料时传入以节省生成时间
+    :return: BenchmarkResult
+    """
+    corpus = corpus or build_corpus(scenario)
+    username = BENCHMARK_USERS[scenario.client_type]
+    shutil.rmtree(os.path.join(temp_dir, username), ignore_errors=True)
+    sink = None if scenario.temp_area else CountingSink()
+    criteria = EmailUtils.buildSearchQuery(date(2000, 1, 1), date(2100, 1, 1), '', '')
+    with LocalIMAPServer(corpus, scenario.profile()) as server:
+        started = time.perf_counter()
+        if scenario.engine == 'client':
+            client = IMAPClientFactory.get_client(scenario.client_type, '127.0.0.1', server.port, username,
+                                                  'benchmark', False)
+            if not client.connect():
+                raise RuntimeError(f'场景{scenario.name}连接本地服务器失败')
+            client.login()
+            client.start_compression()
+            try:
+                for folder in scenario.folders:
+                    client.saveEmails(folder, criteria, sync_mark=FolderSyncMark(folder), message_sink=sink)
+            finally:
+                client.disconnect()
+        else:
+            account = EmailAccount(server_address='127.0.0.1', port=server.port, username=username,
+                                   password='benchmark', ssl_encryption=False)
+            task = BackupTask(task_name=f'benchmark-{scenario.name}', folder_list=pickle.dumps(scenario.folders),
+                              start_date=date(2000, 1, 1), end_date=date(2100, 1, 1), content_type='RFC2822',
+                              sender='', subject_keywords='', filename_keywords='')
+            engine = execute.IMAP_ENGINE
+            execute.IMAP_ENGINE = scenario.engine
+            try:
+                if not execute.backupEmailToTmpArea(task, account, None, None, message_sink=sink):
+                    raise RuntimeError(f'场景{scenario.name}连接本地服务器失败')
+            finally:
+                execute.IMAP_ENGINE = engine
+        seconds = time.perf_counter() - started
+        stats = server.stats.snapshot()
+    if sink is None:
+        messages, size = count_temp_area(username)
+        shutil.rmtree(os.path.join(temp_dir, username), ignore_errors=True)
+    else:
+        messages, size = sink.messages, sink.bytes
+    return BenchmarkResult(scenario, messages, size, seconds, stats)
+
+
+def run_benchmarks(scenarios):
+    """依次运行各场景并打印结果表，语料参数相同的场景共用语料"""
+    corpora = {}
+    results = []
+    for scenario in scenarios:
+        key = (scenario.messages, scenario.body_bytes, scenario.attachment_bytes, tuple(scenario.folders))
+        if key not in corpora:
+            corpora[key] = build_corpus(scenario)
+        results.append(run_benchmark(scenario, corpora[key]))
+    print(RESULT_HEADER)
+    for result in results:
+        print(result.describe())
+    return results
+
+
+CJK_WORDS = ['发票', '报销', '会议纪要', '项目进度', '请查收附件', '中国人民大学', '季度报告', '合同', '审批流程',
+             '数据备份', '邮件归档', '请于周五前回复', '谢谢', '此致敬礼', '附件已上传至云盘']
+
+
+def generate_html_corpus(count, seed=0):
+    """
+    生成以中文为主的HTML邮件正文：嵌套的div和表格、内联样式、style和script块、注释、实体、
+    未闭合的标签和QQ邮箱样式的云附件区块，用于比较HTML转文本后端。
+    部分正文模拟get_body_text的合并结果：纯文本部分在前、多个HTML文档拼接、</html>之后还有文本
+    """
+    rnd = random.Random(seed)
+    bodies = []
+    for index in range(count):
+        paragraphs = []
+        for _ in range(rnd.randint(5, 40)):
+            words = ''.join(rnd.choice(CJK_WORDS) + rnd.choice(['，', '。', ' ', '；', '']) for _ in range(12))
+            paragraphs.append(rnd.choice([
+                f'<p style="margin:0;font-family:微软雅黑">{words}</p>',
+                f'<div><span style="color:#333">{words}</span><br>{words[:10]}&nbsp;&amp;&#x4E2D;&#25991;</div>',
+                f'<table><tr><td>{words[:8]}</td><td>{index} &lt; {index + 1}</td></tr></table>',
+                f'<!-- {words} --><div>{words}<b>加粗<i>斜体</b></i></div>',
+                f'<p>Plain English line {index} with a <a href="https://example.com/{index}">link</a>.</p>',
+                f'<p>{words[:6]}<!--{index}-->{words[6:]}</p>',
+            ]))
+        body = (
+            '<html><head><meta charset="utf-8"><style>p{margin:0} .x{color:red}</style>'
+            f'<script>var a = "{index}<b>";</script></head><body>' + ''.join(paragraphs) +
+            f'<div class="bigatt_bt" title="季度报告{index}.pdf\n文件大小：12.5M\n到期时间：无限期">'
+            f'<a href="https://mail.qq.com/cgi-bin/ftnExs_download?k={index}">季度报告{index}.pdf</a></div>'
+            '</body></html>')
+        layout = index % 4
+        if layout == 1:
+            body = f'{words}\n纯文本部分 {index}\n' + body
+        elif layout == 2:
+            body = body + f'<html><body><p>第二部分{index}</p>{words}</body></html>'
+        elif layout == 3:
+            body = body + f'\n{words}<!--trailer-->签名 {index}'
+        bodies.append(body)
+    return bodies
+
+
+def run_html_benchmark(count=2000, backends=None):
+    """
+    比较各HTML转文本后端的吞吐量，并以bs4的结果为基准检查输出是否一致
+    :return: [(后端, 篇/秒, MB/秒, 完全一致比例, 忽略空白后一致比例)]
+    """
+    bodies = generate_html_corpus(count)
+    size = sum(len(body.encode('utf-8')) for body in bodies)
+    reference = [htmltext.bs4_to_text(body) for body in bodies]
+    results = []
+    for backend in backends or list(htmltext.BACKENDS):
+        started = time.perf_counter()
+        outputs = [htmltext.html_to_text(body, backend) for body in bodies]
+        seconds = time.perf_counter() - started
+        identical = sum(output == expected for output, expected in zip(outputs, reference)) / count
+        similar = sum(output.split() == expected.split() for output, expected in zip(outputs, reference)) / count
+        results.append((backend, count / seconds, size / 1024 / 1024 / seconds, identical, similar))
+    print(f'{"后端":<10}{"篇/秒":>8}{"MB/秒":>9}{"一致":>8}{"忽略空白一致":>10}')
+    for backend, per_second, megabytes, identical, similar in results:
+        print(f'{backend:<12}{per_second:>10.1f}{megabytes:>11.2f}{identical:>10.1%}{similar:>14.1%}')
+    return results
+
+
+def main():
+    parser = ArgumentParser(description='在本地IMAP替身服务器上测量邮件获取的吞吐量')
+    parser.add_argument('-s', '--scenario', action='append', dest='scenarios',
+                        help='只运行指定名称的场景，可重复')
+    parser.add_argument('-e', '--engine', choices=['client', 'thread', 'asyncio'], help='只运行指定引擎的场景')
+    parser.add_argument('-n', '--messages', type=int, help='覆盖各场景的邮件数')
+    parser.add_argument('--latency', type=float, help='覆盖各场景的往返时间（秒）')
+    parser.add_argument('--bandwidth', type=int, help='覆盖各场景的带宽（字节/秒）')
+    parser.add_argument('--temp-area', action='store_true', help='保存到临时数据区，包含写磁盘的开销')
+    parser.add_argument('-l', '--list', action='store_true', help='列出场景后退出')
+    parser.add_argument('--html', type=int, metavar='N', help='改为用N篇HTML正文比较HTML转文本后端')
+    args = parser.parse_args()
+
+    if args.html:
+        run_html_benchmark(args.html)
+        return
+
+    scenarios = DEFAULT_SCENARIOS
+    if args.list:
+        for scenario in scenarios:
+            print(scenario)
+        return
+    if args.scenarios:
+        scenarios = [scenario for scenario in scenarios if scenario.name in args.scenarios]
+    if args.engine:
+        scenarios = [scenario for scenario in scenarios if scenario.engine == args.engine]
+    overrides = {name: value for name, value in (('messages', args.messages), ('latency', args.latency),
+                                                 ('bandwidth', args.bandwidth)) if value is not None}
+    if args.temp_area:
+        overrides['temp_area'] = True
+    run_benchmarks([replace(scenario, **overrides) for scenario in scenarios])
+
+
+if __name__ == '__main__':
+    main()
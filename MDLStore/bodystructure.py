@@ -0,0 +1,222 @@
+import re
+import uuid
+from dataclasses import dataclass
+from email.header import decode_header, make_header
+from email.utils import decode_rfc2231
+from typing import Optional
+from urllib.parse import unquote
+
+# BODYSTRUCTURE响应的词法单元：括号、带引号的字符串、literal占位符和原子
+TOKEN_RE = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|\x00(\d+)\x00|([^\s()"]+))')
+LITERAL_RE = re.compile(rb'\{(\d+)\}$')
+
+
+@dataclass
+class MimePart:
+    """BODYSTRUCTURE中的一个叶子MIME部分"""
+    section: str  # 部分编号，如'2'或'1.2'，用于BODY.PEEK[section]
+    content_type: str  # 如'text/html'
+    encoding: Optional[str] = None
+    size: int = 0  # 编码后的字节数
+    disposition: Optional[str] = None  # 如'attachment'、'inline'
+    filename: Optional[str] = None  # 解码后的文件名
+
+    @property
+    def decoded_size(self):
+        """解码后的大致字节数"""
+        if (self.encoding or '').lower() == 'base64':
+            return self.size * 3 // 4
+        return self.size
+
+    @property
+    def is_attachment(self):
+        return self.disposition is not None and self.disposition.lower() == 'attachment'
+
+
+def parse_sexp(data):
+    """
+    将imaplib返回的FETCH响应片段解析为嵌套列表。字符串为str，NIL为None，literal按字符串处理
+    :param data: bytes，或imaplib返回的由bytes和(前缀, literal)元组组成的列表
+    :return: 嵌套列表
+    """
+    if isinstance(data, bytes):
+        data = [data]
+    literals = []
+    text = b''
+    for item in data:
+        if isinstance(item, tuple):
+            prefix, literal = item
+            text += LITERAL_RE.sub(f'\x00{len(literals)}\x00'.encode(), prefix)
+            literals.append(literal)
+        elif isinstance(item, bytes):
+            text += item
+
+    stack = [[]]
+    for match in TOKEN_RE.finditer(text):
+        open_, close, quoted, literal_index, atom = match.groups()
+        if open_:
+            stack.append([])
+        elif close:
+            if len(stack) == 1:
+                break
+            node = stack.pop()
+            stack[-1].append(node)
+        elif quoted is not None:
+            stack[-1].append(re.sub(rb'\\(.)', rb'\1', quoted).decode('utf-8', 'replace'))
+        elif literal_index is not None:
+            stack[-1].append(literals[int(literal_index)].decode('utf-8', 'replace'))
+        else:
+            value = atom.decode('utf-8', 'replace')
+            stack[-1].append(None if value.upper() == 'NIL' else value)
+    while len(stack) > 1:
+        node = stack.pop()
+        stack[-1].append(node)
+    return stack[0]
+
+
+def find_bodystructure(tree):
+    """在FETCH响应的嵌套列表中找到BODYSTRUCTURE对应的列表"""
+    for item in tree:
+        if isinstance(item, list):
+            for index, value in enumerate(item[:-1]):
+                if isinstance(value, str) and value.upper() == 'BODYSTRUCTURE':
+                    return item[index + 1]
+    return None
+
+
+def parse_bodystructure(node, section=''):
+    """
+    将BODYSTRUCTURE展开为叶子MIME部分列表，message/rfc822部分作为整体不再展开
+    :param node: find_bodystructure返回的列表
+    :param section: 上级部分编号，顶层为空
+    :return: MimePart列表；非multipart邮件只有一个编号为'1'的部分
+    """
+    if not isinstance(node, list) or not node:
+        return []
+    if isinstance(node[0], list):
+        parts = []
+        number = 0
+        for child in node:
+            if not isinstance(child, list):
+                break
+            number += 1
+            parts += parse_bodystructure(child, f'{section}.{number}' if section else str(number))
+        return parts
+
+    main_type = (node[0] or '').lower()
+    sub_type = (node[1] or '').lower() if len(node) > 1 else ''
+    params = param_dict(node[2]) if len(node) > 2 else {}
+    encoding = node[5] if len(node) > 5 else None
+    size = int(node[6]) if len(node) > 6 and str(node[6]).isdigit() else 0
+    # 扩展字段的位置：text类型多一个行数，message/rfc822多信封、内部结构和行数
+    if main_type == 'text':
+        extension = 8
+    elif main_type == 'message' and sub_type == 'rfc822':
+        extension = 10
+    else:
+        extension = 7
+    disposition = None
+    disposition_params = {}
+    if len(node) > extension + 1 and isinstance(node[extension + 1], list) and node[extension + 1]:
+        disposition = node[extension + 1][0]
+        if len(node[extension + 1]) > 1:
+            disposition_params = param_dict(node[extension + 1][1])
+    filename = decode_param(disposition_params, 'filename') or decode_param(params, 'name')
+    return [MimePart(section or '1', f'{main_type}/{sub_type}', encoding, size, disposition, filename)]
+
+
+def param_dict(values):
+    """将('key' 'value' ...)形式的参数列表转为小写键的字典"""
+    if not isinstance(values, list):
+        return {}
+    return {str(values[i]).lower(): values[i + 1] for i in range(0, len(values) - 1, 2)}
+
+
+def decode_param(params, name):
+    """
+    解码参数值，支持RFC 2231的name*、name*0*续行形式和RFC 2047编码字
+    :return: 解码后的字符串，不存在时为None
+    """
+    if name in params and params[name]:
+        value = params[name]
+        try:
+            return str(make_header(decode_header(value)))
+        except Exception:
+            return value
+    pieces = sorted((key for key in params if key.startswith(f'{name}*')),
+                    key=lambda key: int(re.sub(r'\D', '', key) or 0))
+    if not pieces:
+        return None
+    encoded = pieces[0].endswith('*')
+    value = ''.join(params[key] or '' for key in pieces)
+    if not encoded:
+        return value
+    charset, language, text = decode_rfc2231(value)
+    try:
+        return unquote(text, encoding=charset or 'us-ascii', errors='replace')
+    except LookupError:
+        return unquote(text)
+
+
+class PartSelector:
+    """
+    只备份附件或云附件的任务使用：根据BODYSTRUCTURE决定一封邮件需要下载哪些MIME部分，
+    匹配文件名关键字的附件加上正文部分，正文用于识别云附件和建立正文索引
+    """
+
+    def __init__(self, filename_keyword=None, attachments=True, cloud_attachments=True):
+        self.filename_keyword = filename_keyword or ''
+        self.attachments = attachments
+        self.cloud_attachments = cloud_attachments
+
+    def match_attachment(self, part):
+        # 文件名无法解码时宁可多下载，保证不漏掉附件
+        return part.is_attachment and (part.filename is None or self.filename_keyword in part.filename)
+
+    def select(self, parts):
+        """
+        :param parts: parse_bodystructure返回的MimePart列表
+        :return: 需要下载的MimePart列表，为空表示整封邮件都不需要
+        """
+        wanted_attachments = [part for part in parts if self.attachments and self.match_attachment(part)]
+        if not wanted_attachments and not self.cloud_attachments:
+            return []
+        text_parts = [part for part in parts if not part.is_attachment and
+                      part.content_type in ('text/plain', 'text/html')]
+        return sorted(text_parts + wanted_attachments, key=lambda part: [int(n) for n in part.section.split('.')])
+
+
+def strip_headers(header, names):
+    """删除邮件头中指定名称（小写）的字段，包括折行的续行"""
+    lines = []
+    skipping = False
+    for line in header.splitlines(keepends=True):
+        if not line.strip():
+            break
+        if line[:1] in (b' ', b'\t'):
+            if not skipping:
+                lines.append(line)
+            continue
+        skipping = line.split(b':', 1)[0].strip().lower() in names
+        if not skipping:
+            lines.append(line)
+    return b''.join(lines)
+
+
+def assemble_message(header, parts):
+    """
+    用原邮件头和选中的MIME部分重新组成一封multipart/mixed邮件，供EmailParser按完整邮件解析
+    :param header: BODY[HEADER]的内容
+    :param parts: [(BODY[n.MIME]的内容, BODY[n]的内容)]
+    :return: 邮件原始数据
+    """
+    boundary = f'=_MDLStore_{uuid.uuid4().hex}'
+    header = strip_headers(header, {b'content-type', b'content-transfer-encoding', b'mime-version'})
+    lines = [header.rstrip(b'\r\n'), b'\r\nMIME-Version: 1.0\r\n',
+             f'Content-Type: multipart/mixed; boundary="{boundary}"\r\n\r\n'.encode()]
+    for mime_header, body in parts:
+        lines.append(f'--{boundary}\r\n'.encode())
+        lines.append(mime_header.rstrip(b'\r\n') + b'\r\n\r\n')
+        lines.append(body.rstrip(b'\r\n') + b'\r\n')
+    lines.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(lines)
@@ -8,7 +8,70 @@ import re
 import urllib.parse
 import zlib
 
-from bs4 import BeautifulSoup
+from MDLStore.htmltext import make_soup
+
+
+class CloudProviderRegistry:
+    """
+    云附件提供商的识别表：每个提供商对应一个主机名和一个预编译的外部链接模式。
+    绝大多数邮件正文不含云附件，先在一次扫描中检查正文里每个https链接的主机名，只有命中时才运行正则和BeautifulSoup解析
+    """
+    LINK_SCHEME = 'https://'
+
+    def __init__(self, providers):
+        """
+        :param providers: (提供商名称, 主机名, 链接模式)的序列，按识别优先级排列
+        """
+        self.providers = [(name, host, re.compile(pattern)) for name, host, pattern in providers]
+        self.link_prefixes = tuple(dict.fromkeys(f'{self.LINK_SCHEME}{host}/' for _, host, _ in providers))
+
+    def find_hosts(self, text):
+        """
+        返回文本中以https链接形式出现的提供商主机名集合，为空则一定没有云附件链接
+        """
+        hosts = set()
+        pos = text.find(self.LINK_SCHEME)
+        while pos != -1:
+            if text.startswith(self.link_prefixes, pos):
+                end = text.index('/', pos + len(self.LINK_SCHEME))
+                hosts.add(text[pos + len(self.LINK_SCHEME):end])
+            pos = text.find(self.LINK_SCHEME, pos + len(self.LINK_SCHEME))
+        return hosts
+
+    def detect(self, html):
+        """
+        返回HTML中出现的第一个提供商的名称，没有则返回None
+        """
+        if not html:
+            return None
+        hosts = self.find_hosts(html)
+        if not hosts:
+            return None
+        for name, host, pattern in self.providers:
+            if host in hosts and pattern.search(html):
+                return name
+        return None
+
+    def provider_of(self, outside_link):
+        """
+        返回外部链接所属提供商的名称，无法识别则返回None
+        """
+        for name, host, pattern in self.providers:
+            if pattern.match(outside_link):
+                return name
+        return None
+
+
+CLOUD_PROVIDERS = CloudProviderRegistry((
+    ("163", "mail.163.com", r'https://mail\.163\.com/large-attachment-download/index\.html\?p=.*'),
+    ("126", "mail.163.com", r'https://mail\.163\.com/large-attachment-download/index\.html\?p=.*'),
+    ("QQ", "mail.qq.com", r'https://mail\.qq\.com/cgi-bin/ftnExs_download\?k=.*'),
+    ("Gmail", "drive.google.com", r'https://drive\.google\.com/(file/d/|open\?id=).*'),
+    ("Outlook", "1drv.ms", r'https://1drv\.ms/.*'),
+    ("189", "download.cloud.189.cn", r'https://download\.cloud\.189\.cn/file/downloadFile\.action\?dt=.*'),
+    ("RUC", "edisk.qiye.163.com", r'https://edisk\.qiye\.163\.com/api/biz/attachment/download\?identity=.*'),
+    ("Sina", "mail.sina.com.cn", r'https://mail\.sina\.com\.cn/filecenter/download\.php\?id=.*'),
+))
 
 
 class CloudFileParser:
@@ -63,7 +126,7 @@ class QQCloudFileParser(CloudFileParser):
         :param html: 邮件正文的HTML内容
         :return: 包含文件名、链接等信息的字典列表
         """
-        soup = BeautifulSoup(html, 'html.parser')
+        soup = make_soup(html)
         cloud_file_info_list = []
 
         # 查找所有包含云附件链接的部分
@@ -179,7 +242,7 @@ class NeteaseCloudFileParser(CloudFileParser):
         :param html: 邮件正文的HTML内容
         :return: 包含文件名、过期时间、文件大小和下载链接的字典列表
         """
-        soup = BeautifulSoup(html, 'html.parser')
+        soup = make_soup(html)
         cloud_file_info_list = []
 
         # 查找所有云附件的相关部分
@@ -225,8 +288,6 @@ class GmailCloudFileParser(CloudFileParser):
     def __init__(self):
         super().__init__("Gmail")
 
-    from bs4 import BeautifulSoup
-
     def get_cloud_file_info(self, html):
         """
         解析Gmail云附件的HTML，提取文件名、文件大小、过期时间和下载链接
@@ -234,7 +295,7 @@ class GmailCloudFileParser(CloudFileParser):
         :return: 包含文件名、文件大小、过期时间、过期状态和外部链接的字典列表
         """
         print(f'获取gmail云附件信息')
-        soup = BeautifulSoup(html, 'html.parser')
+        soup = make_soup(html)
         cloud_file_info_list = []
 
         # 查找包含云附件信息的 div 元素
@@ -281,7 +342,7 @@ class OutlookCloudFileParser(CloudFileParser):
         :param html: 邮件正文的HTML内容
         :return: 包含文件名、链接等信息的字典列表
         """
-        soup = BeautifulSoup(html, 'html.parser')
+        soup = make_soup(html)
         cloud_file_info_list = []
 
         # 查找所有包含云附件链接的部分
@@ -310,7 +371,7 @@ class Cloud189FileParser(CloudFileParser):
         :param html: 邮件正文的HTML内容
         :return: 包含文件名、下载链接、文件大小和过期时间的字典列表
         """
-        soup = BeautifulSoup(html, 'html.parser')
+        soup = make_soup(html)
         cloud_file_info_list = []
 
         # 查找所有包含附件信息的 div 标签
@@ -374,7 +435,7 @@ class RUCCloudFileParser(CloudFileParser):
         :param html: 邮件正文的HTML内容
         :return: 返回一个包含所有云附件信息的列表
         """
-        soup = BeautifulSoup(html, 'html.parser')
+        soup = make_soup(html)
         cloud_file_info_list = []
 
         # 查找所有附件的div标签
@@ -443,7 +504,7 @@ class SinaCloudFileParser(CloudFileParser):
         super().__init__("Sina")
 
     def get_cloud_file_info(self, html_content):
-        soup = BeautifulSoup(html_content, 'html.parser')
+        soup = make_soup(html_content)
         attachments = []
         # 查找所有附件的容器
         att_containers = soup.find_all('div', style=lambda value: value and 'margin-top: 20px' in value)
@@ -626,17 +687,6 @@ class SinaCloudFileParser(CloudFileParser):
 
 
 class CloudAttachmentDownloader:
-    patterns = {
-        "163": r'https://mail\.163\.com/large-attachment-download/index\.html\?p=.*',
-        "126": r'https://mail\.163\.com/large-attachment-download/index\.html\?p=.*',
-        "QQ": r'https://mail\.qq\.com/cgi-bin/ftnExs_download\?k=.*',
-        "Gmail": r'https://drive\.google\.com/(file/d/|open\?id=).*',
-        "Outlook": r'https://1drv\.ms/.*',
-        "189": r'https://download\.cloud\.189\.cn/file/downloadFile\.action\?dt=.*',
-        "RUC": r'https://edisk\.qiye\.163\.com/api/biz/attachment/download\?identity=.*',
-        "Sina": r'https://mail\.sina\.com\.cn/filecenter/download\.php\?id=.*'
-    }
-
     def __init__(self, outside_link):
         self.outside_link = outside_link
         self.provider = self.get_cloud_file_provider(outside_link)
@@ -649,10 +699,10 @@ class CloudAttachmentDownloader:
         :param outside_link: 外部链接
         :return: 返回名称
         """
-        for provider, pattern in CloudAttachmentDownloader.patterns.items():
-            if re.match(pattern, outside_link):
-                return provider
-        raise ValueError("Unsupported provider")
+        provider = CLOUD_PROVIDERS.provider_of(outside_link)
+        if provider is None:
+            raise ValueError("Unsupported provider")
+        return provider
 
     def create_download_utils(self):
         if self.provider == "163" or self.provider == "126":
@@ -1,5 +1,6 @@
 import os
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, ForeignKey, PickleType, Date, DateTime, Float
+from sqlalchemy import create_engine, Column, Integer, String, Boolean, ForeignKey, PickleType, Date, DateTime, Float, \
+    Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 
 from MDLStore.database.config_database_setup import Base
@@ -88,6 +89,30 @@ class EmailAccount(Base):
                 f"port={self.port}, username='{self.username}', ssl_encryption={self.ssl_encryption}, remarks='{self.remarks}')>")
 
 
+class SyncState(Base):
+    __tablename__ = 'sync_states'
+
+    # 字段定义
+    state_id = Column(Integer, primary_key=True, autoincrement=True)  # 同步状态标识符，自增主键
+    task_id = Column(Integer, ForeignKey('backup_tasks.task_id'), nullable=False)  # 所属备份任务
+    account = Column(String, nullable=False)  # 邮箱账户地址
+    folder = Column(String, nullable=False)  # 邮箱文件夹名称
+    drive = Column(String, nullable=False)  # 备份目标磁盘分区
+    uid_validity = Column(Integer, nullable=False)  # 文件夹的UIDVALIDITY，变化时需要全量同步
+    last_uid = Column(Integer, nullable=False, default=0)  # 已备份的最大UID
+    criteria = Column(String, nullable=True)  # 备份时使用的搜索条件，条件变化时需要全量同步
+    # 上次完整备份前文件夹的STATUS，与当前STATUS相同时跳过该文件夹
+    messages = Column(Integer, nullable=True)  # 邮件数
+    uid_next = Column(Integer, nullable=True)  # UIDNEXT
+    highest_modseq = Column(Integer, nullable=True)  # HIGHESTMODSEQ，服务器支持CONDSTORE时才有
+    update_time = Column(DateTime, nullable=True)  # 最近一次更新时间
+
+    def __repr__(self):
+        return (f"<SyncState(state_id={self.state_id}, task_id={self.task_id}, account='{self.account}', "
+                f"folder='{self.folder}', drive='{self.drive}', uid_validity={self.uid_validity}, "
+                f"last_uid={self.last_uid}, criteria='{self.criteria}', uid_next={self.uid_next})>")
+
+
 # class Attachment(BaseIndex):
 #     __tablename__ = 'attachments'
 #
@@ -153,6 +178,50 @@ class EmailInfo(BaseIndex):
                 f"received_date={self.received_date}, task_name={self.task_name}，eml_path='{self.eml_path}')>")
 
 
+class EmailFolder(BaseIndex):
+    __tablename__ = 'email_folders'
+
+    # 字段定义
+    folder_id = Column(Integer, primary_key=True, autoincrement=True)  # 记录标识符，自增主键
+    email_id = Column(Integer, ForeignKey('email_info.email_id'), nullable=False)  # 所属邮件标识符，外键
+    mailbox = Column(String, nullable=False)  # 邮件所在的邮箱文件夹（IMAP文件夹名），同一封邮件可在多个文件夹中
+
+    def __repr__(self):
+        return f"<EmailFolder(folder_id={self.folder_id}, email_id={self.email_id}, mailbox='{self.mailbox}')>"
+
+
+class Address(BaseIndex):
+    __tablename__ = 'addresses'
+    __table_args__ = (UniqueConstraint('addr_spec', 'display_name', name='uq_addresses_addr_spec_display_name'),)
+
+    # 字段定义
+    address_id = Column(Integer, primary_key=True, autoincrement=True)  # 联系人地址标识符，自增主键
+    addr_spec = Column(String, nullable=False)  # 小写的邮箱地址，如zhangsan@example.com，唯一约束兼作查找索引
+    display_name = Column(String, nullable=False, default='')  # 显示名，同一地址的不同显示名分别记录
+
+    def __repr__(self):
+        return (f"<Address(address_id={self.address_id}, addr_spec='{self.addr_spec}', "
+                f"display_name='{self.display_name}')>")
+
+
+class EmailAddress(BaseIndex):
+    __tablename__ = 'email_addresses'
+    __table_args__ = (
+        Index('ix_email_addresses_address_role_email', 'address_id', 'role', 'email_id'),  # 按联系人和角色查邮件
+        Index('ix_email_addresses_email', 'email_id'),
+    )
+
+    # 字段定义
+    email_address_id = Column(Integer, primary_key=True, autoincrement=True)  # 记录标识符，自增主键
+    email_id = Column(Integer, ForeignKey('email_info.email_id'), nullable=False)  # 所属邮件标识符，外键
+    address_id = Column(Integer, ForeignKey('addresses.address_id'), nullable=False)  # 联系人地址标识符，外键
+    role = Column(String, nullable=False)  # 地址在邮件中的角色：from、to、cc或bcc
+
+    def __repr__(self):
+        return (f"<EmailAddress(email_address_id={self.email_address_id}, email_id={self.email_id}, "
+                f"address_id={self.address_id}, role='{self.role}')>")
+
+
 
 
 # def test():
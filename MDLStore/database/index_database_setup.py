@@ -59,6 +59,9 @@ from sqlalchemy.orm import sessionmaker, declarative_base
 # 创建declarative base 基类实例
 BaseIndex = declarative_base()
 
+# data.db的结构版本，记录在PRAGMA user_version中。1：新增联系人地址表addresses和email_addresses
+INDEX_SCHEMA_VERSION = 1
+
 
 # class DatabaseManager:
 #     def __init__(self, drive):
@@ -109,9 +112,28 @@ class DatabaseManager:
 
         db_path = os.path.join(index_path, 'data.db')
         connection_string = f"sqlite:///{db_path}"
-        self.engine = create_engine(connection_string, echo=False)
+        # 多个备份任务可能并发写入同一个data.db，加长锁等待时间
+        self.engine = create_engine(connection_string, echo=False, connect_args={'timeout': 30})
         self.session_factory = sessionmaker(bind=self.engine)
         BaseIndex.metadata.create_all(self.engine)
+        self.migrate()
+
+    def migrate(self):
+        """把已有的data.db升级到INDEX_SCHEMA_VERSION：为升级前备份的邮件补建联系人地址索引"""
+        with self.engine.connect() as connection:
+            version = connection.exec_driver_sql('PRAGMA user_version').scalar()
+        if version >= INDEX_SCHEMA_VERSION:
+            return
+        from MDLStore.database.service import EmailAddressManager  # service依赖entities，entities依赖本模块
+        session = self.session_factory()
+        try:
+            count = EmailAddressManager(session).backfill()
+        finally:
+            session.close()
+        if count:
+            print(f'已为{count}封邮件建立联系人地址索引')
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql(f'PRAGMA user_version = {INDEX_SCHEMA_VERSION}')
 
     def get_session(self):
         """获取新的Session实例，并管理其生命周期"""
@@ -1,6 +1,18 @@
-from sqlalchemy import and_, func
+import re
+from datetime import datetime
+from email.utils import getaddresses
+from functools import lru_cache
 
-from MDLStore.database.entities import EmailAccount, BackupTask, BackupHistory, EmailInfo, Attachment
+from sqlalchemy import and_, func, insert, or_, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from MDLStore.database.entities import EmailAccount, BackupTask, BackupHistory, EmailInfo, Attachment, SyncState, \
+    EmailFolder, Address, EmailAddress
+
+# EmailInfo中的地址字段及其在email_addresses表中的角色
+ADDRESS_ROLES = {'from_address': 'from', 'to_addresses': 'to', 'cc_addresses': 'cc', 'bcc_addresses': 'bcc'}
+ADDR_SPEC_RE = re.compile(r'[^@\s<>",;]+@[^@\s<>",;]+')  # 完整的邮箱地址，按地址精确查找
+ADDRESS_CACHE_SIZE = 100000  # 入库时缓存的联系人地址数，超过后清空重新缓存
 
 
 class EmailAccountManager:
@@ -149,6 +161,7 @@ class BackupTaskManager:
         """删除备份任务"""
         task = self.session.query(BackupTask).filter(BackupTask.task_id == task_id).one_or_none()
         if task:
+            self.session.query(SyncState).filter(SyncState.task_id == task_id).delete()
             self.session.delete(task)
             self.session.commit()
             return True
@@ -244,9 +257,53 @@ class BackupHistoryManager:
         return result
 
 
+class SyncStateManager:
+    def __init__(self, session):
+        self.session = session
+
+    def get_sync_state(self, task_id, account, folder, drive):
+        """根据备份任务、邮箱账户、文件夹和目标磁盘获取同步状态，不存在则返回None"""
+        return self.session.query(SyncState).filter(
+            and_(
+                SyncState.task_id == task_id,
+                SyncState.account == account,
+                SyncState.folder == folder,
+                SyncState.drive == drive
+            )
+        ).one_or_none()
+
+    def update_sync_state(self, task_id, account, folder, drive, uid_validity, last_uid, criteria, messages=None,
+                          uid_next=None, highest_modseq=None):
+        """
+        记录文件夹的同步状态，已存在则更新
+        :param messages: 备份前STATUS的MESSAGES，与uid_next、highest_modseq一起用于跳过未变化的文件夹
+        :return: 更新后的SyncState对象
+        """
+        state = self.get_sync_state(task_id, account, folder, drive)
+        if state is None:
+            state = SyncState(task_id=task_id, account=account, folder=folder, drive=drive)
+            self.session.add(state)
+        state.uid_validity = uid_validity
+        state.last_uid = last_uid
+        state.criteria = criteria
+        state.messages = messages
+        state.uid_next = uid_next
+        state.highest_modseq = highest_modseq
+        state.update_time = datetime.now()
+        self.session.commit()
+        return state
+
+    def delete_sync_states(self, task_id):
+        """删除备份任务的全部同步状态，下次执行时全量同步"""
+        count = self.session.query(SyncState).filter(SyncState.task_id == task_id).delete()
+        self.session.commit()
+        return count
+
+
 class EmailInfoManager:
     def __init__(self, session):
         self.session = session
+        self.address_manager = EmailAddressManager(session)
 
     def add_email_info(self, email_info):
         """添加一个新的邮件信息，参数是一个EmailInfo对象"""
@@ -290,9 +347,16 @@ class EmailInfoManager:
                     self.session.commit()
                 return existing_email_info
             else:
-                # 如果邮件数据不存在，添加新邮件
-                self.session.add(email_info)
-                self.session.commit()
+                # 如果邮件数据不存在，添加新邮件，同时建立联系人地址索引
+                try:
+                    self.session.add(email_info)
+                    self.session.flush()
+                    self.address_manager.index_email_addresses(email_info, replace=False)
+                    self.session.commit()
+                except Exception:
+                    # 事务回滚后，本次新添加并已缓存的联系人地址不再存在
+                    self.address_manager.address_cache.clear()
+                    raise
                 return email_info
 
         return None
@@ -317,6 +381,7 @@ class EmailInfoManager:
                 email_info.received_date = updated_email_info.received_date
                 email_info.task_name = updated_email_info.task_name
                 email_info.eml_path = updated_email_info.eml_path
+                self.address_manager.index_email_addresses(email_info)
                 self.session.commit()
                 return email_info
         return None
@@ -325,6 +390,9 @@ class EmailInfoManager:
         """删除邮件信息"""
         email_info = self.session.query(EmailInfo).filter(EmailInfo.email_id == email_id).one_or_none()
         if email_info:
+            # 外键不由SQLite强制，同时删除该邮件的联系人地址索引和所在文件夹记录
+            self.session.query(EmailAddress).filter(EmailAddress.email_id == email_id).delete()
+            self.session.query(EmailFolder).filter(EmailFolder.email_id == email_id).delete()
             self.session.delete(email_info)
             self.session.commit()
             return True
@@ -347,6 +415,156 @@ class EmailInfoManager:
                     ).first()
         return result is not None
 
+    def get_email_infos_by_message_id(self, message_id, task_name, email_address):
+        """根据Message-ID查找备份任务中的邮件，同一封邮件保存在多个文件夹时返回多条"""
+        return self.session.query(EmailInfo).filter(
+            and_(EmailInfo.email_uid == message_id,
+                 EmailInfo.task_name == task_name,
+                 EmailInfo.email_address == email_address)
+        ).all()
+
+
+class EmailFolderManager:
+    def __init__(self, session):
+        self.session = session
+
+    def add_unique_email_folder(self, email_id, mailbox):
+        """
+        记录邮件所在的文件夹，已存在则不重复添加
+        :return: EmailFolder对象
+        """
+        email_folder = self.session.query(EmailFolder).filter(
+            and_(EmailFolder.email_id == email_id, EmailFolder.mailbox == mailbox)
+        ).first()
+        if email_folder is None:
+            email_folder = EmailFolder(email_id=email_id, mailbox=mailbox)
+            self.session.add(email_folder)
+            self.session.commit()
+        return email_folder
+
+    def get_folders_by_email_id(self, email_id):
+        """获取邮件所在的全部文件夹名"""
+        return [item.mailbox for item in
+                self.session.query(EmailFolder).filter(EmailFolder.email_id == email_id).all()]
+
+
+@lru_cache(maxsize=8192)
+def parse_addresses(header_value):
+    """
+    解析From、To等地址头部。同一联系人的头部字符串大量重复，缓存解析结果
+    :param header_value: 头部字符串，如'张三 <ZhangSan@example.com>, lisi@example.com'
+    :return: (小写的邮箱地址, 显示名)元组，去掉重复项和没有邮箱地址的项
+    """
+    if not header_value:
+        return ()
+    addresses = []
+    for display_name, addr_spec in getaddresses([header_value]):
+        address = (addr_spec.strip().lower(), display_name.strip())
+        if address[0] and address not in addresses:
+            addresses.append(address)
+    return tuple(addresses)
+
+
+class EmailAddressManager:
+    def __init__(self, session):
+        self.session = session
+        # 入库时的{(addr_spec, display_name): address_id}缓存，同一联系人出现在大量邮件中，不必每封邮件都查询
+        self.address_cache = {}
+
+    def get_or_add_address(self, addr_spec, display_name, cache=None):
+        """
+        获取联系人地址的address_id，不存在则添加。并发的备份任务添加同一地址时由唯一约束去重
+        :param cache: 可选的{(addr_spec, display_name): address_id}字典，批量处理时减少查询
+        """
+        key = (addr_spec, display_name)
+        if cache is not None and key in cache:
+            return cache[key]
+        query = self.session.query(Address.address_id).filter(
+            and_(Address.addr_spec == addr_spec, Address.display_name == display_name))
+        address_id = query.scalar()
+        if address_id is None:
+            self.session.execute(sqlite_insert(Address).values(addr_spec=addr_spec, display_name=display_name)
+                                 .on_conflict_do_nothing())
+            address_id = query.scalar()
+        if cache is not None:
+            cache[key] = address_id
+        return address_id
+
+    def address_rows(self, email_info, cache=None):
+        """
+        解析邮件的发件人、收件人、抄送和密送，返回email_addresses表的记录，缺少的联系人地址直接添加
+        :param email_info: 已有email_id的EmailInfo，或带有email_id和各地址字段的查询结果行
+        """
+        rows = []
+        for field, role in ADDRESS_ROLES.items():
+            for addr_spec, display_name in parse_addresses(getattr(email_info, field)):
+                rows.append({'email_id': email_info.email_id, 'role': role,
+                             'address_id': self.get_or_add_address(addr_spec, display_name, cache)})
+        return rows
+
+    def index_email_addresses(self, email_info, replace=True):
+        """
+        建立一封邮件的联系人地址索引，不提交。联系人地址的address_id缓存在address_cache中，
+        调用方回滚事务时需要清空address_cache
+        :param replace: 是否先删除该邮件已有的地址索引
+        """
+        if replace:
+            self.session.query(EmailAddress).filter(EmailAddress.email_id == email_info.email_id).delete()
+        if len(self.address_cache) > ADDRESS_CACHE_SIZE:
+            self.address_cache.clear()
+        rows = self.address_rows(email_info, self.address_cache)
+        if rows:
+            self.session.execute(insert(EmailAddress), rows)
+
+    def backfill(self, batch_size=1000):
+        """
+        为还没有地址索引的邮件（地址索引加入前备份的邮件）建立索引，每批提交一次
+        :return: 处理的邮件数
+        """
+        indexed = select(EmailAddress.email_id).where(EmailAddress.email_id == EmailInfo.email_id).exists()
+        cache = {}
+        count = 0
+        last_id = 0
+        while True:
+            rows = self.session.query(EmailInfo.email_id, *(getattr(EmailInfo, field) for field in ADDRESS_ROLES)) \
+                .filter(and_(EmailInfo.email_id > last_id, ~indexed)) \
+                .order_by(EmailInfo.email_id).limit(batch_size).all()
+            if not rows:
+                return count
+            address_rows = [item for row in rows for item in self.address_rows(row, cache)]
+            if address_rows:
+                self.session.execute(insert(EmailAddress), address_rows)
+            self.session.commit()
+            count += len(rows)
+            last_id = rows[-1].email_id
+
+    @staticmethod
+    def email_ids_by_address(field, value):
+        """
+        按联系人查找邮件的子查询。value是完整的邮箱地址时按地址精确查找，使用索引；是'张三 <zs@example.com>'
+        形式时按其中的地址精确查找，再对显示名做部分匹配；'<'后不是完整地址时在邮件的原始地址头部中部分匹配；
+        其余在联系人地址表中对邮箱地址和显示名做不区分大小写的部分匹配，地址表只有不同联系人的数量，远小于邮件表
+        :param field: EmailInfo中的地址字段，见ADDRESS_ROLES
+        :param value: 邮箱地址、显示名、"显示名 <邮箱地址>"或其中一部分
+        :return: 返回email_id的select
+        """
+        value = value.strip()
+        parsed = parse_addresses(value) if '<' in value and value.endswith('>') else ()
+        if ADDR_SPEC_RE.fullmatch(value):
+            address_condition = Address.addr_spec == value.lower()
+        elif len(parsed) == 1 and ADDR_SPEC_RE.fullmatch(parsed[0][0]):
+            addr_spec, display_name = parsed[0]
+            address_condition = Address.addr_spec == addr_spec
+            if display_name:
+                address_condition = and_(address_condition, Address.display_name.ilike(f'%{display_name}%'))
+        elif '<' in value:
+            return select(EmailInfo.email_id).where(getattr(EmailInfo, field).ilike(f'%{value}%'))
+        else:
+            address_condition = or_(Address.addr_spec.ilike(f'%{value}%'), Address.display_name.ilike(f'%{value}%'))
+        return select(EmailAddress.email_id) \
+            .join(Address, Address.address_id == EmailAddress.address_id) \
+            .where(and_(EmailAddress.role == ADDRESS_ROLES[field], address_condition))
+
 
 class AttachmentManager:
     def __init__(self, session):
@@ -1,25 +1,32 @@
 import configparser
-import email
 import json
+import multiprocessing
 import os
 import pickle
 import shutil
 import sys
 import tempfile
-import time
+import threading
 import traceback
-import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from typing import List
 
+from MDLStore.asyncimap import AsyncIMAPEngine, backup_account
+from MDLStore.bodystructure import PartSelector
 from MDLStore.cloudfile import CloudAttachmentDownloader
-from MDLStore.database.config_database_setup import SessionManager
+from MDLStore.database.config_database_setup import Session
 from MDLStore.database.entities import EmailInfo, Attachment, BackupTask
 from MDLStore.database.index_database_setup import DatabaseManager
-from MDLStore.database.service import EmailAccountManager, EmailInfoManager, AttachmentManager, BackupTaskManager
+from MDLStore.database.service import EmailAccountManager, EmailInfoManager, AttachmentManager, SyncStateManager, \
+    EmailFolderManager
 from MDLStore.indexes import FileInfo, IndexManager
-from MDLStore.mailclients import IMAPClientFactory
+from MDLStore.mailclients import FolderSyncMark, IMAPConnectionPool, MessageDeduper
+from MDLStore.planner import IndexRatio, plan_backup_task, directory_size, index_directory
 from MDLStore.storage import FileWriter, StorageManager, PathDirUtil
-from MDLStore.utils import ServerUtils, EmailUtils, EmailParser, CommonUtils
+from MDLStore.utils import ServerUtils, EmailUtils, EmailParser, EmailHeaderScanner, RateLimiter, ParsedMessage, \
+    ParsedMessageCache, RawMessage, parse_message_file
 
 # module_path = os.path.dirname(os.path.abspath(__file__))
 
@@ -32,14 +39,86 @@ else:
 
 
 temp_dir = os.path.join(module_path, 'tempdata')
+# 邮件解析记录的磁盘缓存，重新运行备份任务时跳过解析
+parse_cache_dir = os.path.join(module_path, 'parsecache')
 
 if not os.path.exists(temp_dir):
     os.makedirs(temp_dir)
 
 ini_path = os.path.join(module_path, 'configs', 'history.ini')
 
+# 多账户并发备份的默认参数
+MAX_CONCURRENT_TASKS = 3  # 同时执行备份的邮箱账户数
+BANDWIDTH_LIMIT = 0  # 全部任务共享的下载带宽上限，字节/秒，0表示不限速
+DISK_WRITE_LIMIT = 0  # 全部任务共享的目标磁盘写入速度上限，字节/秒，0表示不限速
+DIRECT_STORE_RESERVE = 1024 * 1024  # 直写模式要求目标磁盘至少保留的空间，单位KB，不满足时经临时数据区中转
+# 获取邮件全文使用的IMAP实现：'thread'为imaplib连接池，每个连接一个线程；'asyncio'为asyncimap，
+# 全部账户的连接在同一个事件循环上，命令流水线发送。只下载部分MIME的任务始终使用'thread'
+IMAP_ENGINE = 'thread'
+# 解析邮件、去除HTML标签和识别云附件的进程数，这些都是纯CPU计算，多线程受GIL限制只能用一个核
+PARSE_WORKERS = max(1, (os.cpu_count() or 1) - 1)
+PARSE_POOL_MIN_MESSAGES = 32  # 邮件数少于此值时在当前进程解析，不值得启动进程池
 
-def backupEmailToTmpArea(backup_task, email_account, progress_callback, info_callback):
+# 全部备份任务共用的解析进程池，由parse_executor创建
+_parse_executor = None
+_parse_executor_lock = threading.Lock()
+
+
+class ProgressAggregator:
+    """
+    合并多个并行子任务的进度。每个子任务通过channel()得到一个带emit方法的进度通道，
+    总进度取各通道进度的平均值，通过原有的progress_callback发出
+    """
+
+    def __init__(self, progress_callback, channel_count):
+        self.progress_callback = progress_callback
+        self.progress = [0] * max(1, channel_count)
+        self.last_emitted = -1
+        self.lock = threading.Lock()
+
+    def channel(self, index):
+        return ProgressChannel(self, index)
+
+    def update(self, index, value):
+        with self.lock:
+            self.progress[index] = value
+            total = int(sum(self.progress) / len(self.progress))
+            if total == self.last_emitted:
+                return
+            self.last_emitted = total
+        if self.progress_callback:
+            self.progress_callback.emit(total)
+
+
+class ProgressChannel:
+    """ProgressAggregator中的单个进度通道，接口与pyqtSignal的emit一致"""
+
+    def __init__(self, aggregator, index):
+        self.aggregator = aggregator
+        self.index = index
+
+    def emit(self, value):
+        self.aggregator.update(self.index, value)
+
+
+class PrefixedInfoChannel:
+    """为信息文本加上前缀后转发，用于区分并行子任务的输出"""
+
+    def __init__(self, info_callback, prefix):
+        self.info_callback = info_callback
+        self.prefix = prefix
+
+    def emit(self, text):
+        self.info_callback.emit(f'{self.prefix}{text}')
+
+
+def backupEmailToTmpArea(backup_task, email_account, progress_callback, info_callback, sync_marks=None,
+                         rate_limiter=None, message_sink=None, deduper=None):
+    """
+    获取备份任务各文件夹内符合条件的邮件。默认保存到临时数据区，传入message_sink时每封邮件直接交给message_sink处理
+    :param deduper: MessageDeduper，同一封邮件出现在多个文件夹时只获取一次
+    :return: 获取完成返回True，连接失败返回None
+    """
     # for i in range(100):
     #     time.sleep(0.1)
     #     progress_callback.emit(i+1)
@@ -53,25 +132,101 @@ def backupEmailToTmpArea(backup_task, email_account, progress_callback, info_cal
     start_date = backup_task.start_date  # 邮件收件日期区间的开始
     end_date = backup_task.end_date  # 邮件收件日期区间的末尾
     # task_name = backup_task.task_name  # 备份任务名称
-    criteria = EmailUtils.buildCriteria2(start_date, end_date)
+    # 发件人和主题关键字也交给服务器搜索，只下载匹配的邮件
+    criteria = EmailUtils.buildSearchQuery(start_date, end_date, backup_task.sender, backup_task.subject_keywords)
 
-    # 连接邮件服务器
+    part_selector = build_part_selector(backup_task)
+    folders = [folder.replace('"', '') for folder in folder_list]
+    aggregator = ProgressAggregator(progress_callback, len(folders))
     client_type = ServerUtils.get_client_type(email_account.username)
-    client = IMAPClientFactory.get_client(client_type, email_account.server_address, email_account.port,
-                                          email_account.username, email_account.password, email_account.ssl_encryption)
-    connection = client.connect()
-    if connection:
-        client.login()
-        for folder in folder_list:
-            folder = folder.replace('"', '')
-            client.saveEmails(folder, criteria, progress_callback, info_callback)
-
-    else:
-        print(f'任务失败')
+
+    if IMAP_ENGINE == 'asyncio' and part_selector is None:
+        jobs = [(folder, sync_marks.get(folder) if sync_marks is not None else None,
+                 aggregator.channel(index) if progress_callback else None,
+                 PrefixedInfoChannel(info_callback, f'{folder}：') if info_callback else None)
+                for index, folder in enumerate(folders)]
+        return AsyncIMAPEngine.instance().run(backup_account(client_type, email_account, criteria, jobs,
+                                                             message_sink, rate_limiter, deduper))
+
+    # 连接邮件服务器，同一账户的多个文件夹通过连接池并行获取
+    pool = IMAPConnectionPool(client_type, email_account.server_address, email_account.port,
+                              email_account.username, email_account.password, email_account.ssl_encryption,
+                              rate_limiter=rate_limiter)
+    try:
+        pool.release(pool.acquire())
+    except Exception as e:
+        print(f'任务失败{e}')
+        pool.close_all()
         return None
+
+    def fetch_folder(index, folder):
+        sync_mark = sync_marks.get(folder) if sync_marks is not None else None
+        if sync_mark is None:
+            # 不做增量同步时也用空标记记录检查点，连接断开重连后从检查点继续
+            sync_mark = FolderSyncMark(folder)
+        folder_progress = aggregator.channel(index) if progress_callback else None
+        folder_info = PrefixedInfoChannel(info_callback, f'{folder}：') if info_callback else None
+        pool.run(lambda client: client.saveEmails(folder, criteria, folder_progress, folder_info, sync_mark,
+                                                  message_sink, part_selector, deduper),
+                 progress=lambda: sync_mark.last_uid, description=f'文件夹{folder}')
+        aggregator.update(index, 100)
+
+    try:
+        with ThreadPoolExecutor(max_workers=min(pool.max_connections, max(1, len(folders)))) as executor:
+            futures = [executor.submit(fetch_folder, index, folder) for index, folder in enumerate(folders)]
+            for future in futures:
+                future.result()
+    finally:
+        pool.close_all()
     return True
 
 
+def build_part_selector(backup_task):
+    """
+    不备份邮件全文的任务只需要附件和正文，按BODYSTRUCTURE选择性下载
+    :return: PartSelector，需要邮件全文时为None
+    """
+    content_type = backup_task.content_type
+    if 'RFC2822' in content_type:
+        return None
+    return PartSelector(backup_task.filename_keywords, 'Attachment' in content_type, 'CloudAttach' in content_type)
+
+
+def load_sync_marks(session, backup_task, email_account, drive):
+    """
+    读取备份任务各文件夹的增量同步标记。搜索条件变化后的文件夹返回空标记，即全量同步
+    :return: 字典{文件夹名: FolderSyncMark}
+    """
+    manager = SyncStateManager(session)
+    criteria = EmailUtils.buildCriteria2(backup_task.start_date, backup_task.end_date, backup_task.sender,
+                                         backup_task.subject_keywords)
+    sync_marks = {}
+    for folder in pickle.loads(backup_task.folder_list):
+        folder = folder.replace('"', '')
+        state = manager.get_sync_state(backup_task.task_id, email_account.username, folder, drive)
+        if state is not None and state.criteria == criteria:
+            sync_marks[folder] = FolderSyncMark(folder, state.uid_validity, state.last_uid, state.messages,
+                                                state.uid_next, state.highest_modseq)
+        else:
+            sync_marks[folder] = FolderSyncMark(folder)
+    return sync_marks
+
+
+def save_sync_marks(session, backup_task, email_account, drive, sync_marks):
+    """
+    备份数据写入目标位置后，保存各文件夹的增量同步标记
+    """
+    manager = SyncStateManager(session)
+    criteria = EmailUtils.buildCriteria2(backup_task.start_date, backup_task.end_date, backup_task.sender,
+                                         backup_task.subject_keywords)
+    for folder, sync_mark in sync_marks.items():
+        if sync_mark.uid_validity is None:
+            continue
+        manager.update_sync_state(backup_task.task_id, email_account.username, folder, drive,
+                                  sync_mark.uid_validity, sync_mark.last_uid, criteria, sync_mark.messages,
+                                  sync_mark.uid_next, sync_mark.highest_modseq)
+
+
 # def extractEmailData(drive, backup_task, email_account, progress_callback, info_callback, drive_change=False):
 #     """
 #     解析备份任务，将对应邮件账户所属的邮件，按照备份任务的具体要求，保存在磁盘分区drive下的MDLStore文件夹内。数据源位于temp_dir
@@ -158,304 +313,225 @@ def backupEmailToTmpArea(backup_task, email_account, progress_callback, info_cal
 #                     #                 pass
 
 
-def extractEmailData(drive, backup_task, email_account, drive_change, progress_callback, info_callback):
+def parse_executor():
     """
-    解析备份任务，将对应邮件账户所属的邮件，按照备份任务的具体要求，保存在磁盘分区drive下的MDLStore文件夹内。数据源位于temp_dir
-    文件夹内，其中有若干个以邮箱地址为文件名的文件夹，属于email_account账户的邮件，就保存在该文件夹下，该文件夹下又是按照收件箱、已发送
-    等文件夹来保存邮件eml文件。需要按照backup_task的指示，将符合条件的邮件数据保存到目标位置。在目标位置的任务名
-    文件夹内有三个文件夹，分别是RFC2822、Attachment和CloudAttach，分别保存eml邮件文件和附件文件。注意在RFC2822文件夹内部，
-    邮件依然按照跟temp_dir文件夹中各个邮箱相同的文件夹嵌套结构来保存邮件。
+    全部备份任务共用的解析进程池，第一次使用时创建，进程数为PARSE_WORKERS，多个账户同时备份时也不超过。
+    子进程以spawn方式启动，不继承备份线程所在进程的数据库会话、IMAP连接和锁
     """
-    print(f'开始提取{backup_task}')
-    # 创建临时文件
-    global root
-    rfc2822_temp_file = tempfile.NamedTemporaryFile(delete=False, mode='w+')
-    attachment_temp_file = tempfile.NamedTemporaryFile(delete=False, mode='w+')
-    cloud_attach_temp_file = tempfile.NamedTemporaryFile(delete=False, mode='w+')
+    global _parse_executor
+    with _parse_executor_lock:
+        if _parse_executor is None:
+            _parse_executor = ProcessPoolExecutor(max_workers=PARSE_WORKERS,
+                                                  mp_context=multiprocessing.get_context('spawn'))
+        return _parse_executor
 
-    # 初始化临时文件中的列表
-    rfc2822_list = []
-    attachment_list = []
-    cloud_attach_list = []
 
-    # 源数据位置
-    source_dir = os.path.join(temp_dir, email_account.username)
+def shutdown_parse_executor():
+    """关闭共用的解析进程池，程序退出时调用"""
+    global _parse_executor
+    with _parse_executor_lock:
+        executor, _parse_executor = _parse_executor, None
+    if executor is not None:
+        executor.shutdown(cancel_futures=True)
 
-    # 遍历temp_dir中的所有文件和文件夹
-    for root, dirs, files in os.walk(source_dir):
-        for filename in files:
-            if filename.endswith('.eml'):
-                file_path = os.path.join(root, filename)
-                print(f'解析邮件{filename}:180')
-                with open(file_path, 'rb') as file:
-                    raw_email = file.read()
-
-                # 使用EmailParser解析邮件
-                email_parser = EmailParser(raw_email)
-                headers = email_parser.get_headers()
-                email_date = email_parser.getDate(headers)
-                subject = email_parser.getSubject(headers)
-                From = email_parser.getFrom(headers)
-                To = email_parser.getTo(headers)
-                emlFileName = email_parser.getEmailFileName(headers)
-                fileSize = email_parser.getSize()
-                message_id = email_parser.getEmailMessageUID(headers)
-
-                # 检查日期范围
-                if email_date and backup_task.start_date <= email_date <= backup_task.end_date:
-                    # 检查发件人
-                    if backup_task.sender and backup_task.sender not in email_parser.getFrom(headers):
-                        continue
-
-                    # 检查主题关键字
-                    if (backup_task.subject_keywords and backup_task.subject_keywords not in
-                            email_parser.getSubject(headers)):
-                        continue
-
-                    # 根据备份类型处理邮件
-                    if 'RFC2822' in backup_task.content_type:
-                        rfc2822_list.append({'file_path': file_path, 'size': fileSize, 'filename': emlFileName})
-                    if 'Attachment' in backup_task.content_type:
-                        keyword = backup_task.filename_keywords
-                        print(f'主题{subject}')
-                        attachments = email_parser.get_attachments_by_keyword(keyword)
-                        print(f'{filename}的全部附件:{attachments}')
-                        for attachment in attachments:
-                            attachment_list.append({'file_path': file_path, 'filename': attachment['filename'],
-                                                    'size': attachment['file_size']})
-                    if 'CloudAttach' in backup_task.content_type:
-                        body_parts = email_parser.get_body()
-                        len_body = len(body_parts)
-                        if len_body >= 3:
-                            html_index = int(len_body / 2) - 1
-                        else:
-                            html_index = len_body - 1
-                        # print(f'{body_parts[html_index]}')
-
-                        cloud_attachments = email_parser.get_cloud_attachments(body_parts[html_index],
-                                                                               backup_task.filename_keywords)
-                        if cloud_attachments:
-                            for attach in cloud_attachments:
-                                cloud_attach_list.append({'file_path': file_path, 'filename': attach['filename'],
-                                                          'file_size': attach['file_size'],
-                                                          'expire_time': attach['expire_time'],
-                                                          'expired': attach['expired'],
-                                                          'outside_link': attach['outside_link']})
-
-    # 写入临时文件
-    rfc2822_temp_file.write(json.dumps(rfc2822_list))
-    attachment_temp_file.write(json.dumps(attachment_list))
-    cloud_attach_temp_file.write(json.dumps(cloud_attach_list))
-
-    # 关闭临时文件
-    rfc2822_temp_file.close()
-    attachment_temp_file.close()
-    cloud_attach_temp_file.close()
-
-    # 记录临时文件路径和数据大小
-    # temp_files_info = {
-    #     'RFC2822': {'path': rfc2822_temp_file.name, 'size': os.path.getsize(rfc2822_temp_file.name)},
-    #     'Attachment': {'path': attachment_temp_file.name, 'size': os.path.getsize(attachment_temp_file.name)},
-    #     'CloudAttach': {'path': cloud_attach_temp_file.name, 'size': os.path.getsize(cloud_attach_temp_file.name)}
-    # }
-    #
-    # # 输出临时文件信息
-    # print(temp_files_info)
-    # return temp_files_info
-    # 读取并打印每个临时文件的内容
-    rfc2822_list = read_and_print_temp_file(rfc2822_temp_file.name)
-    attachment_list = read_and_print_temp_file(attachment_temp_file.name)
-    cloud_attach_list = read_and_print_temp_file(cloud_attach_temp_file.name)
-
-    # 估算总附件数目和全文索引容量
-    attachments_nums_estimated = len(cloud_attach_list)
-    index_capacity = attachments_nums_estimated * 1014
-
-    # 计算总备份数据量大小（单位KB）
-    total_size = (sum(item['size'] for item in rfc2822_list) +
-                  sum(item['size'] for item in attachment_list) +
-                  sum(item['file_size'] for item in cloud_attach_list))
-    # 加估算索引数据量的总容量
-    total_size = total_size + index_capacity
 
-    # 创建存储管理器
-    storage_manager = StorageManager()
-    # 寻找可用磁盘单位KB
-    available_disk = storage_manager.get_available_disk(drive, total_size, drive_change)
-    if available_disk is None:
-        print(f'存储总量{total_size}请更换目标磁盘')
+def parse_messages(file_paths):
+    """
+    在共用的进程池中并行解析邮件文件，解析结果写入磁盘缓存。按file_paths的顺序逐个返回，调用方在当前进程中
+    依次写数据库和报告进度。每次调用最多有PARSE_WORKERS * 4封邮件的结果等待取走，不会把全部解析结果留在内存中
+    :return: 生成(file_path, ParsedMessage)
+    """
+    if PARSE_WORKERS <= 1 or len(file_paths) < PARSE_POOL_MIN_MESSAGES:
+        for file_path in file_paths:
+            yield file_path, parse_message_file(file_path, parse_cache_dir)
         return
+    executor = parse_executor()
+    pending = deque()
+    try:
+        for file_path in file_paths:
+            pending.append((file_path, executor.submit(parse_message_file, file_path, parse_cache_dir)))
+            if len(pending) >= PARSE_WORKERS * 4:
+                file_path_, future = pending.popleft()
+                yield file_path_, future.result()
+        while pending:
+            file_path_, future = pending.popleft()
+            yield file_path_, future.result()
+    except BrokenProcessPool:
+        # 子进程异常退出后进程池不能再使用，下次调用时重新创建
+        global _parse_executor
+        with _parse_executor_lock:
+            if _parse_executor is executor:
+                _parse_executor = None
+        raise
+    finally:
+        for file_path_, future in pending:
+            future.cancel()
+
+
+def match_backup_task(backup_task, email_parser, headers):
+    """
+    检查邮件是否满足备份任务的日期区间、发件人和主题关键字条件
+    :return: 满足返回True
+    """
+    email_date = email_parser.getDate(headers)
+    # 检查日期范围
+    if not (email_date and backup_task.start_date <= email_date <= backup_task.end_date):
+        return False
+    # 检查发件人
+    if backup_task.sender and backup_task.sender not in email_parser.getFrom(headers):
+        return False
+    # 检查主题关键字
+    if backup_task.subject_keywords and backup_task.subject_keywords not in email_parser.getSubject(headers):
+        return False
+    return True
 
-    # 创建数据库索引管理器
-    db_manager = DatabaseManager(available_disk)
-    session = db_manager.get_session()
-    email_info_manager = EmailInfoManager(session)
-    attach_info_manager = AttachmentManager(session)
-    # 创建全文索引管理器
-    fulltext_manager = IndexManager(available_disk)
-
-    # 迁移数据到目标位置
-    write = FileWriter()
-    convert = PathDirUtil()
-
-    total_count_rfc = len(rfc2822_list)
-    # 迁移EML文件
-    for i, item in enumerate(rfc2822_list):
-        if progress_callback and info_callback:
-            progress_callback.emit(int(((i + 1) / total_count_rfc) * 100))
-            info_callback.emit(f'备份邮件全文：已完成：{i + 1}封/{total_count_rfc}封')
 
-        file_path = item['file_path']
-        file_size = item['size']
-        filename = item['filename']
+class MessageStore:
+    """
+    把单封邮件的数据按备份任务写入目标磁盘的MDLStore文件夹，并添加数据库索引和全文索引。
+    临时数据区模式的extractEmailData和直写模式的DirectStorePipeline共用
+    """
 
-        # sub_folder = os.path.relpath(root, start=temp_dir)  # 获取文件相对于temp_dir的子目录路径
-        relative_path = os.path.relpath(file_path, start=temp_dir)
-        # 提取所需的子目录部分
-        sub_folder = os.path.join(os.path.splitdrive(relative_path)[1].split(os.sep)[0],
-                                  relative_path.split(os.sep)[1])
-
-        # target_folder = os.path.join('MDLStore', backup_task.task_name, 'RFC2822', sub_folder)  # 构建目标文件夹路径
-        target_folder = os.path.join('MDLStore', backup_task.task_name, email_account.username, 'RFC2822', sub_folder)  # 构建目标文件夹路径
-        # print(f'{file_path}{sub_folder}')
-        result_path = write.copy_file(file_path, filename, available_disk, target_folder, drive_change)
-
-        # 使用缓存为每封邮件添加数据库索引
-        with open(file_path, 'rb') as file:
-            raw_email = file.read()
-        email_parser = EmailParser(raw_email)
-        headers = email_parser.get_headers()
-        email_uid = email_parser.getEmailMessageUID(headers)
-        subject = email_parser.getSubject(headers)
-        from_address = email_parser.getFrom(headers)
-        to_addresses = email_parser.getTo(headers)
-        cc_addresses = email_parser.getCc(headers)
-        bcc_addresses = email_parser.getBcc(headers)
-        date_time = email_parser.getDate(headers)
-        task_name = backup_task.task_name
-        mailbox = convert.extract_mailbox(result_path)
-
-        body_text = email_parser.get_body_text()
-        index_drive, index_path = convert.absolute_to_relative(result_path)
-
-        # 测试用代码
-        # if email_uid is None or email_uid == '':
-        #     email_uid = str(uuid.uuid4())
-
-        current_email = EmailInfo(
-            email_address=email_account.username,
-            email_uid=email_uid,
-            subject=subject,
-            from_address=from_address,
-            to_addresses=to_addresses,
-            cc_addresses=cc_addresses,
-            bcc_addresses=bcc_addresses,
-            received_date=date_time,
-            task_name=task_name,
+    def __init__(self, drive, backup_task, email_account, drive_change=False, write_limiter=None):
+        self.drive = drive
+        self.backup_task = backup_task
+        self.email_account = email_account
+        self.drive_change = drive_change
+        # 创建数据库索引管理器
+        self.db_manager = DatabaseManager(drive)
+        session = self.db_manager.get_session()
+        self.email_info_manager = EmailInfoManager(session)
+        self.attach_info_manager = AttachmentManager(session)
+        self.email_folder_manager = EmailFolderManager(session)
+        # 创建全文索引管理器
+        self.fulltext_manager = IndexManager(drive)
+        self.write = FileWriter(write_limiter)
+        self.convert = PathDirUtil()
+
+    def target_folder(self, *parts):
+        return os.path.join('MDLStore', self.backup_task.task_name, self.email_account.username, *parts)
+
+    def build_email_info(self, message, mailbox, eml_path=None):
+        """根据ParsedMessage构建EmailInfo记录"""
+        return EmailInfo(
+            email_address=self.email_account.username,
+            email_uid=message.message_id,
+            subject=message.subject,
+            from_address=message.from_address,
+            to_addresses=message.to_addresses,
+            cc_addresses=message.cc_addresses,
+            bcc_addresses=message.bcc_addresses,
+            received_date=message.received_date,
+            task_name=self.backup_task.task_name,
             mailbox=mailbox,
-            eml_path=index_path,
-            body_text=body_text
+            eml_path=eml_path,
+            body_text=message.body_text
         )
-        # print(current_email)
-        # email_info_manager = EmailInfoManager(session)
-        # email_info_manager.add_email_info(current_email)
-
-        added_email_info = email_info_manager.add_unique_email_info(current_email)
-        current_email_attachments = email_parser.get_attachments()
-        for index_, attach_ in enumerate(current_email_attachments, start=0):
-            attach_filename_ = attach_['filename']
-            attachment_info = Attachment(
-                email_id=added_email_info.email_id,
-                filename=attach_filename_,
-                attachment_type="Attach",
-                file_path="None"
-            )
-            file_info_ = attach_info_manager.add_unique_attachment(attachment_info)
-
-            file_content_ = email_parser.get_attachment_by_filename(attach_filename_)
-            tem_dir_ = temp_dir.replace('\\', '/')
-            # print(tem_dir_)
-            drive_, target_folder_ = convert.absolute_to_relative(tem_dir_)
-            result_path_ = write.write_file(file_content_, attach_filename_, drive_, target_folder_, False)
-
-            current_file_ = FileInfo(
-                attachment_id=str(file_info_.attachment_id),
-                email_id=str(added_email_info.email_id),
-                filename=attach_filename_,
-                attachment_type="Attach",
-                file_path="None",
-                content=None
-            )
-            fulltext_manager.add_to_index(result_path_, current_file_)
-            if os.path.exists(result_path_):
-                os.remove(result_path_)
-
-    # 解码并提取附件数据
-    total_count_attach = len(attachment_list)
-    print(f'共有直接附件{total_count_attach}个:380')
-    print(f'附件信息列表{attachment_list}')
-    for i, item in enumerate(attachment_list):
 
-        if progress_callback and info_callback:
-            if total_count_attach > 0:  # 确保不会除以零
-                progress = int(((i + 1) / total_count_attach) * 100)
-            else:
-                progress = 100  # 如果 total_count_attach 为 0，直接设置进度为 100
-            progress_callback.emit(progress)
-            info_callback.emit(f'备份邮件附件：已完成{i + 1}个/{total_count_attach}个')
+    def store_message(self, message, raw_email, folder, eml_filename=None, attachment_indexes=(), cloud_items=()):
+        """
+        保存一封邮件需要备份的全部内容。附件只遍历一次MIME结构、每个附件只解码一次，
+        同时用于邮件全文的附件索引和附件文件的保存
+        :param message: 邮件的ParsedMessage
+        :param raw_email: 邮件原始数据bytes，以二进制模式打开的邮件文件，或RawMessage
+        :param eml_filename: 保存邮件全文使用的EML文件名，为None时不保存全文
+        :param attachment_indexes: 需要保存的附件序号，即ParsedMessage.attachments中的index
+        :param cloud_items: 需要下载的云附件信息
+        """
+        email_info = None
+        if eml_filename is not None:
+            email_info = self.store_rfc2822(message, raw_email, eml_filename, folder)
+        if email_info is not None or attachment_indexes:
+            for attachment in message.iter_attachments(raw_email):
+                # 附件内容只能读取一次：需要保存的附件先写入目标位置，全文的附件索引直接读取保存的文件
+                stored_path = None
+                if attachment.index in attachment_indexes:
+                    stored_path = self.store_attachment(message, attachment, folder)
+                if email_info is not None:
+                    self.index_attachment(email_info, attachment, stored_path)
+        for item in cloud_items:
+            self.store_cloud_attachment(message, item, folder)
+
+    def store_rfc2822(self, message, raw_email, filename, folder):
+        """
+        保存邮件全文EML文件，并添加邮件的数据库索引。附件内容的索引由index_attachment添加
+        :param message: 邮件的ParsedMessage
+        :param raw_email: 邮件原始数据
+        :param filename: EML文件名
+        :param folder: 邮件所在的邮箱文件夹
+        :return: 添加的EmailInfo
+        """
+        sub_folder = os.path.join(self.email_account.username, folder)
+        target_folder = self.target_folder('RFC2822', sub_folder)  # 构建目标文件夹路径
+        if isinstance(raw_email, RawMessage):
+            # 直接从文件映射写出，不读入内存
+            with raw_email.view() as view:
+                result_path = self.write.write_file(view, filename, self.drive, target_folder, self.drive_change)
+        else:
+            result_path = self.write.write_file(raw_email, filename, self.drive, target_folder, self.drive_change)
+
+        # 为每封邮件添加数据库索引
+        mailbox = self.convert.extract_mailbox(result_path)
+        index_drive, index_path = self.convert.absolute_to_relative(result_path)
+        current_email = self.build_email_info(message, mailbox, index_path)
+        return self.email_info_manager.add_unique_email_info(current_email)
+
+    def index_attachment(self, email_info, attachment, content_path=None):
+        """
+        为邮件全文中的一个附件添加附件信息和全文索引。附件内容写入临时数据区建立索引后删除
+        :param attachment: ParsedMessage.iter_attachments返回的MailAttachment
+        :param content_path: 附件已由store_attachment保存时的文件路径，直接用于建立索引
+        """
+        attachment_info = Attachment(
+            email_id=email_info.email_id,
+            filename=attachment.filename,
+            attachment_type="Attach",
+            file_path="None"
+        )
+        file_info_ = self.attach_info_manager.add_unique_attachment(attachment_info)
 
-        file_path = item['file_path']
-        filename = item['filename']
-        file_size = item['size']
-        with open(file_path, 'rb') as file:
-            raw_email = file.read()
-        # 使用EmailParser解析邮件
-        email_parser = EmailParser(raw_email)
-        file_content = email_parser.get_attachment_by_filename(filename)
-        target_folder = os.path.join('MDLStore', backup_task.task_name, email_account.username, 'Attachments')
+        if content_path is None:
+            tem_dir_ = temp_dir.replace('\\', '/')
+            drive_, target_folder_ = self.convert.absolute_to_relative(tem_dir_)
+            result_path_ = self.write.write_stream(attachment.stream, attachment.filename, drive_, target_folder_,
+                                                   False, attachment.size * 1024)
+        else:
+            result_path_ = content_path
 
-        result_path = write.write_file(file_content, filename, available_disk, target_folder, drive_change)
+        current_file_ = FileInfo(
+            attachment_id=str(file_info_.attachment_id),
+            email_id=str(email_info.email_id),
+            filename=attachment.filename,
+            attachment_type="Attach",
+            file_path="None",
+            content=None
+        )
+        self.fulltext_manager.add_to_index(result_path_, current_file_)
+        if content_path is None and os.path.exists(result_path_):
+            os.remove(result_path_)
+
+    def store_attachment(self, message, attachment, folder):
+        """
+        保存一个附件，添加所属邮件信息、附件信息和全文索引
+        :param message: 邮件的ParsedMessage
+        :param attachment: ParsedMessage.iter_attachments返回的MailAttachment
+        :return: 附件文件的绝对路径
+        """
+        filename = attachment.filename
+        result_path = self.write.write_stream(attachment.stream, filename, self.drive, self.target_folder('Attachments'),
+                                              self.drive_change, attachment.size * 1024)
 
-        # 为每个文件添加数据库索引和全文索引
         # 添加所属邮件信息
-        headers = email_parser.get_headers()
-        email_uid = email_parser.getEmailMessageUID(headers)
-        subject = email_parser.getSubject(headers)
-        from_address = email_parser.getFrom(headers)
-        to_addresses = email_parser.getTo(headers)
-        cc_addresses = email_parser.getCc(headers)
-        bcc_addresses = email_parser.getBcc(headers)
-        date_time = email_parser.getDate(headers)
-        task_name = backup_task.task_name
-        mailbox = convert.extract_mailbox(file_path)
-        body_text = email_parser.get_body_text()
-        index_drive, index_path = convert.absolute_to_relative(result_path)
-
-        email_info = EmailInfo(
-            email_address=email_account.username,
-            email_uid=email_uid,
-            subject=subject,
-            from_address=from_address,
-            to_addresses=to_addresses,
-            cc_addresses=cc_addresses,
-            bcc_addresses=bcc_addresses,
-            received_date=date_time,
-            task_name=task_name,
-            mailbox=mailbox,
-            eml_path=None,
-            body_text=body_text
-        )
-        email_info = email_info_manager.add_unique_email_info(email_info)
-        # print(email_info.id)
+        index_drive, index_path = self.convert.absolute_to_relative(result_path)
+        email_info = self.email_info_manager.add_unique_email_info(self.build_email_info(message, folder))
         # 添加附件文件信息
         attachment_info = Attachment(
             email_id=email_info.email_id,
             filename=filename,
             attachment_type="Attach",
             file_path=index_path
-            # file_hash="123456789abcdef"  # 哈希值
         )
-        file_info = attach_info_manager.add_unique_attachment(attachment_info)
+        file_info = self.attach_info_manager.add_unique_attachment(attachment_info)
         # 添加附件索引信息
         current_file = FileInfo(
             attachment_id=str(file_info.attachment_id),
@@ -465,18 +541,17 @@ def extractEmailData(drive, backup_task, email_account, drive_change, progress_c
             file_path=file_info.file_path,
             content=None
         )
-        # print(result_path)
-        fulltext_manager.add_to_index(result_path, current_file)
-
-    # # 解码并下载云附件
-    total_count_cloud_attach = len(cloud_attach_list)
-    print(f'云附件列表{cloud_attach_list}')
-    for i, item in enumerate(cloud_attach_list):
-
-        file_path = item['file_path']
+        self.fulltext_manager.add_to_index(result_path, current_file)
+        return result_path
+
+    def store_cloud_attachment(self, message, item, folder):
+        """
+        下载一个云附件，添加所属邮件信息、附件信息和全文索引
+        :param message: 邮件的ParsedMessage
+        :param item: ParsedMessage.cloud_attachments返回的云附件信息
+        :return: 云附件文件的绝对路径，未下载时为None
+        """
         filename = item['filename']
-        file_size = item['file_size']
-        expire_time = item['expire_time']
         expired = item['expired']
         outside_link = item['outside_link']
         print(f'获取状态{expired},{type(expired)}')
@@ -486,8 +561,7 @@ def extractEmailData(drive, backup_task, email_account, drive_change, progress_c
             downloader = CloudAttachmentDownloader(url)
             cloud_utils = downloader.create_download_utils()
             url = cloud_utils.get_downloadUrl()
-            target_folder = os.path.join('MDLStore', backup_task.task_name, email_account.username, 'CloudAttach')
-            download_dir = os.path.join(f'{available_disk}:/', target_folder)
+            download_dir = os.path.join(f'{self.drive}:/', self.target_folder('CloudAttach'))
             os.makedirs(download_dir, exist_ok=True)
             download_path = os.path.join(download_dir, filename)
             print(f'直接下载链接{url}')
@@ -497,49 +571,19 @@ def extractEmailData(drive, backup_task, email_account, drive_change, progress_c
             abstract_path = None
 
         # 添加索引数据
-        with open(file_path, 'rb') as file:
-            raw_email = file.read()
-        email_parser = EmailParser(raw_email)
-        headers = email_parser.get_headers()
-        email_uid = email_parser.getEmailMessageUID(headers)
-        subject = email_parser.getSubject(headers)
-        from_address = email_parser.getFrom(headers)
-        to_addresses = email_parser.getTo(headers)
-        cc_addresses = email_parser.getCc(headers)
-        bcc_addresses = email_parser.getBcc(headers)
-        date_time = email_parser.getDate(headers)
-        task_name = backup_task.task_name
-        mailbox = convert.extract_mailbox(file_path)
-        # print(f"云附件的file_path={file_path}")
-        body_text = email_parser.get_body_text()
         if abstract_path:
-            index_drive, index_path = convert.absolute_to_relative(abstract_path)
+            index_drive, index_path = self.convert.absolute_to_relative(abstract_path)
         else:
             index_path = "None"
-        email_info = EmailInfo(
-            email_address=email_account.username,
-            email_uid=email_uid,
-            subject=subject,
-            from_address=from_address,
-            to_addresses=to_addresses,
-            cc_addresses=cc_addresses,
-            bcc_addresses=bcc_addresses,
-            received_date=date_time,
-            task_name=task_name,
-            mailbox=mailbox,
-            body_text=body_text,
-            eml_path=None
-        )
-        email_info = email_info_manager.add_unique_email_info(email_info)
+        email_info = self.email_info_manager.add_unique_email_info(self.build_email_info(message, folder))
 
         attachment_info = Attachment(
             email_id=email_info.email_id,
             filename=filename,
             attachment_type="CloudAttach",
             file_path=index_path
-            # file_hash="123456789abcdef"  # 哈希值
         )
-        file_info = attach_info_manager.add_unique_attachment(attachment_info)
+        file_info = self.attach_info_manager.add_unique_attachment(attachment_info)
         # 添加全文索引
         current_file = FileInfo(
             attachment_id=str(file_info.attachment_id),
@@ -550,20 +594,189 @@ def extractEmailData(drive, backup_task, email_account, drive_change, progress_c
             content=None
         )
         if index_path:
-            fulltext_manager.add_to_index(abstract_path, current_file)
+            self.fulltext_manager.add_to_index(abstract_path, current_file)
+        return abstract_path
+
+    def record_folders(self, memberships):
+        """
+        记录出现在多个文件夹中的邮件的全部所属文件夹，包括下载前去重时跳过的副本
+        :param memberships: MessageDeduper.memberships()的返回值
+        """
+        for message_id, folders in memberships.items():
+            for email_info in self.email_info_manager.get_email_infos_by_message_id(
+                    message_id, self.backup_task.task_name, self.email_account.username):
+                for folder in folders:
+                    self.email_folder_manager.add_unique_email_folder(email_info.email_id, folder)
+
+    def close(self):
+        self.db_manager.close_session()
+
+
+class DirectStorePipeline:
+    """
+    直写模式的邮件接收端，作为saveEmails的message_sink使用。获取到的每封邮件在内存中解析、按备份任务过滤后
+    直接交给MessageStore写入目标位置，不再经过临时数据区。同一账户的多个文件夹并行获取，写入和索引串行执行
+    """
 
+    def __init__(self, message_store):
+        self.message_store = message_store
+        self.backup_task = message_store.backup_task
+        self.lock = threading.Lock()
+        self.stored_count = 0
+
+    def __call__(self, folder, uid, raw_email):
+        if isinstance(raw_email, tempfile.SpooledTemporaryFile):
+            # 分块获取的大邮件临时文件：映射后按RawMessage解析，附件内容留在文件中，写出EML时也不读入内存
+            with RawMessage(file=raw_email) as raw_message:
+                return self(folder, uid, raw_message)
+        header_scanner = EmailHeaderScanner(raw_email)
+        if not match_backup_task(self.backup_task, header_scanner, header_scanner.get_headers()):
+            return
+        message = ParsedMessage.from_parser(EmailParser(raw_email))
+        content_type = self.backup_task.content_type
+        keyword = self.backup_task.filename_keywords
+        attachment_indexes = set()
+        if 'Attachment' in content_type:
+            attachment_indexes = {item['index'] for item in message.attachments_by_keyword(keyword)}
+        cloud_items = message.cloud_attachments(keyword) if 'CloudAttach' in content_type else []
+        with self.lock:
+            self.message_store.store_message(message, raw_email, folder,
+                                             message.file_name if 'RFC2822' in content_type else None,
+                                             attachment_indexes, cloud_items)
+            self.stored_count += 1
+
+
+def extractEmailData(drive, backup_task, email_account, drive_change, progress_callback, info_callback,
+                     write_limiter=None, folder_memberships=None):
+    """
+    解析备份任务，将对应邮件账户所属的邮件，按照备份任务的具体要求，保存在磁盘分区drive下的MDLStore文件夹内。数据源位于temp_dir
+    文件夹内，其中有若干个以邮箱地址为文件名的文件夹，属于email_account账户的邮件，就保存在该文件夹下，该文件夹下又是按照收件箱、已发送
+    等文件夹来保存邮件eml文件。需要按照backup_task的指示，将符合条件的邮件数据保存到目标位置。在目标位置的任务名
+    文件夹内有三个文件夹，分别是RFC2822、Attachment和CloudAttach，分别保存eml邮件文件和附件文件。注意在RFC2822文件夹内部，
+    邮件依然按照跟temp_dir文件夹中各个邮箱相同的文件夹嵌套结构来保存邮件。
+    """
+    print(f'开始提取{backup_task}')
+    # 创建临时文件
+    global root
+    rfc2822_temp_file = tempfile.NamedTemporaryFile(delete=False, mode='w+')
+    attachment_temp_file = tempfile.NamedTemporaryFile(delete=False, mode='w+')
+    cloud_attach_temp_file = tempfile.NamedTemporaryFile(delete=False, mode='w+')
+
+    # 初始化临时文件中的列表
+    rfc2822_list = []
+    attachment_list = []
+    cloud_attach_list = []
+
+    # 源数据位置
+    source_dir = os.path.join(temp_dir, email_account.username)
+    matched_paths = []  # 符合筛选条件的邮件文件
+
+    # 遍历temp_dir中的所有文件和文件夹
+    for root, dirs, files in os.walk(source_dir):
+        for filename in files:
+            if filename.endswith('.eml'):
+                file_path = os.path.join(root, filename)
+                print(f'解析邮件{filename}:180')
+                with RawMessage(file_path) as raw_message:
+                    # 先只读取头部按日期、发件人和主题筛选，不符合条件的邮件不再完整解析
+                    header_scanner = EmailHeaderScanner(raw_message)
+                    headers = header_scanner.get_headers()
+                    if not match_backup_task(backup_task, header_scanner, headers):
+                        continue
+                    emlFileName = header_scanner.getEmailFileName(headers)
+                    fileSize = header_scanner.getSize()
+
+                    # 根据备份类型处理邮件
+                    if 'RFC2822' in backup_task.content_type:
+                        rfc2822_list.append({'file_path': file_path, 'size': fileSize, 'filename': emlFileName})
+                    matched_paths.append(file_path)
+
+    # 提取附件和云附件才需要完整解析，在进程池中并行解析。解析结果写入缓存，写入目标位置时不再解析
+    if 'Attachment' in backup_task.content_type or 'CloudAttach' in backup_task.content_type:
+        for file_path, message in parse_messages(matched_paths):
+            if 'Attachment' in backup_task.content_type:
+                attachments = message.attachments_by_keyword(backup_task.filename_keywords)
+                print(f'{os.path.basename(file_path)}的全部附件:{attachments}')
+                for attachment in attachments:
+                    attachment_list.append({'file_path': file_path, 'index': attachment['index'],
+                                            'filename': attachment['filename'], 'size': attachment['file_size']})
+            if 'CloudAttach' in backup_task.content_type:
+                for attach in message.cloud_attachments(backup_task.filename_keywords):
+                    cloud_attach_list.append({'file_path': file_path, 'filename': attach['filename'],
+                                              'file_size': attach['file_size'],
+                                              'expire_time': attach['expire_time'],
+                                              'expired': attach['expired'],
+                                              'outside_link': attach['outside_link']})
+
+    # 写入临时文件
+    rfc2822_temp_file.write(json.dumps(rfc2822_list))
+    attachment_temp_file.write(json.dumps(attachment_list))
+    cloud_attach_temp_file.write(json.dumps(cloud_attach_list))
+
+    # 关闭临时文件
+    rfc2822_temp_file.close()
+    attachment_temp_file.close()
+    cloud_attach_temp_file.close()
+
+    # 读取每个临时文件的内容
+    rfc2822_list = read_and_print_temp_file(rfc2822_temp_file.name)
+    attachment_list = read_and_print_temp_file(attachment_temp_file.name)
+    cloud_attach_list = read_and_print_temp_file(cloud_attach_temp_file.name)
+
+    # 计算总备份数据量大小（单位KB）
+    total_size = (sum(item['size'] for item in rfc2822_list) +
+                  sum(item['size'] for item in attachment_list) +
+                  sum(item['file_size'] for item in cloud_attach_list))
+    # 按历次备份学习到的比例估算索引数据量，加上索引数据量得到总容量
+    index_capacity = total_size * IndexRatio().get_ratio()
+    total_size = total_size + index_capacity
+
+    # 创建存储管理器
+    storage_manager = StorageManager()
+    # 寻找可用磁盘单位KB
+    available_disk = storage_manager.get_available_disk(drive, total_size, drive_change)
+    if available_disk is None:
+        print(f'存储总量{total_size}请更换目标磁盘')
+        return
+
+    # 迁移数据到目标位置
+    message_store = MessageStore(available_disk, backup_task, email_account, drive_change, write_limiter)
+
+    def folder_of(file_path):
+        # 邮件所在的邮箱文件夹，即相对于该账户临时目录的路径
+        return os.path.relpath(os.path.dirname(file_path), start=source_dir)
+
+    # 按邮件归并全文、附件和云附件，逐封写入目标位置，每封邮件只读取一次解析记录
+    print(f'共有直接附件{len(attachment_list)}个，云附件{len(cloud_attach_list)}个')
+    message_items = {}
+    for kind, items in (('RFC2822', rfc2822_list), ('Attachment', attachment_list),
+                        ('CloudAttach', cloud_attach_list)):
+        for item in items:
+            message_items.setdefault(item['file_path'], []).append((kind, item))
+
+    total_count = len(message_items)
+    # 子进程解析，当前进程按顺序写入目标位置、数据库和全文索引
+    for i, (file_path, message) in enumerate(parse_messages(list(message_items))):
         if progress_callback and info_callback:
-            if total_count_cloud_attach > 0:  # 确保不会除以零
-                progress = int(((i + 1) / total_count_cloud_attach) * 100)
-            else:
-                progress = 100  # 如果 total_count_attach 为 0，直接设置进度为 100，表示任务已完成
+            progress_callback.emit(int(((i + 1) / total_count) * 100))
+            info_callback.emit(f'备份邮件：已完成{i + 1}封/{total_count}封')
+
+        items = message_items[file_path]
+        eml_filename = next((item['filename'] for kind, item in items if kind == 'RFC2822'), None)
+        attachment_indexes = {item['index'] for kind, item in items if kind == 'Attachment'}
+        cloud_items = [item for kind, item in items if kind == 'CloudAttach']
+        with RawMessage(file_path) as raw_email:
+            message_store.store_message(message, raw_email, folder_of(file_path), eml_filename,
+                                        attachment_indexes, cloud_items)
 
-            progress_callback.emit(progress)
-            info_callback.emit(f'备份邮件云附件：已完成{i + 1}个/{total_count_cloud_attach}个')
+    if folder_memberships:
+        message_store.record_folders(folder_memberships)
 
     # 清空临时文件和临时数据区（临时文件读取后已删除）
     delete_directory(source_dir)
-    db_manager.close_session()
+    ParsedMessageCache(parse_cache_dir).prune()
+    message_store.close()
+    return True
 
 
 def read_and_print_temp_file(filename):
@@ -596,73 +809,231 @@ def delete_directory(directory_path):
 # 调用函数删除目录
 
 
-def long_running_task(task_id_lists: List[BackupTask], drive, drive_change, progress_callback,
-                      detail_callback, info_callback):
-    # 指定 ini 文件的位置
-    ini_file = ini_path
-
-    # 创建一个 ConfigParser 对象
-    config = configparser.ConfigParser()
-
-    # 如果文件已存在，则读取它
-    if os.path.exists(ini_file):
-        config.read(ini_file)
-    config.clear()
-
-    session = SessionManager().get_session()
-    # BackupTaskManager(session)
-    account_manager = EmailAccountManager(session)
-
-    task_nums = len(task_id_lists)
-    print(f'共有备份任务{task_nums}个')
-
-    for index, task in enumerate(task_id_lists):
-        current_task = task
-        # print(current_task)
-        # email_account_manager = EmailAccountManager(session)
-        # email_account = email_account_manager.get_email_account_by_id(current_task.email_account_id)
-        #
-        # detail_callback.emit(f'当前备份的邮箱是:{email_account.username}')
-        # # progress_percentage = int((index + 1) / task_nums * 100)
-        # # progress_callback.emit(progress_percentage)
-        # # detail_callback.emit(f'获取邮箱:{email_account.username}数据到本地···')
-        # backupEmailToTmpArea(current_task, email_account, progress_callback, info_callback)
-        # # detail_callback.emit(f'提取邮箱:{email_account.username}数据到目标位置···')
-        # extractEmailData(drive, current_task, email_account, progress_callback, info_callback, drive_change)
+class TaskChannel:
+    """
+    单个备份任务的进度通道：progress是该任务在总进度中的分量，detail和info的文本带任务名前缀
+    """
+
+    def __init__(self, task, aggregator, index, detail_callback=None, info_callback=None):
+        prefix = f'[{task.task_name}]'
+        self.index = index
+        self.aggregator = aggregator
+        self.progress = aggregator.channel(index)
+        self.detail = PrefixedInfoChannel(detail_callback, prefix) if detail_callback else None
+        self.info = PrefixedInfoChannel(info_callback, prefix) if info_callback else None
+        # 预检结果
+        self.plan = None  # planner.CapacityPlan，预检失败时为None
+        self.target_drive = None  # 已预留空间的目标磁盘
+        self.reserved_bytes = 0
+        self.succeeded = False
+
+    def finish(self):
+        self.aggregator.update(self.index, 100)
+
+
+class BackupScheduler:
+    """
+    备份任务调度器。不同邮箱账户的任务并发执行，同一账户的任务按顺序执行；全部任务共享并发数上限、
+    下载带宽预算和磁盘写入预算。每个任务有独立的进度通道，合并后的总进度通过progress_callback发出，
+    每个任务结束后立即把结果写入历史记录文件。下载开始前先预检全部任务的数据量并预留目标磁盘空间，
+    空间不足的任务直接失败
+    """
+
+    def __init__(self, drive, drive_change, progress_callback=None, detail_callback=None, info_callback=None,
+                 max_concurrency=MAX_CONCURRENT_TASKS, bandwidth_limit=BANDWIDTH_LIMIT,
+                 disk_write_limit=DISK_WRITE_LIMIT):
+        self.drive = drive
+        self.drive_change = drive_change
+        self.progress_callback = progress_callback
+        self.detail_callback = detail_callback
+        self.info_callback = info_callback
+        self.max_concurrency = max(1, max_concurrency)
+        self.network_limiter = RateLimiter(bandwidth_limit)
+        self.write_limiter = RateLimiter(disk_write_limit)
+        self.config = configparser.ConfigParser()
+        self.history_lock = threading.Lock()
+        self.index_ratio = IndexRatio()
+
+    def run(self, tasks):
+        """
+        执行全部备份任务，阻塞到所有任务结束
+        :param tasks: BackupTask列表
+        """
+        # 如果文件已存在，则读取它
+        if os.path.exists(ini_path):
+            self.config.read(ini_path)
+        self.config.clear()
+
+        print(f'共有备份任务{len(tasks)}个')
+        aggregator = ProgressAggregator(self.progress_callback, len(tasks))
+        # 按邮箱账户分组，同一账户共用临时目录和服务器会话限制，组内顺序执行
+        account_groups = {}
+        channels = []
+        for index, task in enumerate(tasks):
+            channel = TaskChannel(task, aggregator, index, self.detail_callback, self.info_callback)
+            account_groups.setdefault(task.email_account_id, []).append((task, channel))
+            channels.append(channel)
+
+        max_workers = min(self.max_concurrency, max(1, len(account_groups)))
+        # 预检：下载前统计各任务的数据量并预留目标磁盘空间
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self.plan_account_tasks, group) for group in account_groups.values()]
+            for future in futures:
+                future.result()
+        index_sizes = {channel.target_drive: directory_size(index_directory(channel.target_drive))
+                       for channel in channels if channel.target_drive is not None}
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self.run_account_tasks, group) for group in account_groups.values()]
+            for future in futures:
+                future.result()
+
+        self.learn_index_ratio(channels, index_sizes)
+        self.write_history()
+        return "Task completed"
+
+    def plan_account_tasks(self, group):
+        """预检同一邮箱账户的任务，每个线程使用独立的配置库Session"""
+        session = Session()
+        try:
+            for task, channel in group:
+                self.plan_task(session, task, channel)
+        finally:
+            session.close()
+
+    def plan_task(self, session, task, channel):
+        """
+        预检单个任务并预留目标磁盘空间。预检失败时不预留，任务按原方式执行
+        """
+        try:
+            account = EmailAccountManager(session).get_email_account_by_id(task.email_account_id)
+            sync_marks = load_sync_marks(session, task, account, self.drive)
+            plan = plan_backup_task(task, account, sync_marks, self.network_limiter)
+        except Exception as e:
+            print(f'任务{task.task_name}预检失败{e}')
+            return
+        ratio = self.index_ratio.get_ratio()
+        channel.plan = plan
+        channel.reserved_bytes = plan.total_bytes(ratio)
+        channel.target_drive = StorageManager().reserve_disk(self.drive, channel.reserved_bytes, self.drive_change)
+        print(f'任务{task.task_name}预检：{plan.describe(ratio)}，目标磁盘{channel.target_drive}')
+        if channel.info:
+            channel.info.emit(plan.describe(ratio))
+
+    def learn_index_ratio(self, channels, index_sizes):
+        """
+        根据索引目录的实际增长量学习索引比例
+        :param channels: 全部任务的TaskChannel
+        :param index_sizes: 执行前各目标磁盘索引目录的字节数
+        """
+        for drive, before in index_sizes.items():
+            data_bytes = sum(channel.plan.data_bytes for channel in channels
+                             if channel.target_drive == drive and channel.succeeded)
+            growth = directory_size(index_directory(drive)) - before
+            self.index_ratio.learn(growth, data_bytes)
+
+    def run_account_tasks(self, group):
+        """顺序执行同一邮箱账户的任务，每个线程使用独立的配置库Session"""
+        session = Session()
+        try:
+            for task, channel in group:
+                self.run_task(session, task, channel)
+        finally:
+            session.close()
 
+    def run_task(self, session, task, channel):
         try:
             # 获取账户信息
-            account = account_manager.get_email_account_by_id(task.email_account_id)
-            detail_callback.emit(f'当前备份的邮箱是:{account.username}')
-            # 执行备份到临时区域
-            # print(f'参数{task, account}')
-            backupEmailToTmpArea(task, account, progress_callback, info_callback)
-            # 执行数据提取
-            drive = drive
-            extractEmailData(drive, task, account, drive_change, progress_callback, info_callback)
+            account = EmailAccountManager(session).get_email_account_by_id(task.email_account_id)
+            if channel.detail:
+                channel.detail.emit(f'当前备份的邮箱是:{account.username}')
+            if channel.plan is not None and channel.target_drive is None:
+                raise RuntimeError(f'目标磁盘空间不足，预计需要{channel.reserved_bytes / 1024 / 1024:.1f}MB，'
+                                   f'请更换目标磁盘')
+            sync_marks = load_sync_marks(session, task, account, self.drive)
+            # 目标磁盘可用时直接写入目标位置，否则经临时数据区中转
+            if channel.target_drive is not None:
+                direct_drive = channel.target_drive
+            else:
+                direct_drive = StorageManager().get_available_disk(self.drive, DIRECT_STORE_RESERVE,
+                                                                   self.drive_change)
+            if direct_drive is not None:
+                try:
+                    stored = self.store_direct(direct_drive, task, account, channel, sync_marks)
+                except Exception:
+                    # 直写模式下检查点之前的邮件都已写入目标位置，保存检查点，下次从断点继续
+                    save_sync_marks(session, task, account, self.drive, sync_marks)
+                    raise
+            else:
+                stored = self.store_via_temp_area(task, account, channel, sync_marks)
+            if stored:
+                # 数据写入目标位置后才记录同步标记，下次只获取新邮件
+                save_sync_marks(session, task, account, self.drive, sync_marks)
             # 如果成功，记录在 ini 文件中
             result = "Success"
+            channel.succeeded = True
         except Exception as e:
             # 如果发生错误，记录在 ini 文件中
             result = f"Failed: {str(e)}"
             traceback.print_exc()
+        if channel.target_drive is not None:
+            StorageManager().release_disk(channel.target_drive, channel.reserved_bytes)
+        channel.finish()
+        self.record_result(task, result)
+
+    def store_direct(self, drive, task, account, channel, sync_marks):
+        """直写模式：获取到的邮件直接解析并写入目标磁盘drive"""
+        print(f'直写模式，目标磁盘{drive}')
+        message_store = MessageStore(drive, task, account, self.drive_change, self.write_limiter)
+        deduper = MessageDeduper()
+        try:
+            pipeline = DirectStorePipeline(message_store)
+            fetched = backupEmailToTmpArea(task, account, channel.progress, channel.info, sync_marks,
+                                           self.network_limiter, pipeline, deduper)
+            print(f'共写入邮件{pipeline.stored_count}封，跳过重复副本{deduper.skipped}封')
+            message_store.record_folders(deduper.memberships())
+        finally:
+            message_store.close()
+        return fetched
+
+    def store_via_temp_area(self, task, account, channel, sync_marks):
+        """中转模式：先把邮件保存到临时数据区，统计数据量并选定磁盘后再提取到目标位置"""
+        deduper = MessageDeduper()
+        # 执行备份到临时区域
+        backupEmailToTmpArea(task, account, channel.progress, channel.info, sync_marks, self.network_limiter,
+                             deduper=deduper)
+        print(f'跳过重复副本{deduper.skipped}封')
+        # 执行数据提取
+        return extractEmailData(self.drive, task, account, self.drive_change, channel.progress, channel.info,
+                                self.write_limiter, deduper.memberships())
+
+    def record_result(self, task, result):
+        """在 ini 文件中添加备份任务的结果"""
+        with self.history_lock:
+            task_section = f"Task_{task.task_id}"
+            if not self.config.has_section(task_section):
+                self.config.add_section(task_section)
+
+            # 序列化 task 对象并存储为字节字符串
+            serialized_task = pickle.dumps(task)
+
+            # 将序列化后的 task 对象存储在 ini 文件中
+            self.config.set(task_section, "task_data", serialized_task.hex())  # 将字节流转换为十六进制字符串存储
+            self.config.set(task_section, "result", result)
+            self.config.set(task_section, "drive", self.drive)
+        self.write_history()
+
+    def write_history(self):
+        """将结果写入 ini 文件"""
+        with self.history_lock:
+            with open(ini_path, "w") as configfile:
+                self.config.write(configfile)
 
-        # 在 ini 文件中添加备份任务的结果
-        task_section = f"Task_{task.task_id}"
-        if not config.has_section(task_section):
-            config.add_section(task_section)
-
-        # 序列化 task 对象并存储为字节字符串
-        serialized_task = pickle.dumps(task)
-
-        # 将序列化后的 task 对象存储在 ini 文件中
-        config.set(task_section, "task_data", serialized_task.hex())  # 将字节流转换为十六进制字符串存储
-        config.set(task_section, "result", result)
-        config.set(task_section, "drive", drive)
-
-    # 将结果写入 ini 文件
-    with open(ini_file, "w") as configfile:
-        config.write(configfile)
-    # print(f"备份任务结果记录在 {ini_file} 中")
 
-    return "Task completed"
+def long_running_task(task_id_lists: List[BackupTask], drive, drive_change, progress_callback,
+                      detail_callback, info_callback):
+    """
+    执行备份任务列表。不同邮箱账户的任务由BackupScheduler并发执行，结果记录在历史记录文件中
+    """
+    scheduler = BackupScheduler(drive, drive_change, progress_callback, detail_callback, info_callback)
+    return scheduler.run(task_id_lists)
@@ -0,0 +1,158 @@
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup
+
+try:
+    from lxml import etree
+except ImportError:  # lxml是可选依赖，未安装时没有lxml后端
+    etree = None
+
+# 内容不属于正文文本的标签，与BeautifulSoup的get_text()一致：脚本、样式、模板和注音
+SKIPPED_TAGS = ('script', 'style', 'template', 'rt', 'rp')
+
+
+class TextCollector:
+    """
+    按标签切分文本并跳过script、style等标签内容的文本收集逻辑，TextStripper和LxmlTextTarget共用，
+    输出与BeautifulSoup(html, 'html.parser').get_text(separator=' ', strip=True)相同
+    """
+
+    def __init__(self):
+        self.pieces = []
+        self.current = []  # 两个标签之间的连续文本，解析器可能分多次交给data
+        self.skip_depth = 0
+
+    def flush(self):
+        if self.current:
+            text = ''.join(self.current).strip()
+            self.current = []
+            if text:
+                self.pieces.append(text)
+
+    def open_tag(self, tag):
+        self.flush()
+        if tag in SKIPPED_TAGS:
+            self.skip_depth += 1
+
+    def close_tag(self, tag):
+        self.flush()
+        if tag in SKIPPED_TAGS and self.skip_depth:
+            self.skip_depth -= 1
+
+    def add_data(self, data):
+        if not self.skip_depth:
+            self.current.append(data)
+
+    def result(self):
+        self.flush()
+        return ' '.join(self.pieces)
+
+
+class TextStripper(HTMLParser, TextCollector):
+    """基于html.parser的流式去标签器，不建立文档树"""
+
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        TextCollector.__init__(self)
+
+    def handle_starttag(self, tag, attrs):
+        self.open_tag(tag)
+
+    def handle_endtag(self, tag):
+        self.close_tag(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.flush()
+
+    def handle_data(self, data):
+        self.add_data(data)
+
+    def handle_comment(self, data):
+        self.flush()
+
+    def handle_decl(self, decl):
+        self.flush()
+
+    def handle_pi(self, data):
+        self.flush()
+
+    def unknown_decl(self, data):
+        self.flush()
+
+    def text(self, html):
+        self.feed(html)
+        self.close()
+        return self.result()
+
+
+class LxmlTextTarget(TextCollector):
+    """
+    lxml解析器的事件接收对象，不建立文档树。与document_fromstring不同，</html>之后的文本和拼接在一起的多个文档
+    （get_body_text合并的多个正文部分）都会保留，注释两侧的文本不会被合并
+    """
+
+    def start(self, tag, attrib):
+        self.open_tag(tag)
+
+    def end(self, tag):
+        self.close_tag(tag)
+
+    def data(self, data):
+        self.add_data(data)
+
+    def comment(self, text):
+        self.flush()
+
+    def pi(self, target, data=None):
+        self.flush()
+
+    def doctype(self, *args):
+        self.flush()
+
+    def close(self):
+        return self.result()
+
+
+def stripper_to_text(html):
+    return TextStripper().text(html)
+
+
+def lxml_to_text(html):
+    """用libxml2的HTML解析器逐个事件提取文本，需要安装lxml"""
+    if not html.strip():
+        return ''
+    parser = etree.HTMLParser(target=LxmlTextTarget())
+    try:
+        parser.feed(html)
+        return parser.close()
+    except (ValueError, etree.LxmlError):
+        # 无法解析的内容
+        return stripper_to_text(html)
+
+
+def bs4_to_text(html):
+    soup = BeautifulSoup(html, 'html.parser')  # 使用内建的 html.parser
+    return soup.get_text(separator=' ', strip=True)  # 获取所有标签去除后的纯文本内容
+
+
+# HTML转文本的后端：'stripper'为流式去标签，'lxml'需要安装lxml，'bs4'为BeautifulSoup建树后取文本。
+# 默认使用与bs4输出一致的stripper，lxml可用benchmark --html验证后再切换
+BACKENDS = {'stripper': stripper_to_text, 'bs4': bs4_to_text}
+if etree is not None:
+    BACKENDS['lxml'] = lxml_to_text
+HTML_TEXT_BACKEND = 'stripper'
+
+
+def html_to_text(html, backend=None):
+    """
+    去除HTML标签，返回以空格分隔的正文文本
+    :param backend: BACKENDS中的名称，默认为HTML_TEXT_BACKEND
+    """
+    return BACKENDS[backend or HTML_TEXT_BACKEND](html)
+
+
+def make_soup(html):
+    """
+    云附件解析使用的BeautifulSoup文档树。固定使用html.parser，各CloudFileParser按其建树结果编写
+    """
+    return BeautifulSoup(html, 'html.parser')
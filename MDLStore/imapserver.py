@@ -0,0 +1,669 @@
+import email
+import hashlib
+import queue
+import random
+import re
+import socketserver
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from email import policy
+from email.message import EmailMessage
+from email.utils import format_datetime, parsedate_to_datetime
+
+from MDLStore.bodystructure import parse_sexp
+from MDLStore.utils import EmailUtils, RateLimiter
+
+# 命令行末尾的literal长度，{n+}为LITERAL+，不需要等待继续响应
+COMMAND_LITERAL_RE = re.compile(rb'\{(\d+)(\+?)\}\r\n$')
+# FETCH数据项，如BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)]、BODY.PEEK[]<0.4096>、RFC822.SIZE
+FETCH_ITEM_RE = re.compile(r'(BODY(?:\.PEEK)?)\[([^\]]*)\](?:<(\d+)\.(\d+)>)?|([A-Z0-9.\-]+)', re.I)
+FETCH_MACROS = {'ALL': ['FLAGS', 'INTERNALDATE', 'RFC822.SIZE'], 'FAST': ['FLAGS', 'INTERNALDATE', 'RFC822.SIZE'],
+                'FULL': ['FLAGS', 'INTERNALDATE', 'RFC822.SIZE', 'BODYSTRUCTURE']}
+INFLATE_READ_SIZE = 64 * 1024
+NEWLINE = b'\n'
+
+
+def generate_corpus(count, body_bytes=4096, attachment_bytes=64 * 1024, attachment_ratio=0.5, start=None,
+                    first_index=0):
+    """
+    生成测试邮件语料。每封邮件有纯文本和HTML正文，按attachment_ratio的比例带一个随机内容的附件，
+    每三封中有一封使用中文主题，便于覆盖CHARSET搜索。内容由序号决定，相同参数生成的语料相同
+    :param count: 邮件数
+    :param body_bytes: 纯文本正文的大致字节数
+    :param attachment_bytes: 附件解码后的字节数，为0时不带附件
+    :param attachment_ratio: 带附件的邮件比例
+    :param start: 第一封邮件的日期，之后每封晚一小时
+    :param first_index: 第一封邮件的序号，用于向已有文件夹追加新邮件
+    :return: 邮件原始数据列表，行尾为CRLF
+    """
+    start = start or datetime(2024, 1, 1, tzinfo=timezone.utc)
+    messages = []
+    for index in range(first_index, first_index + count):
+        message = EmailMessage()
+        message['From'] = f'User {index % 7} <user{index % 7}@example.com>'
+        message['To'] = 'me@example.com'
+        message['Subject'] = f'发票 {index}' if index % 3 == 0 else f'Report {index}'
+        message['Date'] = format_datetime(start + timedelta(hours=index))
+        message['Message-ID'] = f'<bench{index}@example.com>'
+        line = f'Line of message {index}: the quick brown fox jumps over the lazy dog.\n'
+        message.set_content(line * max(1, body_bytes // len(line)))
+        message.add_alternative(f'<html><body><p>Message {index}</p></body></html>', subtype='html')
+        if attachment_bytes and int((index + 1) * attachment_ratio) > int(index * attachment_ratio):
+            message.add_attachment(random.Random(index).randbytes(attachment_bytes), maintype='application',
+                                   subtype='octet-stream', filename=f'report{index}.pdf')
+        messages.append(message.as_bytes(policy=policy.SMTP))
+    return messages
+
+
+@dataclass
+class ServerProfile:
+    """本地IMAP服务器模拟的网络和服务商行为"""
+    latency: float = 0  # 每条命令从收到到开始处理的秒数，模拟往返时间；流水线发送的命令延迟相互重叠
+    bandwidth: int = 0  # 全部连接共享的发送带宽，字节/秒，0表示不限速
+    throttle_every: int = 0  # 每N条FETCH命令以NO [THROTTLED]拒绝一条，0表示不限流
+    compress: bool = True  # 是否声明COMPRESS=DEFLATE
+    idle: bool = True  # 是否声明IDLE
+    condstore: bool = True  # 是否声明CONDSTORE，STATUS和SELECT返回HIGHESTMODSEQ
+    gmail: bool = False  # 是否声明X-GM-EXT-1，FETCH支持X-GM-MSGID
+    charset_search: bool = True  # 为False时以NO [BADCHARSET]拒绝带CHARSET的SEARCH
+
+
+class ServerStats:
+    """服务器端计数，多个连接共享"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.sessions = 0  # 建立的连接数
+        self.commands = 0  # 处理的命令数，即客户端的往返次数
+        self.fetch_commands = 0
+        self.throttled = 0  # 被限流拒绝的命令数
+        self.messages_served = 0  # 以RFC822或BODY[]返回全文的邮件数
+        self.bytes_out = 0  # 压缩前发送的字节数
+        self.wire_bytes_out = 0  # 线路上发送的字节数
+
+    def add(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def snapshot(self):
+        with self.lock:
+            return {name: value for name, value in vars(self).items() if name != 'lock'}
+
+
+class Mailbox:
+    """服务器上的一个文件夹。UID从1开始连续分配，序号与UID相同，不支持删除邮件"""
+
+    def __init__(self, name, messages=()):
+        self.name = name
+        self.messages = []
+        self.modseq = 1
+        self._parsed = {}
+        for raw in messages:
+            self.append(raw)
+
+    def append(self, raw):
+        """追加一封邮件，返回其UID"""
+        self.messages.append(raw)
+        self.modseq += 1
+        return len(self.messages)
+
+    @property
+    def uid_next(self):
+        return len(self.messages) + 1
+
+    def raw(self, uid):
+        return self.messages[uid - 1]
+
+    def parsed(self, uid):
+        message = self._parsed.get(uid)
+        if message is None:
+            message = email.message_from_bytes(self.raw(uid), policy=policy.default)
+            self._parsed[uid] = message
+        return message
+
+    def date(self, uid):
+        """邮件的日期，用Date头代替INTERNALDATE"""
+        try:
+            return parsedate_to_datetime(str(self.parsed(uid)['Date']))
+        except (TypeError, ValueError):
+            return datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+    def parse_set(self, text):
+        """解析序号集合或UID集合，如'1:5,9,12:*'，返回存在的UID列表"""
+        last = len(self.messages)
+        uids = []
+        for item in text.split(','):
+            start, _, end = item.partition(':')
+            start = last if start == '*' else int(start)
+            end = start if not end else (last if end == '*' else int(end))
+            uids.extend(range(min(start, end), max(start, end) + 1))
+        return [uid for uid in sorted(set(uids)) if 1 <= uid <= last]
+
+
+class LocalIMAPServer(socketserver.ThreadingTCPServer):
+    """
+    本地IMAP替身服务器，在localhost上提供生成的邮件语料，用于在没有真实邮箱时测量和回归测试获取性能。
+    实现了mailclients和asyncimap用到的IMAP4rev1子集：LOGIN、ID、COMPRESS=DEFLATE、LIST、STATUS、
+    SELECT/EXAMINE、SEARCH、FETCH（含BODYSTRUCTURE、BODY.PEEK[section]<partial>）、IDLE、NOOP。
+    响应延迟、带宽和限流由ServerProfile配置，服务器端计数见stats。
+
+    with LocalIMAPServer({'INBOX': generate_corpus(100)}) as server:
+        client = IMAPClientFactory.get_client('gmail', '127.0.0.1', server.port, 'me@gmail.com', 'pw', False)
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, folders, profile=None, host='127.0.0.1', port=0):
+        """
+        :param folders: 字典{文件夹名: 邮件原始数据列表}，文件夹名可以是中文
+        :param profile: ServerProfile
+        """
+        super().__init__((host, port), IMAPSession)
+        self.profile = profile or ServerProfile()
+        self.mailboxes = {EmailUtils.encode_modified_utf7(name): Mailbox(name, messages)
+                          for name, messages in folders.items()}
+        self.uid_validity = int(time.time())
+        self.stats = ServerStats()
+        self.limiter = RateLimiter(self.profile.bandwidth)
+        self.thread = None
+        self._fetch_count = 0
+        self._lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        """在后台线程中开始服务，返回self"""
+        self.thread = threading.Thread(target=self.serve_forever, name='LocalIMAPServer', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def mailbox(self, name):
+        """按客户端发送的文件夹名（Modified UTF-7）查找文件夹，不存在时为None"""
+        if name.upper() == 'INBOX':
+            name = next((key for key in self.mailboxes if key.upper() == 'INBOX'), name)
+        # mailclients发送的Modified UTF-7把','写成了'/'
+        return self.mailboxes.get(name) or self.mailboxes.get(name.replace('/', ','))
+
+    def append(self, folder, raw):
+        """向文件夹追加一封新邮件，正在IDLE的连接会收到EXISTS"""
+        return self.mailboxes[EmailUtils.encode_modified_utf7(folder)].append(raw)
+
+    def capabilities(self):
+        capabilities = ['IMAP4rev1', 'UIDPLUS', 'ID', 'LITERAL+']
+        if self.profile.idle:
+            capabilities.append('IDLE')
+        if self.profile.compress:
+            capabilities.append('COMPRESS=DEFLATE')
+        if self.profile.condstore:
+            capabilities.append('CONDSTORE')
+        if self.profile.gmail:
+            capabilities.append('X-GM-EXT-1')
+        return ' '.join(capabilities)
+
+    def should_throttle(self):
+        """按throttle_every决定本条FETCH是否被限流"""
+        if self.profile.throttle_every <= 0:
+            return False
+        with self._lock:
+            self._fetch_count += 1
+            return self._fetch_count % self.profile.throttle_every == 0
+
+
+class InflatingReader:
+    """COMPRESS=DEFLATE启用后客户端发来的数据流"""
+
+    def __init__(self, file):
+        self.file = file
+        self.decompressor = zlib.decompressobj(-15)
+        self.buffer = bytearray()
+
+    def _more(self):
+        chunk = self.file.read1(INFLATE_READ_SIZE)
+        if not chunk:
+            return False
+        self.buffer += self.decompressor.decompress(chunk)
+        return True
+
+    def readline(self):
+        while b'\n' not in self.buffer and self._more():
+            pass
+        end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+        line = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        return line
+
+    def read(self, size):
+        while len(self.buffer) < size and self._more():
+            pass
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+class IMAPSession(socketserver.StreamRequestHandler):
+    """
+    一个客户端连接。读取线程把收到的命令连同到达时间放入队列，处理线程在到达时间加latency之后处理，
+    所以流水线发送的多条命令只等待一次往返时间
+    """
+
+    def setup(self):
+        super().setup()
+        self.profile = self.server.profile
+        self.stats = self.server.stats
+        self.commands = queue.Queue()
+        self.write_lock = threading.Lock()
+        self.compressor = None
+        self.selected = None
+        self.exists = 0  # 已向客户端报告的邮件数
+
+    def handle(self):
+        self.stats.add(sessions=1)
+        self.write(b'* OK [CAPABILITY ' + self.server.capabilities().encode() + b'] MDLStore local IMAP ready\r\n')
+        threading.Thread(target=self.read_commands, daemon=True).start()
+        while True:
+            item = self.commands.get()
+            if item is None:
+                return
+            arrival, command = item
+            delay = arrival + self.profile.latency - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                if not self.dispatch(command):
+                    return
+            except OSError:
+                return
+
+    def read_commands(self):
+        """读取线程：按行读取命令，处理literal，COMPRESS命令之后改为解压读取"""
+        reader = self.rfile
+        try:
+            while True:
+                line = reader.readline()
+                if not line:
+                    break
+                command = []
+                match = COMMAND_LITERAL_RE.search(line)
+                while match:
+                    if not match.group(2):
+                        self.write(b'+ Ready for literal data\r\n')
+                    literal = reader.read(int(match.group(1)))
+                    command.append((line[:match.start()] + b'{' + match.group(1) + b'}', literal))
+                    line = reader.readline()
+                    match = COMMAND_LITERAL_RE.search(line)
+                command.append(line)
+                self.commands.put((time.monotonic(), command))
+                if (self.profile.compress and not isinstance(reader, InflatingReader) and
+                        re.match(rb'\S+ COMPRESS DEFLATE\r?\n$', line, re.I)):
+                    # 客户端收到OK之后才发送压缩数据，COMPRESS之后的内容都需要解压
+                    reader = InflatingReader(reader)
+        except (OSError, ValueError, zlib.error):
+            pass
+        self.commands.put(None)
+
+    def write(self, data):
+        with self.write_lock:
+            plain = len(data)
+            if self.compressor is not None:
+                data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.server.limiter.consume(len(data))
+            self.wfile.write(data)
+        self.stats.add(bytes_out=plain, wire_bytes_out=len(data))
+
+    def respond(self, tag, status, text):
+        self.write(f'{tag} {status} {text}\r\n'.encode())
+
+    def dispatch(self, command):
+        """
+        处理一条命令
+        :param command: [(前缀, literal), ..., 最后一行]
+        :return: 为False时关闭连接
+        """
+        self.stats.add(commands=1)
+        tokens = parse_sexp(command)
+        if len(tokens) < 2 or not isinstance(tokens[0], str) or not isinstance(tokens[1], str):
+            self.write(b'* BAD Invalid command\r\n')
+            return True
+        tag, name, args = tokens[0], tokens[1].upper(), tokens[2:]
+        # 命令名之后的原始文本，FETCH数据项按文本解析
+        text = b''.join(item[0] if isinstance(item, tuple) else item for item in command).decode('utf-8', 'replace')
+        text = text.split(None, 2)[2].strip() if len(text.split(None, 2)) > 2 else ''
+        handler = getattr(self, f'cmd_{name.lower()}', None)
+        if handler is None:
+            self.respond(tag, 'BAD', f'Unknown command {name}')
+            return True
+        try:
+            return handler(tag, args, text) is not False
+        except (IndexError, KeyError, ValueError, TypeError) as e:
+            self.respond(tag, 'BAD', f'{name} failed: {e}')
+            return True
+
+    def cmd_capability(self, tag, args, text):
+        self.write(f'* CAPABILITY {self.server.capabilities()}\r\n'.encode())
+        self.respond(tag, 'OK', 'CAPABILITY completed')
+
+    def cmd_login(self, tag, args, text):
+        self.respond(tag, 'OK', 'LOGIN completed')
+
+    def cmd_id(self, tag, args, text):
+        self.write(b'* ID ("name" "MDLStore local IMAP")\r\n')
+        self.respond(tag, 'OK', 'ID completed')
+
+    def cmd_noop(self, tag, args, text):
+        self.report_exists()
+        self.respond(tag, 'OK', 'NOOP completed')
+
+    def cmd_logout(self, tag, args, text):
+        self.write(b'* BYE logging out\r\n')
+        self.respond(tag, 'OK', 'LOGOUT completed')
+        return False
+
+    def cmd_compress(self, tag, args, text):
+        if not self.profile.compress or self.compressor is not None:
+            self.respond(tag, 'NO', '[COMPRESSIONACTIVE] compression unavailable')
+            return
+        self.respond(tag, 'OK', 'DEFLATE active')
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+
+    def cmd_list(self, tag, args, text):
+        for name in self.server.mailboxes:
+            self.write(f'* LIST (\\HasNoChildren) "/" "{name}"\r\n'.encode())
+        self.respond(tag, 'OK', 'LIST completed')
+
+    def cmd_status(self, tag, args, text):
+        mailbox = self.server.mailbox(args[0])
+        if mailbox is None:
+            self.respond(tag, 'NO', 'No such mailbox')
+            return
+        values = {'MESSAGES': len(mailbox.messages), 'UIDNEXT': mailbox.uid_next, 'RECENT': 0, 'UNSEEN': 0,
+                  'UIDVALIDITY': self.server.uid_validity}
+        if self.profile.condstore:
+            values['HIGHESTMODSEQ'] = mailbox.modseq
+        items = ' '.join(f'{item.upper()} {values[item.upper()]}' for item in args[1] if item.upper() in values)
+        self.write(f'* STATUS "{args[0]}" ({items})\r\n'.encode())
+        self.respond(tag, 'OK', 'STATUS completed')
+
+    def cmd_select(self, tag, args, text, readonly=False):
+        mailbox = self.server.mailbox(args[0])
+        if mailbox is None:
+            self.selected = None
+            self.respond(tag, 'NO', 'No such mailbox')
+            return
+        self.selected = mailbox
+        self.exists = len(mailbox.messages)
+        lines = ['* FLAGS (\\Seen \\Answered \\Flagged \\Deleted \\Draft)', f'* {self.exists} EXISTS', '* 0 RECENT',
+                 f'* OK [UIDVALIDITY {self.server.uid_validity}] UIDs valid',
+                 f'* OK [UIDNEXT {mailbox.uid_next}] Predicted next UID']
+        if self.profile.condstore:
+            lines.append(f'* OK [HIGHESTMODSEQ {mailbox.modseq}] Highest')
+        self.write(('\r\n'.join(lines) + '\r\n').encode())
+        self.respond(tag, 'OK', '[READ-ONLY] EXAMINE completed' if readonly else '[READ-WRITE] SELECT completed')
+
+    def cmd_examine(self, tag, args, text):
+        return self.cmd_select(tag, args, text, readonly=True)
+
+    def cmd_close(self, tag, args, text):
+        self.selected = None
+        self.respond(tag, 'OK', 'CLOSE completed')
+
+    cmd_unselect = cmd_close
+
+    def cmd_idle(self, tag, args, text):
+        if self.selected is None:
+            self.respond(tag, 'BAD', 'No mailbox selected')
+            return
+        self.write(b'+ idling\r\n')
+        while True:
+            try:
+                item = self.commands.get(timeout=0.05)
+            except queue.Empty:
+                self.report_exists()
+                continue
+            if item is None:
+                return False
+            line = item[1][-1]
+            if line.strip().upper() == b'DONE':
+                break
+        self.respond(tag, 'OK', 'IDLE terminated')
+
+    def report_exists(self):
+        """已选中文件夹有新邮件时发送EXISTS"""
+        if self.selected is not None and len(self.selected.messages) != self.exists:
+            self.exists = len(self.selected.messages)
+            self.write(f'* {self.exists} EXISTS\r\n'.encode())
+
+    def cmd_uid(self, tag, args, text):
+        sub = args[0].upper()
+        rest = text.split(None, 1)[1] if len(text.split(None, 1)) > 1 else ''
+        if sub == 'SEARCH':
+            return self.cmd_search(tag, args[1:], rest, uid=True)
+        if sub == 'FETCH':
+            return self.cmd_fetch(tag, args[1:], rest, uid=True)
+        self.respond(tag, 'BAD', f'UID {sub} not supported')
+
+    def cmd_search(self, tag, args, text, uid=False):
+        if self.selected is None:
+            self.respond(tag, 'BAD', 'No mailbox selected')
+            return
+        if args and str(args[0]).upper() == 'CHARSET':
+            if not self.profile.charset_search or str(args[1]).upper() not in ('UTF-8', 'US-ASCII'):
+                self.respond(tag, 'NO', '[BADCHARSET (US-ASCII)] charset not supported')
+                return
+            args = args[2:]
+        matcher = SearchMatcher(self.selected)
+        predicates = matcher.parse(list(args))
+        uids = [uid_ for uid_ in range(1, len(self.selected.messages) + 1)
+                if all(predicate(uid_) for predicate in predicates)]
+        self.write(('* SEARCH' + ''.join(f' {uid_}' for uid_ in uids) + '\r\n').encode())
+        self.respond(tag, 'OK', f'{"UID " if uid else ""}SEARCH completed')
+
+    def cmd_fetch(self, tag, args, text, uid=False):
+        if self.selected is None:
+            self.respond(tag, 'BAD', 'No mailbox selected')
+            return
+        self.stats.add(fetch_commands=1)
+        if self.server.should_throttle():
+            self.stats.add(throttled=1)
+            self.respond(tag, 'NO', '[THROTTLED] Too many requests, try again later')
+            return
+        uid_set, _, items_text = text.partition(' ')
+        items = parse_fetch_items(items_text)
+        if uid and not any(item[0] == 'UID' for item in items):
+            items.insert(0, ('UID', None, None, None))
+        for uid_ in self.selected.parse_set(uid_set):
+            self.write(self.fetch_response(uid_, items))
+        self.respond(tag, 'OK', f'{"UID " if uid else ""}FETCH completed')
+
+    def fetch_response(self, uid, items):
+        """一封邮件的FETCH响应，整封拼好后一次写出"""
+        mailbox = self.selected
+        parts = []
+        for name, section, offset, length in items:
+            if name == 'UID':
+                parts.append(f'UID {uid}'.encode())
+            elif name == 'FLAGS':
+                parts.append(b'FLAGS (\\Seen)')
+            elif name == 'INTERNALDATE':
+                parts.append(mailbox.date(uid).strftime('INTERNALDATE "%d-%b-%Y %H:%M:%S %z"').encode())
+            elif name == 'RFC822.SIZE':
+                parts.append(f'RFC822.SIZE {len(mailbox.raw(uid))}'.encode())
+            elif name == 'MODSEQ':
+                parts.append(f'MODSEQ ({mailbox.modseq})'.encode())
+            elif name == 'X-GM-MSGID' and self.profile.gmail:
+                message_id = str(mailbox.parsed(uid)['Message-ID']).encode()
+                parts.append(f'X-GM-MSGID {int(hashlib.sha1(message_id).hexdigest()[:15], 16)}'.encode())
+            elif name in ('BODYSTRUCTURE', 'BODY') and section is None:
+                parts.append(f'{name} {body_structure(mailbox.parsed(uid))}'.encode())
+            elif name in ('RFC822', 'RFC822.HEADER', 'RFC822.TEXT'):
+                data = message_section(mailbox, uid, {'RFC822': '', 'RFC822.HEADER': 'HEADER',
+                                                      'RFC822.TEXT': 'TEXT'}[name])
+                if name == 'RFC822':
+                    self.stats.add(messages_served=1)
+                parts.append(f'{name} {{{len(data)}}}\r\n'.encode() + data)
+            elif section is not None:
+                data = message_section(mailbox, uid, section)
+                if section == '' and offset is None:
+                    self.stats.add(messages_served=1)
+                label = f'BODY[{section}]'
+                if offset is not None:
+                    data = data[offset:offset + length]
+                    label += f'<{offset}>'
+                parts.append(f'{label} {{{len(data)}}}\r\n'.encode() + data)
+        return f'* {uid} FETCH ('.encode() + b' '.join(parts) + b')\r\n'
+
+
+class SearchMatcher:
+    """把SEARCH条件解析为判断函数列表，支持mailclients发送的条件以及NOT、OR和括号"""
+
+    def __init__(self, mailbox):
+        self.mailbox = mailbox
+
+    def parse(self, tokens):
+        predicates = []
+        while tokens:
+            predicates.append(self.parse_key(tokens))
+        return predicates
+
+    def parse_key(self, tokens):
+        token = tokens.pop(0)
+        mailbox = self.mailbox
+        if isinstance(token, list):
+            predicates = self.parse(token)
+            return lambda uid: all(predicate(uid) for predicate in predicates)
+        key = token.upper()
+        if key == 'ALL':
+            return lambda uid: True
+        if key == 'NOT':
+            predicate = self.parse_key(tokens)
+            return lambda uid: not predicate(uid)
+        if key == 'OR':
+            first, second = self.parse_key(tokens), self.parse_key(tokens)
+            return lambda uid: first(uid) or second(uid)
+        if key == 'UID':
+            uids = set(mailbox.parse_set(tokens.pop(0)))
+            return lambda uid: uid in uids
+        if key in ('SINCE', 'BEFORE', 'ON', 'SENTSINCE', 'SENTBEFORE', 'SENTON'):
+            day = datetime.strptime(tokens.pop(0), '%d-%b-%Y').date()
+            compare = {'SINCE': lambda d: d >= day, 'BEFORE': lambda d: d < day, 'ON': lambda d: d == day}[
+                key.replace('SENT', '')]
+            return lambda uid: compare(mailbox.date(uid).date())
+        if key in ('FROM', 'TO', 'CC', 'SUBJECT'):
+            value = (tokens.pop(0) or '').lower()
+            return lambda uid: value in str(mailbox.parsed(uid)[key] or '').lower()
+        if key in ('LARGER', 'SMALLER'):
+            size = int(tokens.pop(0))
+            if key == 'LARGER':
+                return lambda uid: len(mailbox.raw(uid)) > size
+            return lambda uid: len(mailbox.raw(uid)) < size
+        if key in ('SEEN', 'OLD'):
+            return lambda uid: True
+        if key in ('UNSEEN', 'NEW', 'RECENT', 'DELETED', 'FLAGGED', 'ANSWERED', 'DRAFT'):
+            return lambda uid: False
+        if key[0].isdigit() or key[0] == '*':
+            uids = set(mailbox.parse_set(key))
+            return lambda uid: uid in uids
+        raise ValueError(f'unsupported search key {key}')
+
+
+def parse_fetch_items(text):
+    """
+    解析FETCH数据项
+    :return: [(名称, section, 起始偏移, 长度)]，section为None表示不是BODY[...]形式
+    """
+    items = []
+    for match in FETCH_ITEM_RE.finditer(text):
+        body, section, offset, length, atom = match.groups()
+        if body:
+            items.append(('BODY', section.upper() if section.upper().startswith('HEADER') else section,
+                          int(offset) if offset else None, int(length) if length else None))
+        elif atom.upper() in FETCH_MACROS:
+            items.extend((name, None, None, None) for name in FETCH_MACROS[atom.upper()])
+        else:
+            items.append((atom.upper(), None, None, None))
+    return items
+
+
+def split_part(part):
+    """MIME部分序列化后的(头部, 正文)，与BODYSTRUCTURE中的大小一致"""
+    data = part.as_bytes(policy=policy.SMTP)
+    header, _, body = data.partition(b'\r\n\r\n')
+    return header + b'\r\n\r\n', body
+
+
+def message_section(mailbox, uid, section):
+    """
+    BODY[section]的内容
+    :param section: ''、'HEADER'、'TEXT'、'HEADER.FIELDS (FROM SUBJECT)'、'1.2'、'2.MIME'等
+    """
+    raw = mailbox.raw(uid)
+    if section == '':
+        return raw
+    header, _, body = raw.partition(b'\r\n\r\n')
+    if section == 'HEADER':
+        return header + b'\r\n\r\n'
+    if section == 'TEXT':
+        return body
+    if section.startswith('HEADER.FIELDS'):
+        negate = section.startswith('HEADER.FIELDS.NOT')
+        names = {name.upper() for name in section[section.index('(') + 1:section.rindex(')')].split()}
+        lines = re.split(rb'\r\n(?![ \t])', header)
+        kept = [line for line in lines if (line.split(b':', 1)[0].decode(errors='replace').upper() in names) != negate]
+        return b''.join(line + b'\r\n' for line in kept) + b'\r\n'
+    mime = section.endswith('.MIME')
+    path = section[:-5] if mime else section
+    part = mailbox.parsed(uid)
+    for number in path.split('.'):
+        if part.is_multipart():
+            part = part.get_payload()[int(number) - 1]
+        elif int(number) != 1:
+            raise ValueError(f'no such part {section}')
+    part_header, part_body = split_part(part)
+    return part_header if mime else part_body
+
+
+def quote(value):
+    if value is None:
+        return 'NIL'
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def body_structure(part):
+    """生成BODYSTRUCTURE，非multipart部分按基本类型或文本类型描述"""
+    if part.is_multipart():
+        children = ''.join(body_structure(child) for child in part.get_payload())
+        return (f'({children} {quote(part.get_content_subtype().upper())} '
+                f'("boundary" {quote(part.get_boundary())}) NIL NIL)')
+    _, body = split_part(part)
+    params = ' '.join(f'{quote(key)} {quote(value)}' for key, value in part.get_params()[1:])
+    params = f'({params})' if params else 'NIL'
+    disposition = part.get_content_disposition()
+    filename = part.get_filename()
+    if disposition and filename:
+        disposition = f'({quote(disposition)} ("filename" {quote(filename)}))'
+    elif disposition:
+        disposition = f'({quote(disposition)} NIL)'
+    else:
+        disposition = 'NIL'
+    encoding = part.get('Content-Transfer-Encoding', '7bit')
+    lines = f' {body.count(NEWLINE)}' if part.get_content_maintype() == 'text' else ''
+    return (f'({quote(part.get_content_maintype().upper())} {quote(part.get_content_subtype().upper())} '
+            f'{params} NIL NIL {quote(encoding)} {len(body)}{lines} NIL {disposition} NIL NIL)')
@@ -1,4 +1,6 @@
 import os
+import threading
+
 import docx2txt
 import jieba
 from whoosh import index
@@ -14,10 +16,12 @@ import openpyxl
 import thulac
 from whoosh.query import Term, Or, Phrase, And
 
-from MDLStore.utils import EmailParser
+from MDLStore.utils import EmailParser, RawMessage
 
 # 清华智能中文分词器
 thu = thulac.thulac(seg_only=True)
+# Whoosh同一时间只允许一个writer，并发的备份任务写索引时需要排队
+index_writer_lock = threading.Lock()
 class CustomTokenizer:
     @staticmethod
     def enumerate_splits(text_, start=0):
@@ -135,10 +139,9 @@ class FileReader:
 
     @staticmethod
     def read_eml(file_path):
-        with open(file_path, 'rb') as file:
-            raw_email = file.read()
-        email_parser = EmailParser(raw_email)
-        body_parts = email_parser.get_body()
+        # 只需要正文，附件内容留在文件映射中不解码
+        with RawMessage(file_path) as raw_email:
+            body_parts = EmailParser(raw_email).get_body()
         len_body = len(body_parts)
         if len_body == 0:
             return ""
@@ -258,19 +261,20 @@ class IndexManager:
         # 使用清理后的内容
         content = clean_content(content)
 
-        writer = self.ix.writer()
-
-        # print(file_info)
-        writer.update_document(
-            attachment_id=file_info.attachment_id,
-            email_id=file_info.email_id,
-            filename=file_info.filename,
-            attachment_type=file_info.attachment_type,
-            file_path=file_info.file_path,
-            content=content
-        )
-        # writer.commit(optimize=True)
-        writer.commit()
+        with index_writer_lock:
+            writer = self.ix.writer()
+
+            # print(file_info)
+            writer.update_document(
+                attachment_id=file_info.attachment_id,
+                email_id=file_info.email_id,
+                filename=file_info.filename,
+                attachment_type=file_info.attachment_type,
+                file_path=file_info.file_path,
+                content=content
+            )
+            # writer.commit(optimize=True)
+            writer.commit()
         # 打印索引构建信息
         print(f"Indexed: {file_info.attachment_id}")
 
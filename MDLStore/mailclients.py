@@ -1,13 +1,31 @@
 import codecs
+import configparser
 import email
 import imaplib
 import os
+import queue
+import random
+import re
+import select
+import shutil
+import socket
+import ssl
 import sys
+import tempfile
+import threading
+import time
+import zlib
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import partial
+from typing import Optional
+from email import policy
 from email.header import decode_header
 from email.utils import parsedate_to_datetime
 
-from MDLStore.utils import EmailUtils
+from MDLStore.bodystructure import parse_sexp, find_bodystructure, parse_bodystructure, assemble_message
+from MDLStore.utils import EmailUtils, SearchQuery
 
 # module_path = os.path.dirname(os.path.abspath(__file__))
 
@@ -23,8 +41,309 @@ temp_dir = os.path.join(module_path, 'tempdata')
 if not os.path.exists(temp_dir):
     os.makedirs(temp_dir)
 
+# 按邮箱账户覆盖获取参数，每个账户一节，例如[me@example.com] compress = false
+account_ini_path = os.path.join(module_path, 'configs', 'accounts.ini')
+
+DEFLATE_READ_SIZE = 64 * 1024  # 压缩生效后每次从连接读取的字节数
+
+# 从FETCH响应中提取UID和RFC822.SIZE
+FETCH_UID_RE = re.compile(rb'UID (\d+)')
+FETCH_SIZE_RE = re.compile(rb'RFC822\.SIZE (\d+)')
+# FETCH响应中一封邮件的开始，如b'12 (UID 345 ...'
+FETCH_START_RE = re.compile(rb'^\d+ \(')
+# STATUS响应中的数据项，如b'MESSAGES 12'
+STATUS_ITEM_RE = re.compile(rb'([A-Z]+) (\d+)')
+# Gmail扩展的邮件标识，同一封邮件在各标签中相同
+FETCH_GM_MSGID_RE = re.compile(rb'X-GM-MSGID (\d+)')
+# IDLE、NOOP期间服务器报告的邮件数变化
+UNTAGGED_EXISTS_RE = re.compile(rb'^\* \d+ EXISTS')
+# 服务器限流的提示：RFC 5530的响应码，以及QQ、网易等服务商NO、BYE响应中常见的文字
+THROTTLE_RE = re.compile(r'THROTTL|\[LIMIT\]|\[UNAVAILABLE\]|\[INUSE\]|too many|rate limit|try again later|'
+                         r'server busy|system busy|频繁|稍后', re.I)
+MAX_BATCH_DIVISOR = 16  # 限流后每批获取数量最多缩小到原来的1/16
+# FETCH响应中literal对应的数据项名称，如b' BODY[1.2.MIME] {345}'
+FETCH_SECTION_RE = re.compile(rb'BODY\[([^\]]*)\](?:<\d+>)? \{\d+\}$')
+# 分块获取到达邮件末尾时，部分服务器不用空literal而用""或NIL表示没有数据
+FETCH_EMPTY_BODY_RE = re.compile(rb'BODY\[\]<\d+> (?:""|NIL)')
+
+
+@dataclass
+class FolderSyncMark:
+    """
+    文件夹的增量同步标记。saveEmails根据uid_validity和last_uid只获取新邮件，获取结束后更新这两个字段
+    """
+    folder: str
+    uid_validity: Optional[int] = None  # 上次备份时文件夹的UIDVALIDITY
+    last_uid: int = 0  # 已备份的最大UID，0表示全量同步
+    # 上次完整备份前文件夹的STATUS，未记录或上次有邮件获取失败时为None
+    messages: Optional[int] = None
+    uid_next: Optional[int] = None
+    highest_modseq: Optional[int] = None  # 服务器支持CONDSTORE时才有
+
+    def compare_status(self, status):
+        """
+        将文件夹当前的STATUS与上次完整备份时的记录比较
+        :param status: IMAPClientBase.folder_status的返回值
+        :return: 'unchanged'表示完全没有变化；'flags'表示UIDNEXT未变，只有标记变化或邮件被删除，没有新邮件；
+        'new'表示可能有新邮件或无法判断
+        """
+        if not status or self.uid_next is None or self.uid_validity is None:
+            return 'new'
+        if status.get('UIDVALIDITY') != self.uid_validity or status.get('UIDNEXT') != self.uid_next:
+            return 'new'
+        modseq = status.get('HIGHESTMODSEQ')
+        if status.get('MESSAGES') == self.messages and (modseq is None or self.highest_modseq is None or
+                                                        modseq == self.highest_modseq):
+            return 'unchanged'
+        return 'flags'
+
+    def record_status(self, status):
+        """记录本次备份前的STATUS，下次据此跳过未变化的文件夹；传入None清除记录"""
+        status = status or {}
+        self.messages = status.get('MESSAGES')
+        self.uid_next = status.get('UIDNEXT')
+        self.highest_modseq = status.get('HIGHESTMODSEQ')
+
+
+class TempAreaSink:
+    """
+    saveEmails默认的邮件接收端：按邮箱文件夹结构把邮件原始数据保存到临时数据区，每封邮件一个EML文件
+    """
+
+    def __init__(self, username):
+        self.base_dir = os.path.join(temp_dir, username)
+
+    def __call__(self, folder, uid, raw_email):
+        email_dir = os.path.join(self.base_dir, folder)
+        os.makedirs(email_dir, exist_ok=True)
+        with open(os.path.join(email_dir, f"email{uid}.eml"), 'wb') as f:
+            if isinstance(raw_email, bytes):
+                f.write(raw_email)
+            else:
+                shutil.copyfileobj(raw_email, f)
+
+
+class MessageDeduper:
+    """
+    同一备份任务各文件夹之间的下载前去重。Gmail的标签、[Gmail]/All Mail以及已发送、归档中的副本是同一封邮件，
+    按X-GM-MSGID（Gmail）或Message-ID识别。第一个认领的文件夹下载邮件，其余文件夹只记录为该邮件的所属文件夹。
+    各文件夹并行获取时由多个线程共享
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.copies = {}  # 去重键 -> (Message-ID, 认领的文件夹, 所在的全部文件夹)
+        self.skipped = 0
+
+    def claim(self, folder, uid, key, message_id=None):
+        """
+        认领一封邮件
+        :param key: IMAPClientBase.fetch_message_keys得到的去重键，为None时无法去重
+        :return: 需要下载时返回True，已由其他文件夹认领时返回False
+        """
+        if key is None:
+            return True
+        with self.lock:
+            copies = self.copies.get(key)
+            if copies is None:
+                self.copies[key] = (message_id, folder, [folder])
+                return True
+            if folder == copies[1]:
+                # 同一文件夹中Message-ID相同的是不同的邮件，照常下载
+                return True
+            if folder not in copies[2]:
+                copies[2].append(folder)
+            self.skipped += 1
+            return False
+
+    def memberships(self):
+        """
+        :return: {Message-ID: 文件夹列表}，只包含出现在多个文件夹中的邮件
+        """
+        with self.lock:
+            return {message_id: list(folders) for message_id, owner, folders in self.copies.values()
+                    if message_id and len(folders) > 1}
+
+
+class SocketReader:
+    """
+    替代imaplib中socket.makefile('rb')的读缓冲。makefile得到的文件在socket超时一次后就不能再读，
+    IDLE需要限时等待服务器推送，所以自行缓冲，由wait_readable()判断是否有数据可读
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+
+    def _fill(self):
+        chunk = self.sock.recv(DEFLATE_READ_SIZE)
+        self.buffer += chunk
+        return len(chunk)
+
+    def _take(self, size):
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def read1(self, size=-1):
+        if not self.buffer:
+            self._fill()
+        return self._take(len(self.buffer) if size < 0 else size)
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            if not self._fill():
+                break
+        return self._take(size)
+
+    def readline(self, limit=-1):
+        start = 0
+        while True:
+            end = self.buffer.find(b'\n', start)
+            if end >= 0:
+                end += 1
+                break
+            if 0 <= limit <= len(self.buffer):
+                end = limit
+                break
+            start = len(self.buffer)
+            if not self._fill():
+                end = len(self.buffer)
+                break
+        if 0 <= limit < end:
+            end = limit
+        return self._take(end)
+
+    def wait_readable(self, timeout):
+        """
+        等待服务器数据，最多timeout秒
+        :return: 缓冲区或连接中有数据可读时为True
+        """
+        if self.buffer or (hasattr(self.sock, 'pending') and self.sock.pending()):
+            return True
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        return bool(readable)
+
+    def close(self):
+        pass
+
+
+class DeflateTransport:
+    """
+    RFC 4978 COMPRESS=DEFLATE，作为imaplib.IMAP4、IMAP4_SSL的混入类。start_deflate()之后收发的数据都经过
+    原始deflate流（无zlib头），同时统计线路上的字节数和压缩前的字节数。连接的读缓冲使用SocketReader，
+    支持IDLE限时等待
+    """
+    deflate_active = False
+
+    def open(self, *args, **kwargs):
+        super().open(*args, **kwargs)
+        self.file = SocketReader(self.sock)
+
+    def wait_readable(self, timeout):
+        """等待服务器数据，最多timeout秒，有数据可读时返回True"""
+        if self.deflate_active and self._inflated:
+            return True
+        return self.file.wait_readable(timeout)
+
+    def start_deflate(self):
+        self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self._decompressor = zlib.decompressobj(-15)
+        self._inflated = bytearray()
+        self.wire_bytes_in = 0
+        self.plain_bytes_in = 0
+        self.wire_bytes_out = 0
+        self.plain_bytes_out = 0
+        self.deflate_active = True
+
+    def send(self, data):
+        if self.deflate_active:
+            self.plain_bytes_out += len(data)
+            data = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.wire_bytes_out += len(data)
+        super().send(data)
+
+    def _inflate_more(self):
+        # 从缓冲文件读取而不是直接读socket，COMPRESS的OK响应之后已经读入缓冲区的压缩数据不会丢失
+        chunk = self.file.read1(DEFLATE_READ_SIZE)
+        if not chunk:
+            raise self.abort('socket error: EOF')
+        self.wire_bytes_in += len(chunk)
+        data = self._decompressor.decompress(chunk)
+        self.plain_bytes_in += len(data)
+        self._inflated += data
+
+    def read(self, size):
+        if not self.deflate_active:
+            return super().read(size)
+        while len(self._inflated) < size:
+            self._inflate_more()
+        data = bytes(self._inflated[:size])
+        del self._inflated[:size]
+        return data
+
+    def readline(self):
+        if not self.deflate_active:
+            return super().readline()
+        while True:
+            end = self._inflated.find(b'\n')
+            if end >= 0:
+                break
+            if len(self._inflated) > imaplib._MAXLINE:
+                raise self.error(f"got more than {imaplib._MAXLINE} bytes")
+            self._inflate_more()
+        line = bytes(self._inflated[:end + 1])
+        del self._inflated[:end + 1]
+        return line
+
+
+class DeflateIMAP4(DeflateTransport, imaplib.IMAP4):
+    pass
+
+
+class DeflateIMAP4_SSL(DeflateTransport, imaplib.IMAP4_SSL):
+    pass
+
+
+class ServerThrottled(imaplib.IMAP4.error):
+    """服务器以限流提示拒绝了命令"""
+
+
+def is_throttle_message(message):
+    """错误信息或服务器响应文本是否表示限流"""
+    return bool(THROTTLE_RE.search(message))
+
+
+# 重连后可以继续获取的连接错误：连接被重置或关闭、读写超时、SSL错误和imaplib的连接中断。
+# 其他OSError（如磁盘写入失败、域名解析失败）重连也无法解决，不在其中
+RETRYABLE_ERRORS = (ConnectionError, socket.timeout, ssl.SSLError, imaplib.IMAP4.abort)
+
+
+def is_retryable_error(e):
+    """连接断开、网络超时和限流可以重连后继续获取，其余错误（如认证失败、磁盘已满）直接失败"""
+    if isinstance(e, (ServerThrottled,) + RETRYABLE_ERRORS):
+        return True
+    return isinstance(e, imaplib.IMAP4.error) and is_throttle_message(str(e))
+
 
 class IMAPClientBase(ABC):
+    # 批量获取参数，由IMAPClientFactory按服务商覆盖
+    batch_fetch = True  # 是否启用批量UID FETCH
+    fetch_batch_size = 500  # 每批最多获取的邮件数
+    fetch_batch_bytes = 32 * 1024 * 1024  # 每批按RFC822.SIZE累计的最大字节数
+    size_batch_size = 2000  # 获取RFC822.SIZE时每批的UID数
+    large_message_bytes = 16 * 1024 * 1024  # 超过该大小的邮件分块获取，不整体读入内存
+    fetch_chunk_bytes = 4 * 1024 * 1024  # 分块获取时每块的字节数
+    rate_limiter = None  # 多个任务共享的下载带宽预算，utils.RateLimiter
+    search_charset = True  # 非ASCII搜索条件是否使用CHARSET UTF-8发送，为False时直接在本地校验邮件头
+    compress = True  # 服务器支持COMPRESS=DEFLATE时是否启用压缩传输
+    # 持续同步参数
+    use_idle = True  # 服务器支持IDLE时是否用IDLE等待新邮件，为False时用NOOP轮询
+    watched_exists = None  # watch_folder选中的文件夹最近一次报告的邮件数
+    idle_timeout = 25 * 60  # 每次IDLE的最长秒数，服务器一般在30分钟无活动后断开，需要在此之前重新发送
+    poll_interval = 60  # NOOP轮询的间隔秒数
+    batch_divisor = 1  # 服务器限流后由连接池调高，每批获取的邮件数和字节数按此缩小
+
     def __init__(self, server, port, username, password, ssl=True):
         self.server = server
         self.port = port
@@ -32,33 +351,95 @@ class IMAPClientBase(ABC):
         self.password = password
         self.ssl = ssl
         self.client = None
+        self.capabilities = None  # 登录后的能力列表，由get_capabilities获取并缓存
 
     def connect(self):
         try:
+            # 连接支持COMPRESS=DEFLATE，登录后由start_compression启用
             if self.ssl:
-                self.client = imaplib.IMAP4_SSL(self.server, self.port)
+                self.client = DeflateIMAP4_SSL(self.server, self.port)
             else:
-                self.client = imaplib.IMAP4(self.server, self.port)
+                self.client = DeflateIMAP4(self.server, self.port)
             return True
         except Exception as e:
             print(f"Connection failed: {e}")
             return False
 
     def capability(self):
-        """发送CAPABILITY命令并打印服务器的能力。"""
+        """
+        发送CAPABILITY命令并打印服务器的能力。
+        :return: 大写的能力名称列表，如['IMAP4REV1', 'COMPRESS=DEFLATE']，失败时为空列表
+        """
         typ, data = self.client.capability()
         if typ == 'OK':
             print("Capabilities:", data)
+            return data[-1].decode().upper().split()
         else:
             print("Failed to get capabilities")
+            return []
+
+    def get_capabilities(self):
+        """登录后的能力列表，只查询一次"""
+        if self.capabilities is None:
+            self.capabilities = self.capability()
+        return self.capabilities
+
+    def start_compression(self):
+        """
+        登录后协商COMPRESS=DEFLATE，RFC 4978只允许在认证之后启用。登录前的CAPABILITY通常不包含该能力，
+        所以在这里重新获取
+        :return: 是否已启用压缩
+        """
+        if not self.compress or not isinstance(self.client, DeflateTransport):
+            return False
+        if 'COMPRESS=DEFLATE' not in self.get_capabilities():
+            return False
+        imaplib.Commands['COMPRESS'] = ('AUTH', 'SELECTED')
+        typ, data = self.client._simple_command('COMPRESS', 'DEFLATE')
+        if typ != 'OK':
+            print(f"COMPRESS=DEFLATE启用失败: {data}")
+            return False
+        self.client.start_deflate()
+        print(f'账户{self.username}已启用COMPRESS=DEFLATE')
+        return True
+
+    def log_compression(self):
+        """打印压缩传输的统计：线路上的字节数和解压后的字节数"""
+        if not getattr(self.client, 'deflate_active', False):
+            return
+        client = self.client
+        ratio = client.plain_bytes_in / client.wire_bytes_in if client.wire_bytes_in else 0
+        print(f'账户{self.username} COMPRESS=DEFLATE：接收线路{client.wire_bytes_in}字节，'
+              f'解压后{client.plain_bytes_in}字节（{ratio:.1f}倍）；'
+              f'发送线路{client.wire_bytes_out}字节，压缩前{client.plain_bytes_out}字节')
 
     def authenticate(self):
         pass
 
+    def apply_options(self, options):
+        """
+        应用服务商相关的获取参数，只设置本类已定义的属性
+        :param options: 参数字典，例如{'fetch_batch_size': 100}
+        """
+        for name, value in options.items():
+            if hasattr(self, name):
+                setattr(self, name, value)
+
     @abstractmethod
     def login(self):
         pass
 
+    def get_imap_id(self):
+        """
+        登录后通过ID命令（RFC 2971）发送的客户端标识，网易等服务商要求发送，否则拒绝访问文件夹
+        :return: (键, 值, 键, 值, ...)，不需要发送时为None
+        """
+        return None
+
+    def format_imap_id(self):
+        """ID命令的参数，如'("name" "myclient" "version" "1.0.0")'"""
+        return '("' + '" "'.join(self.get_imap_id()) + '")'
+
     # LIST 命令
     def get_mailbox_list(self):
         """获取并打印邮箱列表。"""
@@ -92,6 +473,7 @@ class IMAPClientBase(ABC):
 
     def disconnect(self):
         if self.client:
+            self.log_compression()
             self.client.logout()
             self.client = None
 
@@ -214,7 +596,8 @@ class IMAPClientBase(ABC):
             #     # 处理非multipart类型的邮件正文
             #     print(msg.get_payload(decode=True).decode())
 
-    def saveEmails(self, folder, criteria, progress_callback=None, info_callback=None):
+    def saveEmails(self, folder, criteria, progress_callback=None, info_callback=None, sync_mark=None,
+                   message_sink=None, part_selector=None, deduper=None):
         """
         将目标文件夹中符合条件的邮件保存到本地。每封邮件保存为一个EML文件。按照邮箱文件夹结构保存.
         比如要备份的zinc@ruc.edu.cn中已发送的邮件。那么目标位置就是有一个zinc@ruc.edu.cn文件夹，
@@ -222,31 +605,52 @@ class IMAPClientBase(ABC):
         :param progress_callback:
         :param info_callback:
         :param folder: 文件夹比如"收件箱","已发送"等
-        :param criteria: SINCE date BEFORE date
+        :param criteria: SearchQuery，或SINCE date BEFORE date形式的搜索条件字符串
+        :param sync_mark: FolderSyncMark增量同步标记，为None时全量获取。批量模式下只获取UID大于last_uid的邮件，
+        UIDVALIDITY变化时自动全量同步，结束后更新标记
+        :param message_sink: 邮件接收端，以(文件夹名, UID, 邮件原始数据)调用，大邮件的原始数据是二进制文件对象，
+        为None时保存到临时数据区
+        :param part_selector: bodystructure.PartSelector，批量模式下只下载选中的MIME部分，为None时下载邮件全文
+        :param deduper: MessageDeduper，批量模式下跳过已在其他文件夹获取的邮件，为None时不去重
         :return: 保存完毕返回True
         """
-        folder = EmailUtils.encode_modified_utf7(folder)
-        # print(f'新文件夹名{folder}')
-        folder_select = f"\"{folder}\""
-        print(f'选中的文件夹名{folder_select}')
-        folder_select = folder_select.replace(',','/')
-        self.client.select(folder_select, readonly=True)
-        # print('搜索邮件')
-        # 搜索邮件
-        status, messages = self.client.search(None, criteria)
+        folder_status = None
+        if sync_mark is not None and self.batch_fetch:
+            folder_status = self.folder_status(folder)
+            if self.skip_unchanged_folder(folder, sync_mark, folder_status):
+                return True
+        status, msg_nums, uid_validity, last_uid = self.search_folder(folder, criteria, sync_mark)
         if status != 'OK':
             print(f"Failed to search emails with criteria: {criteria}")
             return False
 
         # 处理每封邮件
-        msg_nums = messages[0].split()
         # email_dir = os.path.join(self.username, folder)
-        utf8_folder = EmailUtils.decode_modified_utf7(folder)
-        email_dir = os.path.join(temp_dir, self.username, utf8_folder)
-        os.makedirs(email_dir, exist_ok=True)
+        if message_sink is None:
+            message_sink = TempAreaSink(self.username)
 
         total_count = len(msg_nums)
         print(f'共搜索到邮件{total_count}封')
+        if self.batch_fetch:
+            uids = msg_nums
+            wanted_uids = self.claim_messages(folder, uids, deduper) if deduper is not None and uids else uids
+            saved_uids = []
+            try:
+                self.save_emails_batched(wanted_uids, partial(message_sink, folder), progress_callback,
+                                         info_callback, part_selector, saved_uids)
+            finally:
+                # 由其他文件夹下载的副本视为已保存
+                wanted = set(wanted_uids)
+                saved_uids += [uid for uid in uids if uid not in wanted]
+                if sync_mark is not None:
+                    # 连接中途断开时也记录检查点，重连后从检查点继续
+                    sync_mark.uid_validity = uid_validity
+                    sync_mark.last_uid = self.get_checkpoint_uid(uids, saved_uids, last_uid)
+                    # 全部邮件都已保存时才记录STATUS，否则下次不能跳过该文件夹
+                    sync_mark.record_status(folder_status if set(uids) <= set(saved_uids) else None)
+            print(f"Emails saved from {folder}")
+            return True
+
         for i, num in enumerate(msg_nums):
             print(f'正在处理第{i+1}/{total_count}封')
             status, msg_data = self.client.fetch(num, '(RFC822)')
@@ -254,21 +658,754 @@ class IMAPClientBase(ABC):
                 print(f"Failed to fetch email number: {num}")
                 continue
 
+            if self.rate_limiter:
+                self.rate_limiter.consume(len(msg_data[0][1]))
             msg = email.message_from_bytes(msg_data[0][1])
             # msg_subject = msg.get('Subject', 'No_Subject').replace('/', '_')
             # msg_date = msg.get('Date', 'No_Date')
-            msg_filename = f"email{str(num)}.eml"
-
-            with open(os.path.join(email_dir, msg_filename), 'wb') as f:
-                f.write(msg_data[0][1])
+            message_sink(folder, num, msg_data[0][1])
 
             if progress_callback and info_callback:
                 progress_callback.emit(int(((i + 1) / total_count) * 100))
                 info_callback.emit(f'已获取邮件{i}封/{total_count}封')
 
-        print(f"Emails saved to {email_dir}")
+        print(f"Emails saved from {folder}")
         return True
 
+    def claim_messages(self, folder, uids, deduper):
+        """
+        下载前去重：获取各邮件的去重键交给deduper认领，已由其他文件夹认领的邮件不再下载
+        :return: 需要下载的UID列表
+        """
+        keys = self.fetch_message_keys(uids)
+        wanted = [uid for uid in uids if deduper.claim(folder, uid, *keys.get(uid, (None, None)))]
+        if len(wanted) < len(uids):
+            print(f'文件夹{folder}中{len(uids) - len(wanted)}封邮件已在其他文件夹获取，跳过')
+        return wanted
+
+    def message_key_items(self):
+        """获取去重键的FETCH数据项，服务器支持Gmail扩展时加上X-GM-MSGID"""
+        if 'X-GM-EXT-1' in self.get_capabilities():
+            return '(X-GM-MSGID BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])'
+        return '(BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])'
+
+    def fetch_message_keys(self, uids):
+        """
+        批量获取邮件的去重键，只传输Message-ID头
+        :param uids: UID列表
+        :return: 字典{uid: (去重键, Message-ID)}，获取失败的UID不在字典中
+        """
+        keys = {}
+        items = self.message_key_items()
+        for start in range(0, len(uids), self.size_batch_size):
+            chunk = uids[start:start + self.size_batch_size]
+            status, data = self.uid_command('fetch', self.compact_uid_set(chunk), items)
+            if status != 'OK':
+                print(f"Failed to fetch Message-ID: {data}")
+                continue
+            keys.update(self.parse_message_keys(data))
+        return keys
+
+    @classmethod
+    def parse_message_keys(cls, data):
+        """
+        解析X-GM-MSGID和Message-ID的UID FETCH响应。有X-GM-MSGID时以其为去重键，否则用Message-ID
+        :return: 字典{uid: (去重键, Message-ID)}，两者都没有时去重键为None
+        """
+        keys = {}
+        for response in cls.group_fetch_responses(data):
+            uid = gm_msgid = message_id = None
+            for item in response:
+                prefix, literal = item if isinstance(item, tuple) else (item, None)
+                uid_match = FETCH_UID_RE.search(prefix)
+                if uid_match:
+                    uid = int(uid_match.group(1))
+                gm_match = FETCH_GM_MSGID_RE.search(prefix)
+                if gm_match:
+                    gm_msgid = gm_match.group(1).decode()
+                if literal is not None:
+                    message_id = email.message_from_bytes(literal, policy=policy.default).get('Message-ID')
+                    message_id = str(message_id).strip() if message_id else None
+            if uid is None:
+                continue
+            if gm_msgid:
+                key = f'X-GM-MSGID:{gm_msgid}'
+            else:
+                key = f'Message-ID:{message_id}' if message_id else None
+            keys[uid] = (key, message_id)
+        return keys
+
+    @staticmethod
+    def mailbox_name(folder):
+        """SELECT、STATUS等命令使用的文件夹参数：Modified UTF-7编码并加引号"""
+        folder = EmailUtils.encode_modified_utf7(folder)
+        return f"\"{folder}\"".replace(',', '/')
+
+    def folder_status(self, folder):
+        """
+        不选中文件夹，用STATUS获取MESSAGES、UIDNEXT、UIDVALIDITY，服务器支持CONDSTORE时再加HIGHESTMODSEQ
+        :return: 字典，如{'MESSAGES': 12, 'UIDNEXT': 345, 'UIDVALIDITY': 7}，失败时为None
+        """
+        items = ['MESSAGES', 'UIDNEXT', 'UIDVALIDITY']
+        capabilities = self.get_capabilities()
+        if 'CONDSTORE' in capabilities or 'QRESYNC' in capabilities:
+            items.append('HIGHESTMODSEQ')
+        try:
+            status, data = self.client.status(self.mailbox_name(folder), f'({" ".join(items)})')
+        except self.client.error as e:
+            print(f"STATUS失败: {e}")
+            return None
+        if status != 'OK' or not data or not isinstance(data[-1], bytes):
+            return None
+        return self.parse_status(data[-1])
+
+    @staticmethod
+    def parse_status(response):
+        """解析STATUS响应，如b'"INBOX" (MESSAGES 12 UIDNEXT 345)'"""
+        items = response[response.rfind(b'('):]
+        return {name.decode(): int(value) for name, value in STATUS_ITEM_RE.findall(items)}
+
+    @staticmethod
+    def skip_unchanged_folder(folder, sync_mark, folder_status):
+        """
+        根据STATUS判断能否跳过文件夹。UIDNEXT不变说明没有新邮件，只有标记变化或删除时也不需要搜索，
+        备份只增不删，只更新记录的STATUS
+        :return: 可以跳过时返回True
+        """
+        change = sync_mark.compare_status(folder_status)
+        if change == 'unchanged':
+            print(f'文件夹{folder}自上次备份后没有变化，跳过')
+            return True
+        if change == 'flags':
+            print(f'文件夹{folder}只有标记变化或邮件删除，没有新邮件，跳过: {folder_status}')
+            sync_mark.record_status(folder_status)
+            return True
+        return False
+
+    def search_folder(self, folder, criteria, sync_mark=None, use_uid=None):
+        """
+        只读选中文件夹并按条件搜索邮件。有增量同步标记且UIDVALIDITY未变化时只搜索上次备份之后的新邮件
+        :param folder: 文件夹比如"收件箱","已发送"等
+        :param criteria: SearchQuery或搜索条件字符串
+        :param sync_mark: FolderSyncMark，只读取不修改
+        :param use_uid: 是否使用UID搜索，默认与batch_fetch相同；不使用UID时忽略sync_mark
+        :return: (status, 搜索结果, uid_validity, last_uid)。UID搜索时结果为大于last_uid的UID整数列表，否则为序号列表
+        """
+        if use_uid is None:
+            use_uid = self.batch_fetch
+        folder_select = self.mailbox_name(folder)
+        print(f'选中的文件夹名{folder_select}')
+        self.client.select(folder_select, readonly=True)
+        uid_validity = self.get_uid_validity()
+        last_uid = 0
+        uid_range = None
+        if sync_mark is not None and use_uid:
+            if sync_mark.uid_validity is not None and sync_mark.uid_validity != uid_validity:
+                print(f'文件夹{folder_select}的UIDVALIDITY已变化，全量同步')
+            elif sync_mark.last_uid:
+                last_uid = sync_mark.last_uid
+                uid_range = f'{last_uid + 1}:*'
+                print(f'增量同步，从UID {last_uid + 1}开始')
+        # print('搜索邮件')
+        # 搜索邮件，批量模式下使用UID搜索，发件人和主题条件交给服务器过滤
+        if use_uid:
+            status, msg_nums = self.search_messages(criteria, uid_range)
+            # UID n:* 在n大于最大UID时仍会返回最后一封邮件，需要再过滤一次
+            msg_nums = [uid for uid in msg_nums if uid > last_uid]
+        else:
+            if isinstance(criteria, SearchQuery):
+                criteria = criteria.ascii_criteria()
+            status, messages = self.client.search(None, criteria)
+            msg_nums = messages[0].split() if status == 'OK' else []
+        return status, msg_nums, uid_validity, last_uid
+
+    def estimate_folder(self, folder, criteria, sync_mark=None, attachment_selector=None, full_size=True):
+        """
+        预检：不下载邮件内容，统计文件夹中待备份邮件的数据量。邮件全文大小来自RFC822.SIZE，
+        附件大小来自BODYSTRUCTURE中匹配的附件部分，base64编码按解码后的大小计算
+        :param folder: 文件夹
+        :param criteria: SearchQuery或搜索条件字符串
+        :param sync_mark: FolderSyncMark，增量同步时只统计新邮件
+        :param attachment_selector: bodystructure.PartSelector，为None时不统计附件
+        :param full_size: 是否统计邮件全文大小
+        :return: 字典{'messages': 邮件数, 'RFC2822': 全文字节数, 'Attachment': 附件字节数, 'attachments': 附件数}
+        """
+        estimate = {'messages': 0, 'RFC2822': 0, 'Attachment': 0, 'attachments': 0}
+        if sync_mark is not None and sync_mark.compare_status(self.folder_status(folder)) != 'new':
+            return estimate
+        status, uids, uid_validity, last_uid = self.search_folder(folder, criteria, sync_mark, use_uid=True)
+        if status != 'OK':
+            raise RuntimeError(f'文件夹{folder}搜索失败')
+        estimate['messages'] = len(uids)
+        if not uids:
+            return estimate
+        if full_size:
+            estimate['RFC2822'] = sum(self.fetch_message_sizes(uids).values())
+        if attachment_selector is not None:
+            for parts in self.fetch_bodystructures(uids).values():
+                for part in parts:
+                    if attachment_selector.match_attachment(part):
+                        estimate['Attachment'] += part.decoded_size
+                        estimate['attachments'] += 1
+        return estimate
+
+    def save_emails_batched(self, uids, message_handler, progress_callback=None, info_callback=None,
+                            part_selector=None, saved_uids=None):
+        """
+        批量获取邮件并逐封交给message_handler保存。先获取全部邮件的RFC822.SIZE，再按邮件数和累计字节数切分批次，
+        每批发送一次UID FETCH，响应中的每封邮件解析出来后立即交给message_handler。
+        指定part_selector时改为先获取BODYSTRUCTURE，只下载选中的MIME部分，见fetch_selected_parts
+        :param uids: 已选中文件夹内待获取的UID列表
+        :param message_handler: 以(UID, 邮件原始数据)调用的保存函数
+        :param progress_callback:
+        :param info_callback:
+        :param part_selector: bodystructure.PartSelector
+        :param saved_uids: 记录已处理UID的列表，获取中途出错时调用方据此计算检查点
+        :return: 已处理的UID列表，包括不需要下载而跳过的邮件
+        """
+        if saved_uids is None:
+            saved_uids = []
+        total_count = len(uids)
+        if total_count == 0:
+            return saved_uids
+
+        def report():
+            if progress_callback and info_callback:
+                progress_callback.emit(int((len(saved_uids) / total_count) * 100))
+                info_callback.emit(f'已获取邮件{len(saved_uids)}封/{total_count}封')
+
+        def store(uid, raw_email):
+            # 分块获取的大邮件在获取每块时已计入带宽预算
+            if self.rate_limiter and isinstance(raw_email, bytes):
+                self.rate_limiter.consume(len(raw_email))
+            message_handler(uid, raw_email)
+            saved_uids.append(uid)
+            report()
+
+        def skip(uid):
+            saved_uids.append(uid)
+            report()
+
+        if part_selector is not None:
+            self.fetch_selected_parts(uids, part_selector, store, skip)
+            return saved_uids
+
+        self.fetch_full_messages(uids, store)
+        return saved_uids
+
+    def fetch_full_messages(self, uids, message_handler):
+        """
+        获取邮件全文。普通邮件按批次一次UID FETCH获取；超过large_message_bytes的邮件用BODY.PEEK[]<offset.length>
+        分块获取并写入临时文件，以文件对象交给message_handler，内存占用不随邮件大小增长
+        :param uids: UID列表
+        :param message_handler: 以(UID, 邮件原始数据bytes或二进制文件对象)调用
+        :return: 成功获取的UID列表
+        """
+        sizes = self.fetch_message_sizes(uids)
+        large_uids = [uid for uid in uids if sizes.get(uid, 0) > self.large_message_bytes]
+        large = set(large_uids)
+        batches = self.plan_fetch_batches([uid for uid in uids if uid not in large], sizes)
+        print(f'共{len(uids)}封邮件，分{len(batches)}批获取，{len(large_uids)}封大邮件分块获取')
+        fetched = []
+        for batch in batches:
+            fetched += self.fetch_batch(batch, message_handler)
+        for uid in large_uids:
+            spool = self.fetch_large_message(uid, sizes[uid])
+            if spool is None:
+                continue
+            with spool:
+                message_handler(uid, spool)
+            fetched.append(uid)
+        if len(fetched) != len(uids):
+            missing = set(uids) - set(fetched)
+            print(f"Failed to fetch email uids: {sorted(missing)}")
+        return fetched
+
+    def fetch_large_message(self, uid, size):
+        """
+        用BODY.PEEK[]<offset.length>分块获取一封大邮件，依次追加到SpooledTemporaryFile，直到收到不足一块的数据。
+        RFC822.SIZE可能只是近似值，不用来判断是否获取完毕
+        :param uid: 邮件UID
+        :param size: RFC822.SIZE，只用于提示实际大小不同
+        :return: 读写位置在开头的临时文件，获取失败或邮件不完整时返回None，该UID留待下次获取
+        """
+        spool = tempfile.SpooledTemporaryFile(max_size=self.fetch_chunk_bytes)
+        offset = 0
+        while True:
+            status, data = self.uid_command('fetch', str(uid), f'(BODY.PEEK[]<{offset}.{self.fetch_chunk_bytes}>)')
+            if status != 'OK':
+                print(f"Failed to fetch email uid {uid} at offset {offset}: {data}")
+                spool.close()
+                return None
+            chunk = self.partial_body_chunk(data)
+            if chunk is None or (not chunk and offset == 0):
+                print(f"Failed to fetch email uid {uid} at offset {offset}: 响应中没有邮件内容")
+                spool.close()
+                return None
+            if chunk:
+                if self.rate_limiter:
+                    self.rate_limiter.consume(len(chunk))
+                spool.write(chunk)
+                offset += len(chunk)
+            if len(chunk) < self.fetch_chunk_bytes:
+                break
+        if offset != size:
+            print(f'邮件uid {uid}实际大小{offset}字节，RFC822.SIZE为{size}字节')
+        spool.seek(0)
+        return spool
+
+    @staticmethod
+    def partial_body_chunk(data):
+        """
+        BODY.PEEK[]<offset.length>响应中的邮件数据。offset已到邮件末尾时为b''
+        :param data: 响应数据列表
+        :return: bytes，响应中没有BODY[]数据项时为None
+        """
+        for item in data:
+            if isinstance(item, tuple):
+                match = FETCH_SECTION_RE.search(item[0])
+                if match and not match.group(1):
+                    return item[1]
+            elif isinstance(item, bytes) and FETCH_EMPTY_BODY_RE.search(item):
+                return b''
+        return None
+
+    def fetch_selected_parts(self, uids, part_selector, message_handler, skip_handler):
+        """
+        选择性下载：批量获取BODYSTRUCTURE，由part_selector选出需要的MIME部分，不需要任何部分的邮件直接跳过；
+        选中部分相同的邮件合并为一次UID FETCH (BODY.PEEK[HEADER] BODY.PEEK[n.MIME] BODY.PEEK[n] ...)，
+        下载后用原邮件头和选中部分重新组成邮件交给message_handler。只有一个部分的邮件和缺少部分的响应改为下载全文
+        :param uids: UID列表
+        :param part_selector: bodystructure.PartSelector
+        :param message_handler: 以(UID, 邮件原始数据)调用
+        :param skip_handler: 以UID调用，表示该邮件不需要下载
+        """
+        structures = self.fetch_bodystructures(uids)
+        groups = {}
+        sizes = {}
+        full_uids = []
+        for uid in uids:
+            parts = structures.get(uid)
+            if parts is None:
+                full_uids.append(uid)
+                continue
+            selected = part_selector.select(parts)
+            if not selected:
+                skip_handler(uid)
+            elif len(parts) == 1:
+                # 只有一个部分的邮件没有可省略的内容，直接下载全文
+                full_uids.append(uid)
+            else:
+                groups.setdefault(tuple(part.section for part in selected), []).append(uid)
+                sizes[uid] = sum(part.size for part in selected)
+        print(f'选择性下载：{sum(len(group) for group in groups.values())}封下载部分内容，'
+              f'{len(full_uids)}封下载全文，其余跳过')
+
+        for sections, group_uids in groups.items():
+            for batch in self.plan_fetch_batches(group_uids, sizes):
+                items = ['BODY.PEEK[HEADER]']
+                for section in sections:
+                    items += [f'BODY.PEEK[{section}.MIME]', f'BODY.PEEK[{section}]']
+                status, data = self.uid_command('fetch', self.compact_uid_set(batch), f'({" ".join(items)})')
+                if status != 'OK':
+                    print(f"Failed to fetch parts: {data}")
+                    continue
+                for uid, fetched in self.iter_fetch_sections(data):
+                    keys = ['HEADER'] + [f'{section}.MIME' for section in sections] + list(sections)
+                    if any(key not in fetched for key in keys):
+                        full_uids.append(uid)
+                        continue
+                    raw_email = assemble_message(fetched['HEADER'],
+                                                 [(fetched[f'{section}.MIME'], fetched[section])
+                                                  for section in sections])
+                    message_handler(uid, raw_email)
+
+        if full_uids:
+            self.fetch_full_messages(full_uids, message_handler)
+
+    def fetch_bodystructures(self, uids):
+        """
+        批量获取邮件的BODYSTRUCTURE
+        :param uids: UID列表
+        :return: 字典{uid: MimePart列表}，获取或解析失败的UID不在字典中
+        """
+        structures = {}
+        for start in range(0, len(uids), self.size_batch_size):
+            chunk = uids[start:start + self.size_batch_size]
+            status, data = self.uid_command('fetch', self.compact_uid_set(chunk), '(BODYSTRUCTURE)')
+            if status != 'OK':
+                print(f"Failed to fetch BODYSTRUCTURE: {data}")
+                continue
+            for response in self.group_fetch_responses(data):
+                tree = parse_sexp(response)
+                uid = None
+                for item in tree:
+                    if isinstance(item, list):
+                        for index, value in enumerate(item[:-1]):
+                            if isinstance(value, str) and value.upper() == 'UID':
+                                uid = int(item[index + 1])
+                parts = parse_bodystructure(find_bodystructure(tree))
+                if uid is not None and parts:
+                    structures[uid] = parts
+        return structures
+
+    @staticmethod
+    def group_fetch_responses(data):
+        """
+        将imaplib返回的FETCH响应按邮件分组，一封邮件的响应可能由多个(前缀, literal)元组和bytes组成
+        :param data: imaplib返回的响应数据列表
+        :return: 每封邮件一个列表
+        """
+        groups = []
+        for item in data:
+            prefix = item[0] if isinstance(item, tuple) else item
+            if not isinstance(prefix, bytes):
+                continue
+            if FETCH_START_RE.match(prefix) or not groups:
+                groups.append([])
+            groups[-1].append(item)
+        return groups
+
+    @classmethod
+    def iter_fetch_sections(cls, data):
+        """
+        遍历包含多个BODY[section]的UID FETCH响应
+        :param data: imaplib返回的响应数据列表
+        :return: 逐个返回(uid, {section: 数据})，section如'HEADER'、'2'、'2.MIME'
+        """
+        for response in cls.group_fetch_responses(data):
+            uid = None
+            sections = {}
+            for item in response:
+                prefix, literal = item if isinstance(item, tuple) else (item, None)
+                match = FETCH_UID_RE.search(prefix)
+                if match:
+                    uid = int(match.group(1))
+                if literal is not None:
+                    section_match = FETCH_SECTION_RE.search(prefix)
+                    if section_match:
+                        sections[section_match.group(1).decode().upper()] = literal
+            if uid is None:
+                print(f"FETCH响应中缺少UID: {response[0]}")
+                continue
+            yield uid, sections
+
+    def search_messages(self, query, uid_range=None):
+        """
+        按搜索条件执行UID SEARCH。FROM、SUBJECT中的非ASCII关键字以CHARSET UTF-8和literal发送，imaplib每条命令只能带
+        一个literal，其余非ASCII条件在本地校验。服务器拒绝CHARSET或返回空结果时，退回只用ASCII条件搜索，
+        再批量获取候选邮件的From和Subject头，在本地校验后只保留匹配的邮件
+        :param query: SearchQuery或搜索条件字符串
+        :param uid_range: UID范围，如'100:*'，为None时不限制
+        :return: (status, UID整数列表)
+        """
+        if isinstance(query, SearchQuery):
+            criteria = query.ascii_criteria()
+            text_terms = query.non_ascii_terms()
+        else:
+            criteria = query
+            text_terms = []
+        if uid_range:
+            criteria = f'UID {uid_range} {criteria}'
+        if not text_terms:
+            return self.uid_search(criteria)
+
+        if self.search_charset:
+            key, value = text_terms[0]
+            self.client.literal = value.encode('utf-8')
+            status, uids = self.uid_search(f'{criteria} {key}', 'UTF-8')
+            self.client.literal = None
+            if status == 'OK' and uids:
+                if len(text_terms) > 1:
+                    uids = self.filter_by_headers(uids, query)
+                return status, uids
+            print(f'CHARSET UTF-8搜索失败或无结果，改为在本地校验邮件头: {status}')
+
+        # 只用ASCII条件得到候选邮件，再校验邮件头
+        status, uids = self.uid_search(criteria)
+        if status != 'OK':
+            return status, []
+        return status, self.filter_by_headers(uids, query)
+
+    def uid_search(self, criteria, charset=None):
+        """
+        执行一次UID SEARCH
+        :param criteria: 搜索条件字符串
+        :param charset: 搜索条件的字符集，如'UTF-8'
+        :return: (status, UID整数列表)
+        """
+        args = ('CHARSET', charset, criteria) if charset else (None, criteria)
+        try:
+            status, data = self.uid_command('search', *args)
+        except self.client.error as e:
+            print(f"UID SEARCH失败: {e}")
+            return 'NO', []
+        if status != 'OK':
+            return status, []
+        return status, [int(uid) for uid in data[0].split()]
+
+    def filter_by_headers(self, uids, query):
+        """
+        批量获取候选邮件的From和Subject头，只保留满足query邮件头条件的UID。获取失败的批次全部保留，
+        由后续的本地过滤处理
+        :param uids: 候选UID列表
+        :param query: SearchQuery
+        :return: 匹配的UID列表
+        """
+        matched = []
+        for start in range(0, len(uids), self.size_batch_size):
+            chunk = uids[start:start + self.size_batch_size]
+            status, data = self.uid_command('fetch', self.compact_uid_set(chunk),
+                                           '(BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)])')
+            if status != 'OK':
+                print(f"Failed to fetch headers: {data}")
+                matched.extend(chunk)
+                continue
+            for uid, header in self.iter_fetch_literals(data):
+                msg = email.message_from_bytes(header, policy=policy.default)
+                if query.matches(str(msg.get('From', '')), str(msg.get('Subject', ''))):
+                    matched.append(uid)
+        print(f'本地校验邮件头，{len(uids)}封候选邮件中{len(matched)}封匹配')
+        return sorted(matched)
+
+    def get_uid_validity(self):
+        """
+        获取当前选中文件夹的UIDVALIDITY，需在select之后调用
+        :return: 整数，服务器未返回时为None
+        """
+        typ, data = self.client.response('UIDVALIDITY')
+        if data and data[0] is not None:
+            return int(data[-1])
+        return None
+
+    @staticmethod
+    def get_checkpoint_uid(uids, saved_uids, last_uid=0):
+        """
+        计算可以安全记录的最大UID：不大于该UID的待获取邮件都已保存，获取失败的邮件下次仍会重新获取
+        :param uids: 待获取的UID列表
+        :param saved_uids: 已保存的UID列表
+        :param last_uid: 本次获取前的最大UID
+        :return: 检查点UID
+        """
+        saved = set(saved_uids)
+        checkpoint = last_uid
+        for uid in sorted(uids):
+            if uid not in saved:
+                break
+            checkpoint = uid
+        return checkpoint
+
+    def fetch_message_sizes(self, uids):
+        """
+        批量获取邮件的RFC822.SIZE
+        :param uids: UID列表
+        :return: 字典{uid: 字节数}，获取失败的UID不在字典中
+        """
+        sizes = {}
+        for start in range(0, len(uids), self.size_batch_size):
+            chunk = uids[start:start + self.size_batch_size]
+            status, data = self.uid_command('fetch', self.compact_uid_set(chunk), '(RFC822.SIZE)')
+            if status != 'OK':
+                print(f"Failed to fetch RFC822.SIZE: {data}")
+                continue
+            sizes.update(self.parse_message_sizes(data))
+        return sizes
+
+    @staticmethod
+    def parse_message_sizes(data):
+        """
+        解析(RFC822.SIZE)的UID FETCH响应
+        :param data: imaplib返回的响应数据列表
+        :return: 字典{uid: 字节数}
+        """
+        sizes = {}
+        for item in data:
+            if isinstance(item, tuple):
+                item = item[0]
+            if not isinstance(item, bytes):
+                continue
+            uid_match = FETCH_UID_RE.search(item)
+            size_match = FETCH_SIZE_RE.search(item)
+            if uid_match and size_match:
+                sizes[int(uid_match.group(1))] = int(size_match.group(1))
+        return sizes
+
+    def plan_fetch_batches(self, uids, sizes):
+        """
+        按每批邮件数上限和累计字节数上限切分UID列表，超过字节上限的单封邮件独占一批
+        :param uids: UID列表
+        :param sizes: fetch_message_sizes返回的字典
+        :return: 批次列表，每一项是一个UID列表
+        """
+        batch_size = max(1, self.fetch_batch_size // self.batch_divisor)
+        batch_bytes = max(1, self.fetch_batch_bytes // self.batch_divisor)
+        batches = []
+        current = []
+        current_bytes = 0
+        for uid in uids:
+            size = sizes.get(uid, 0)
+            if current and (len(current) >= batch_size or current_bytes + size > batch_bytes):
+                batches.append(current)
+                current = []
+                current_bytes = 0
+            current.append(uid)
+            current_bytes += size
+        if current:
+            batches.append(current)
+        return batches
+
+    def uid_command(self, command, *args):
+        """
+        发送UID命令。服务器以限流提示拒绝时抛出ServerThrottled，由连接池降低并发和批量后重连继续
+        :return: imaplib的(typ, data)
+        """
+        typ, data = self.client.uid(command, *args)
+        if typ != 'OK':
+            message = b' '.join(item for item in data if isinstance(item, bytes)).decode(errors='replace')
+            if is_throttle_message(message):
+                raise ServerThrottled(f'UID {command.upper()}被限流: {message}')
+        return typ, data
+
+    def fetch_batch(self, uids, message_handler):
+        """
+        用一次UID FETCH获取一批邮件全文，响应中的每封邮件依次交给message_handler处理
+        :param uids: 本批次的UID列表
+        :param message_handler: 回调函数message_handler(uid, raw_email)
+        :return: 本批次成功获取的UID列表
+        """
+        status, data = self.uid_command('fetch', self.compact_uid_set(uids), '(RFC822)')
+        if status != 'OK':
+            print(f"Failed to fetch batch: {data}")
+            return []
+        fetched = []
+        for uid, raw_email in self.iter_fetch_literals(data):
+            message_handler(uid, raw_email)
+            fetched.append(uid)
+        return fetched
+
+    @staticmethod
+    def iter_fetch_literals(data):
+        """
+        遍历UID FETCH响应，逐个返回(uid, 字面量数据)。UID可能位于字面量之前或之后
+        :param data: imaplib返回的响应数据列表
+        """
+        for index, item in enumerate(data):
+            if not isinstance(item, tuple):
+                continue
+            prefix, literal = item
+            match = FETCH_UID_RE.search(prefix)
+            if match is None and index + 1 < len(data) and isinstance(data[index + 1], bytes):
+                match = FETCH_UID_RE.search(data[index + 1])
+            if match is None:
+                print(f"FETCH响应中缺少UID: {prefix}")
+                continue
+            yield int(match.group(1)), literal
+
+    @staticmethod
+    def compact_uid_set(uids):
+        """
+        将UID列表压缩为IMAP序列集字符串，例如[1, 2, 3, 5, 7, 8] -> '1:3,5,7:8'
+        :param uids: UID列表
+        :return: 序列集字符串
+        """
+        numbers = sorted({int(uid) for uid in uids})
+        ranges = []
+        start = previous = numbers[0]
+        for number in numbers[1:]:
+            if number == previous + 1:
+                previous = number
+                continue
+            ranges.append(f'{start}:{previous}' if start != previous else f'{start}')
+            start = previous = number
+        ranges.append(f'{start}:{previous}' if start != previous else f'{start}')
+        return ','.join(ranges)
+
+    def supports_idle(self):
+        """是否用IDLE等待新邮件：服务商参数允许且服务器声明了IDLE能力"""
+        return self.use_idle and 'IDLE' in self.get_capabilities()
+
+    def idle(self, timeout, interrupt=None):
+        """
+        RFC 2177 IDLE：在已选中的文件夹上等待服务器推送，收到EXISTS、超时或interrupt被设置后发送DONE结束
+        :param timeout: 最长等待秒数，不应超过idle_timeout
+        :param interrupt: threading.Event，设置后尽快结束等待
+        :return: 等待期间是否收到EXISTS，即文件夹可能有新邮件
+        """
+        client = self.client
+        tag = client._new_tag()
+        tagged = tag + b' '
+        try:
+            client.send(tag + b' IDLE\r\n')
+            notified = False
+            while True:
+                line = self.read_idle_line()
+                if line.startswith(b'+'):
+                    break
+                if line.startswith(tagged):
+                    raise client.error(f'IDLE失败: {line.decode(errors="replace").strip()}')
+                notified = notified or bool(UNTAGGED_EXISTS_RE.match(line))
+
+            deadline = time.monotonic() + timeout
+            while not notified:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (interrupt is not None and interrupt.is_set()):
+                    break
+                # 分段等待，以便及时响应interrupt
+                if not client.wait_readable(min(remaining, 1)):
+                    continue
+                notified = bool(UNTAGGED_EXISTS_RE.match(self.read_idle_line()))
+
+            client.send(b'DONE\r\n')
+            while True:
+                line = self.read_idle_line()
+                if line.startswith(tagged):
+                    break
+                notified = notified or bool(UNTAGGED_EXISTS_RE.match(line))
+        finally:
+            # _new_tag在tagged_commands中登记了该标签，完成响应由这里读取，imaplib不会删除，
+            # 持续同步反复IDLE时需要自行删除，否则不断累积
+            client.tagged_commands.pop(tag, None)
+        if not line[len(tagged):].startswith(b'OK'):
+            raise client.error(f'IDLE失败: {line.decode(errors="replace").strip()}')
+        return notified
+
+    def read_idle_line(self):
+        """读取IDLE期间的一行响应，连接断开时抛出abort"""
+        line = self.client.readline()
+        if not line:
+            raise self.client.abort('socket error: EOF')
+        return line
+
+    def watch_folder(self, folder):
+        """
+        只读选中要IDLE或轮询的文件夹，记录其邮件数。SELECT的EXISTS等未标记响应留在untagged_responses中，
+        这里清空，否则下一次poll会把它当作新邮件通知
+        """
+        typ, data = self.client.select(self.mailbox_name(folder), readonly=True)
+        if typ != 'OK':
+            raise self.client.error(f'选中文件夹{folder}失败: {data}')
+        self.client.untagged_responses.clear()
+        self.watched_exists = int(data[0])
+
+    def poll(self):
+        """
+        不使用IDLE时的轮询：发送NOOP，服务器在响应前报告已选中文件夹的变化。与watch_folder记录的邮件数比较，
+        同步新邮件时重新SELECT同一文件夹得到的EXISTS不会被误报
+        :return: 邮件数是否变化，即文件夹可能有新邮件
+        """
+        typ, data = self.client.noop()
+        if typ != 'OK':
+            raise self.client.error(f'NOOP失败: {data}')
+        exists = self.client.untagged_responses.get('EXISTS')
+        # NOOP的未标记响应不再使用，清空以免长时间运行时累积
+        self.client.untagged_responses.clear()
+        if not exists:
+            return False
+        count = int(exists[-1])
+        notified = count != self.watched_exists
+        self.watched_exists = count
+        return notified
+
     def select_folder(self, folder):
         try:
             folder = f"\"{folder}\""
@@ -300,16 +1437,20 @@ class NetEClient(IMAPClientBase):
     def login(self):
         self.client.login(self.username, self.password)
         imaplib.Commands['ID'] = ('AUTH')
-        args = ("name", "your-name", "contact", self.username, "version", "1.0.0", "vendor", "myclient")
-        typ, dat = self.client._simple_command('ID', '("' + '" "'.join(args) + '")')
+        typ, dat = self.client._simple_command('ID', self.format_imap_id())
         # print(self.client._untagged_response(typ, dat, 'ID'))
 
+    def get_imap_id(self):
+        return "name", "your-name", "contact", self.username, "version", "1.0.0", "vendor", "myclient"
+
 
 class NetE126Client(IMAPClientBase):
     def login(self):
         self.client.login(self.username, self.password)
-        imap_id = ("name", "RPA robot", "version", "1.0.0", "vendor", "ins")
-        typ, data = self.client.xatom('ID', '("' + '" "'.join(imap_id) + '")')
+        typ, data = self.client.xatom('ID', self.format_imap_id())
+
+    def get_imap_id(self):
+        return "name", "RPA robot", "version", "1.0.0", "vendor", "ins"
 
 
 class NetERucClient(IMAPClientBase):
@@ -348,31 +1489,322 @@ class SohuClient(IMAPClientBase):
 
 
 class IMAPClientFactory:
-    @staticmethod
-    def get_client(client_type_, *args, **kwargs):
+    # 各服务商的获取参数，未列出的参数使用default中的值
+    # fetch_batch_size: 每批UID FETCH的最多邮件数；fetch_batch_bytes: 每批累计RFC822.SIZE的上限
+    # max_connections: 同一账户同时登录的连接数上限，QQ、网易等服务商会限制并发会话数
+    # use_idle: 持续同步时是否使用IDLE，网易等服务商声明了IDLE但不可靠地推送新邮件，改用NOOP轮询
+    provider_options = {
+        'default': {'batch_fetch': True, 'fetch_batch_size': 500, 'fetch_batch_bytes': 32 * 1024 * 1024,
+                    'max_connections': 4},
+        'qmail': {'fetch_batch_size': 100, 'fetch_batch_bytes': 8 * 1024 * 1024, 'max_connections': 2},
+        'netease': {'fetch_batch_size': 200, 'fetch_batch_bytes': 16 * 1024 * 1024, 'max_connections': 2,
+                    'use_idle': False},
+        'nete126': {'fetch_batch_size': 200, 'fetch_batch_bytes': 16 * 1024 * 1024, 'max_connections': 2,
+                    'use_idle': False},
+        'rucmail': {'fetch_batch_size': 200, 'fetch_batch_bytes': 16 * 1024 * 1024, 'max_connections': 2,
+                    'use_idle': False},
+        'sina': {'max_connections': 2, 'use_idle': False},
+        'mail139': {'fetch_batch_size': 100, 'fetch_batch_bytes': 8 * 1024 * 1024, 'max_connections': 1,
+                    'use_idle': False},
+        'mail189': {'fetch_batch_size': 100, 'fetch_batch_bytes': 8 * 1024 * 1024, 'max_connections': 1,
+                    'use_idle': False},
+        'sohu': {'max_connections': 1, 'use_idle': False},
+    }
+
+    @classmethod
+    def get_provider_options(cls, client_type_):
+        """
+        获取服务商的获取参数
+        :param client_type_: 客户端类型，如'qmail'
+        :return: 参数字典
+        """
+        options = dict(cls.provider_options['default'])
+        options.update(cls.provider_options.get(client_type_, {}))
+        return options
+
+    @classmethod
+    def get_client(cls, client_type_, *args, **kwargs):
         print(f'client_type = {client_type_}')
         if client_type_ == 'gmail':
-            return GmailClient(*args, **kwargs)
+            client = GmailClient(*args, **kwargs)
         elif client_type_ == 'netease':
-            return NetEClient(*args, **kwargs)
+            client = NetEClient(*args, **kwargs)
         elif client_type_ == 'nete126':
-            return NetE126Client(*args, **kwargs)
+            client = NetE126Client(*args, **kwargs)
         elif client_type_ == 'rucmail':
-            return NetERucClient(*args, **kwargs)
+            client = NetERucClient(*args, **kwargs)
         elif client_type_ == 'qmail':
-            return QmailClient(*args, **kwargs)
+            client = QmailClient(*args, **kwargs)
         elif client_type_ == 'outlook':
-            return OutlookClient(*args, **kwargs)
+            client = OutlookClient(*args, **kwargs)
         elif client_type_ == 'sina':
-            return SinaClient(*args, **kwargs)
+            client = SinaClient(*args, **kwargs)
         elif client_type_ == 'mail139':
-            return Mail139Client(*args, **kwargs)
+            client = Mail139Client(*args, **kwargs)
         elif client_type_ == 'mail189':
-            return Mail189Client(*args, **kwargs)
+            client = Mail189Client(*args, **kwargs)
         elif client_type_ == 'sohu':
-            return SohuClient(*args, **kwargs)
+            client = SohuClient(*args, **kwargs)
         else:
             raise ValueError("Unknown client type")
+        client.apply_options(cls.get_provider_options(client_type_))
+        client.apply_options(cls.get_account_options(client.username))
+        return client
+
+    @staticmethod
+    def get_account_options(username, path=None):
+        """
+        读取configs/accounts.ini中该账户的参数，覆盖服务商参数，例如关闭某个账户的压缩传输：
+        [me@example.com]
+        compress = false
+        :param username: 邮箱账户
+        :return: 参数字典，值按IMAPClientBase中同名属性的类型转换，未知参数忽略
+        """
+        config = configparser.ConfigParser()
+        config.read(path or account_ini_path, encoding='utf-8')
+        if not config.has_section(username):
+            return {}
+        options = {}
+        for name in config.options(username):
+            default = getattr(IMAPClientBase, name, None)
+            if isinstance(default, bool):
+                options[name] = config.getboolean(username, name)
+            elif isinstance(default, int):
+                options[name] = config.getint(username, name)
+        return options
+
+
+@dataclass
+class RetryPolicy:
+    """连接断开或服务器限流后的重试策略：带随机抖动的指数退避"""
+    max_retries: int = 8  # 没有新进展时连续重试的次数上限，每次重试有进展后重新计数
+    base_delay: float = 2  # 第一次重试前等待的秒数
+    max_delay: float = 300  # 等待秒数的上限
+
+    def delay(self, attempt):
+        """
+        第attempt次重试前等待的秒数。在指数增长的上限的一半到上限之间随机取值，
+        避免多个连接同时断开后又同时重连
+        """
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+
+class AccountConnectionBudget:
+    """
+    同一邮箱账户已登录连接数的上限，由该账户的全部连接池共享，包括批量备份、持续同步和备份规划。
+    持续同步以background方式申请：有前台连接池在等待时让出，等它们用完后再申请
+    """
+
+    def __init__(self, limit):
+        self.limit = max(1, limit)
+        self.used = 0
+        self.waiting = 0  # 正在等待的前台申请数
+        self._changed = threading.Condition()
+
+    def acquire(self, background=False):
+        """申请一个连接名额，达到上限时阻塞等待"""
+        with self._changed:
+            if not background:
+                self.waiting += 1
+            try:
+                while self.used >= self.limit or (background and self.waiting):
+                    self._changed.wait()
+                self.used += 1
+            finally:
+                if not background:
+                    self.waiting -= 1
+
+    def release(self):
+        with self._changed:
+            self.used -= 1
+            self._changed.notify_all()
+
+    @property
+    def contended(self):
+        """是否有前台连接池在等待名额，持续同步据此断开连接让出名额"""
+        return self.waiting > 0
+
+
+_account_budgets = {}
+_account_budgets_lock = threading.Lock()
+
+
+def account_connection_budget(client_type, server, username):
+    """
+    返回邮箱账户共享的AccountConnectionBudget，上限为服务商的max_connections
+    """
+    key = (server.lower(), username.lower())
+    with _account_budgets_lock:
+        budget = _account_budgets.get(key)
+        if budget is None:
+            budget = AccountConnectionBudget(IMAPClientFactory.get_provider_options(client_type)['max_connections'])
+            _account_budgets[key] = budget
+        return budget
+
+
+class IMAPConnectionPool:
+    """
+    单个邮箱账户的IMAP连接池。按需创建并登录客户端，同时在用的连接数不超过max_connections，
+    用完的连接放回池中复用。服务器限流时降低同时在用的连接数和每批获取的数量。
+    新建连接前还要从账户共享的AccountConnectionBudget申请名额，同一账户的多个连接池合计不超过服务商上限
+    """
+
+    def __init__(self, client_type, server, port, username, password, ssl=True, max_connections=None,
+                 rate_limiter=None, background=False):
+        self.client_type = client_type
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.ssl = ssl
+        if max_connections is None:
+            max_connections = IMAPClientFactory.get_provider_options(client_type)['max_connections']
+        self.max_connections = max(1, max_connections)
+        self.rate_limiter = rate_limiter
+        self.budget = account_connection_budget(client_type, server, username)
+        self.background = background  # 持续同步的连接池，有前台连接池等待时让出名额
+        self._idle_clients = queue.LifoQueue()
+        self._all_clients = []
+        self._lock = threading.Lock()
+        self._slots_changed = threading.Condition(self._lock)
+        self._in_use = 0
+        self.connection_limit = self.max_connections  # 当前允许同时在用的连接数，限流后降低
+        self.batch_divisor = 1  # 限流后调高，应用到池中全部客户端
+
+    def acquire(self):
+        """
+        取出一个已登录的客户端，连接数达到上限时阻塞等待
+        :return: IMAPClientBase实例
+        """
+        with self._slots_changed:
+            while self._in_use >= self.connection_limit:
+                self._slots_changed.wait()
+            self._in_use += 1
+        try:
+            client = self._idle_clients.get_nowait()
+        except queue.Empty:
+            try:
+                client = self._create_client()
+            except Exception:
+                self._free_slot()
+                raise
+        client.batch_divisor = self.batch_divisor
+        return client
+
+    def _free_slot(self):
+        with self._slots_changed:
+            self._in_use -= 1
+            self._slots_changed.notify()
+
+    def release(self, client):
+        """归还客户端"""
+        self._idle_clients.put(client)
+        self._free_slot()
+
+    def throttle(self):
+        """服务器限流：同时在用的连接数减一（至少保留一个），每批获取的邮件数和字节数减半"""
+        with self._lock:
+            self.connection_limit = max(1, self.connection_limit - 1)
+            self.batch_divisor = min(MAX_BATCH_DIVISOR, self.batch_divisor * 2)
+            clients = list(self._all_clients)
+        for client in clients:
+            client.batch_divisor = self.batch_divisor
+        print(f'账户{self.username}被限流，连接数降为{self.connection_limit}，每批获取数量缩小为1/{self.batch_divisor}')
+
+    def run(self, job, retry_policy=None, progress=None, description=''):
+        """
+        用池中的连接执行job(client)。连接断开、网络错误或服务器限流时丢弃该连接，按退避策略等待后
+        用新连接重新执行，job应能从上次的检查点继续
+        :param job: 以客户端为参数的函数
+        :param retry_policy: RetryPolicy，默认使用RetryPolicy()
+        :param progress: 返回当前进度的函数，如检查点UID；两次失败之间进度有变化时重新计数重试次数
+        :param description: 打印重试信息时的说明，如文件夹名
+        :return: job的返回值
+        """
+        retry_policy = retry_policy or RetryPolicy()
+        attempt = 0
+        last_progress = progress() if progress else None
+        while True:
+            client = None
+            try:
+                client = self.acquire()
+                result = job(client)
+                self.release(client)
+                return result
+            except Exception as e:
+                if client is not None:
+                    self.discard(client)
+                if not is_retryable_error(e):
+                    raise
+                if isinstance(e, ServerThrottled) or is_throttle_message(str(e)):
+                    self.throttle()
+                current = progress() if progress else None
+                attempt = 1 if current != last_progress else attempt + 1
+                last_progress = current
+                if attempt > retry_policy.max_retries:
+                    raise
+                delay = retry_policy.delay(attempt)
+                print(f'{description}获取中断{e}，{delay:.1f}秒后第{attempt}次重连')
+                time.sleep(delay)
+
+    def discard(self, client):
+        """断开并丢弃客户端，不再放回池中，用于连接出错或长期占用的连接结束时"""
+        with self._lock:
+            owned = client in self._all_clients
+            if owned:
+                self._all_clients.remove(client)
+        if owned:
+            self.budget.release()
+        try:
+            client.disconnect()
+        except Exception as e:
+            print(f"断开连接时出错: {e}")
+        self._free_slot()
+
+    @contextmanager
+    def connection(self):
+        """
+        with pool.connection() as client: 形式使用连接。正常结束时归还连接；出错时连接可能处于断开或
+        命令未完成的状态，与run一样丢弃，不放回池中
+        """
+        client = self.acquire()
+        try:
+            yield client
+        except BaseException:
+            self.discard(client)
+            raise
+        self.release(client)
+
+    def close_all(self):
+        """断开池中全部连接"""
+        with self._lock:
+            clients = self._all_clients
+            self._all_clients = []
+        for client in clients:
+            self.budget.release()
+            try:
+                client.disconnect()
+            except Exception as e:
+                print(f"断开连接时出错: {e}")
+
+    def _create_client(self):
+        self.budget.acquire(self.background)
+        try:
+            client = IMAPClientFactory.get_client(self.client_type, self.server, self.port, self.username,
+                                                  self.password, self.ssl)
+            if not client.connect():
+                raise ConnectionError(f"无法连接到服务器{self.server}:{self.port}")
+            client.login()
+            client.start_compression()
+        except Exception:
+            self.budget.release()
+            raise
+        client.rate_limiter = self.rate_limiter
+        with self._lock:
+            self._all_clients.append(client)
+        print(f'账户{self.username}新建连接，共{len(self._all_clients)}个')
+        return client
 
 
 if __name__ == "__main__":
@@ -0,0 +1,152 @@
+import configparser
+import os
+import pickle
+import sys
+import threading
+from dataclasses import dataclass
+
+from MDLStore.bodystructure import PartSelector
+from MDLStore.mailclients import IMAPConnectionPool
+from MDLStore.utils import ServerUtils, EmailUtils
+
+# 如果是打包后的exe，获取exe的所在目录
+if getattr(sys, 'frozen', False):
+    module_path = os.path.dirname(sys.executable)
+else:
+    # 如果是脚本运行，则获取脚本的所在目录
+    module_path = os.path.dirname(os.path.abspath(__file__))
+
+capacity_ini_path = os.path.join(module_path, 'configs', 'capacity.ini')
+
+DEFAULT_INDEX_RATIO = 0.2  # 没有历史数据时，索引数据量与备份数据量之比的初始值
+RATIO_SMOOTHING = 0.3  # 学习索引比例时新样本的权重
+MIN_SAMPLE_BYTES = 1024 * 1024  # 备份数据量小于该值的样本不用于学习
+
+
+@dataclass
+class CapacityPlan:
+    """备份任务的预检结果，各项均为字节数"""
+    messages: int = 0  # 待备份邮件数
+    rfc2822_bytes: int = 0  # 邮件全文
+    attachment_bytes: int = 0  # 匹配文件名关键字的附件
+    attachment_count: int = 0
+
+    def add(self, estimate):
+        """累加IMAPClientBase.estimate_folder的结果"""
+        self.messages += estimate['messages']
+        self.rfc2822_bytes += estimate['RFC2822']
+        self.attachment_bytes += estimate['Attachment']
+        self.attachment_count += estimate['attachments']
+
+    @property
+    def data_bytes(self):
+        return self.rfc2822_bytes + self.attachment_bytes
+
+    def index_bytes(self, index_ratio):
+        return int(self.data_bytes * index_ratio)
+
+    def total_bytes(self, index_ratio):
+        return self.data_bytes + self.index_bytes(index_ratio)
+
+    def describe(self, index_ratio):
+        mb = 1024 * 1024
+        return (f'预计邮件{self.messages}封，邮件全文{self.rfc2822_bytes / mb:.1f}MB，'
+                f'附件{self.attachment_count}个{self.attachment_bytes / mb:.1f}MB，'
+                f'索引{self.index_bytes(index_ratio) / mb:.1f}MB，云附件大小下载前未知')
+
+
+class IndexRatio:
+    """
+    索引数据量（数据库索引和全文索引）与备份数据量之比。每次备份后根据索引目录的实际增长量学习，
+    保存在configs/capacity.ini中，用于预检和临时数据区模式的容量估算
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, path=capacity_ini_path):
+        self.path = path
+
+    def _read(self):
+        config = configparser.ConfigParser()
+        if os.path.exists(self.path):
+            config.read(self.path)
+        if not config.has_section('index'):
+            config.add_section('index')
+        return config
+
+    def get_ratio(self):
+        with self._lock:
+            return self._read().getfloat('index', 'ratio', fallback=DEFAULT_INDEX_RATIO)
+
+    def learn(self, index_bytes, data_bytes):
+        """
+        用一次备份的实际结果更新比例
+        :param index_bytes: 索引目录增长的字节数
+        :param data_bytes: 本次写入的备份数据字节数
+        :return: 更新后的比例
+        """
+        with self._lock:
+            config = self._read()
+            ratio = config.getfloat('index', 'ratio', fallback=DEFAULT_INDEX_RATIO)
+            if data_bytes < MIN_SAMPLE_BYTES or index_bytes < 0:
+                return ratio
+            samples = config.getint('index', 'samples', fallback=0)
+            sample = index_bytes / data_bytes
+            # 第一个样本直接采用，之后按指数平均
+            ratio = sample if samples == 0 else ratio * (1 - RATIO_SMOOTHING) + sample * RATIO_SMOOTHING
+            config.set('index', 'ratio', f'{ratio:.4f}')
+            config.set('index', 'samples', str(samples + 1))
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'w') as configfile:
+                config.write(configfile)
+            print(f'索引比例样本{sample:.4f}，更新为{ratio:.4f}')
+            return ratio
+
+
+def directory_size(path):
+    """目录下全部文件的总字节数，目录不存在时为0"""
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            try:
+                total += os.path.getsize(os.path.join(root, filename))
+            except OSError:
+                continue
+    return total
+
+
+def index_directory(drive):
+    """磁盘drive上数据库索引和全文索引所在的目录"""
+    return os.path.join(f'{drive}:/', 'MDLStore', 'index')
+
+
+def plan_backup_task(backup_task, email_account, sync_marks=None, rate_limiter=None):
+    """
+    预检备份任务：只获取RFC822.SIZE和BODYSTRUCTURE，统计需要写入目标磁盘的数据量，不下载邮件内容
+    :param backup_task: BackupTask
+    :param email_account: EmailAccount
+    :param sync_marks: load_sync_marks返回的增量同步标记，增量备份时只统计新邮件
+    :param rate_limiter: 下载带宽预算
+    :return: CapacityPlan
+    """
+    content_type = backup_task.content_type
+    criteria = EmailUtils.buildSearchQuery(backup_task.start_date, backup_task.end_date, backup_task.sender,
+                                           backup_task.subject_keywords)
+    attachment_selector = None
+    if 'Attachment' in content_type:
+        attachment_selector = PartSelector(backup_task.filename_keywords, True, False)
+
+    client_type = ServerUtils.get_client_type(email_account.username)
+    pool = IMAPConnectionPool(client_type, email_account.server_address, email_account.port,
+                              email_account.username, email_account.password, email_account.ssl_encryption,
+                              max_connections=1, rate_limiter=rate_limiter)
+    plan = CapacityPlan()
+    try:
+        with pool.connection() as client:
+            for folder in pickle.loads(backup_task.folder_list):
+                folder = folder.replace('"', '')
+                sync_mark = sync_marks.get(folder) if sync_marks is not None else None
+                plan.add(client.estimate_folder(folder, criteria, sync_mark, attachment_selector,
+                                                'RFC2822' in content_type))
+    finally:
+        pool.close_all()
+    return plan
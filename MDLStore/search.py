@@ -8,7 +8,7 @@ from sqlalchemy.orm import joinedload
 
 from MDLStore.database.entities import EmailInfo, Attachment
 from MDLStore.database.index_database_setup import DatabaseManager
-from MDLStore.database.service import EmailInfoManager
+from MDLStore.database.service import EmailInfoManager, EmailAddressManager, ADDRESS_ROLES
 from MDLStore.indexes import IndexManager
 
 
@@ -208,7 +208,10 @@ class MailSearcher:
         conditions = []
         for key, value in criteria.items():
             if value is not None:
-                if key in ['subject', 'from_address', 'to_addresses', 'cc_addresses', 'bcc_addresses', 'body_text']:
+                if key in ADDRESS_ROLES:
+                    # 通过联系人地址表查找，完整邮箱地址为索引查找
+                    conditions.append(EmailInfo.email_id.in_(EmailAddressManager.email_ids_by_address(key, value)))
+                elif key in ['subject', 'body_text']:
                     conditions.append(getattr(EmailInfo, key).ilike(f'%{value}%'))  # case-insensitive partial match
                 elif key == 'received_date_start':
                     conditions.append(EmailInfo.received_date >= value)
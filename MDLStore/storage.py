@@ -1,7 +1,12 @@
 import hashlib
 import os
+import threading
+import uuid
+
 import psutil
 
+COPY_CHUNK_SIZE = 1024 * 1024  # 按块复制文件时每块的字节数
+
 
 class PathDirUtil:
 
@@ -116,6 +121,8 @@ class StorageManager:
             cls._instance = super(StorageManager, cls).__new__(cls)
             cls._instance.disk_info = cls._instance.get_disk_info()
             cls._instance.partitions = cls._instance.get_disk_partitions()
+            cls._instance.reserved = {}  # 各磁盘已预留的字节数
+            cls._instance.reserve_lock = threading.Lock()
         return cls._instance
 
     def get_disk_partitions(self):
@@ -188,6 +195,35 @@ class StorageManager:
 
         return None
 
+    def reserve_disk(self, drive, size_bytes, change=False):
+        """
+        为即将写入的数据预留磁盘空间。并发的备份任务各自预留，不会重复计算同一部分剩余空间
+        :param drive: 初始磁盘，例如“E”
+        :param size_bytes: 预留的字节数
+        :param change: 容量不足时，是否切换其他磁盘
+        :return: 预留成功的磁盘盘符，若均不可用，则返回None
+        """
+        with self.reserve_lock:
+            partitions = self.get_disk_partitions()
+            candidates = [partition for partition in partitions if partition.device.startswith(drive)]
+            if change:
+                candidates += [partition for partition in partitions if not partition.device.startswith(drive)]
+            for partition in candidates:
+                letter = partition.device[0]
+                try:
+                    free = self.get_available_space(partition.mountpoint) - self.reserved.get(letter, 0)
+                except (PermissionError, OSError):
+                    continue
+                if free >= size_bytes:
+                    self.reserved[letter] = self.reserved.get(letter, 0) + size_bytes
+                    return letter
+        return None
+
+    def release_disk(self, drive, size_bytes):
+        """释放reserve_disk预留的空间"""
+        with self.reserve_lock:
+            self.reserved[drive] = max(0, self.reserved.get(drive, 0) - size_bytes)
+
 
 # class StorageManager:
 #     def __init__(self):
@@ -234,8 +270,9 @@ class StorageManager:
 
 class FileWriter:
 
-    def __init__(self):
+    def __init__(self, rate_limiter=None):
         self.storage_manager = StorageManager()  # 使用已经存在的StorageManager单例
+        self.rate_limiter = rate_limiter  # 多个任务共享的磁盘写入预算，utils.RateLimiter
 
     def get_available_space(self, path):
         """使用psutil检查指定路径的可用空间"""
@@ -270,7 +307,7 @@ class FileWriter:
     def write_file(self, file_data, filename, drive, base_folder, change=False):
         """
         将文件数据写入指定磁盘的指定文件夹中。如果指定磁盘空间不足，可选择性地切换到另一个磁盘。
-        :param file_data: 要写入文件的数据
+        :param file_data: 要写入文件的数据，bytes、memoryview（如RawMessage的文件映射）或以二进制模式打开的文件（按块复制，不整体读入内存）
         :param filename: 要创建的文件名
         :param drive: 初始驱动器字母（例如：'E'）
         :param base_folder: 相对于驱动器根目录的文件夹路径
@@ -293,6 +330,51 @@ class FileWriter:
             return None  # 存储不足返回None
         return full_path  # Return the path where the file was successfully written
 
+    def write_stream(self, stream, filename, drive, base_folder, change=False, size_hint=0):
+        """
+        把只能顺序读取的数据流写入指定磁盘的指定文件夹，边写边计算MD5，内存占用只有一块数据。
+        先写入同一文件夹下的临时文件，写完后再按内容哈希处理同名文件：内容相同时沿用已有文件，否则在文件名后添加序号
+        :param stream: 有read方法的二进制数据流，如utils.MailAttachment.stream
+        :param size_hint: 预计的字节数，用于检查磁盘剩余空间
+        :return: 文件最终存储的绝对路径，空间不足时返回None
+        """
+        candidates = [(drive + ':/', drive + ':/')]
+        if change:
+            candidates += [(partition.mountpoint, partition.device) for partition in self.storage_manager.partitions
+                           if partition.device != drive + ':/']
+        for root, device in candidates:
+            if self.get_available_space(device) > size_hint:
+                break
+        else:
+            return None  # 存储不足返回None
+
+        full_path = os.path.join(root, base_folder, filename)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        temp_path = os.path.join(os.path.dirname(full_path), f'.{uuid.uuid4().hex}.part')
+        hash_algo = hashlib.md5()
+        try:
+            with open(temp_path, 'wb') as f:
+                while chunk := stream.read(COPY_CHUNK_SIZE):
+                    if self.rate_limiter:
+                        self.rate_limiter.consume(len(chunk))
+                    hash_algo.update(chunk)
+                    f.write(chunk)
+            file_hash = hash_algo.hexdigest()
+
+            base, extension = os.path.splitext(full_path)
+            counter = 1
+            unique_path = full_path
+            while os.path.exists(unique_path):
+                if self.get_file_hash(unique_path) == file_hash:
+                    return unique_path
+                unique_path = f"{base}_{counter}{extension}"
+                counter += 1
+            os.replace(temp_path, unique_path)
+            return unique_path
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
     def get_file_hash(self, file_path):
         hash_algo = hashlib.md5()
         with open(file_path, 'rb') as file:
@@ -304,10 +386,31 @@ class FileWriter:
         """获取文件的大小（以字节为单位）"""
         return os.path.getsize(file_path)
 
+    @staticmethod
+    def get_data_size(file_data):
+        """获取bytes、memoryview或二进制文件对象的字节数"""
+        if isinstance(file_data, (bytes, bytearray, memoryview)):
+            return len(file_data)
+        size = file_data.seek(0, os.SEEK_END)
+        file_data.seek(0)
+        return size
+
+    @staticmethod
+    def get_data_hash(file_data):
+        """计算bytes、memoryview或二进制文件对象内容的MD5，文件对象按块读取"""
+        if isinstance(file_data, (bytes, bytearray, memoryview)):
+            return hashlib.md5(file_data).hexdigest()
+        hash_algo = hashlib.md5()
+        file_data.seek(0)
+        while chunk := file_data.read(COPY_CHUNK_SIZE):
+            hash_algo.update(chunk)
+        file_data.seek(0)
+        return hash_algo.hexdigest()
+
     def _handle_existing_file(self, full_path, file_data):
         if os.path.exists(full_path):
             existing_hash = self.get_file_hash(full_path)
-            new_hash = hashlib.md5(file_data).hexdigest()
+            new_hash = self.get_data_hash(file_data)
             if existing_hash == new_hash:
                 return full_path
             else:
@@ -343,7 +446,7 @@ class FileWriter:
         base, extension = os.path.splitext(path)
         counter = 1
         unique_path = path
-        file_hash = hashlib.md5(file_data).hexdigest()
+        file_hash = self.get_data_hash(file_data)
 
         while os.path.exists(unique_path):
             existing_hash = self.get_file_hash(unique_path)
@@ -379,10 +482,20 @@ class FileWriter:
     def _write_to_disk(self, full_path, file_data, drive):
         """尝试向目标位置写文件"""
         # if self.get_available_space(drive) > 1000*(2**30):
-        if self.get_available_space(drive) > len(file_data):
+        size = self.get_data_size(file_data)
+        if self.get_available_space(drive) > size:
             os.makedirs(os.path.dirname(full_path), exist_ok=True)
             with open(full_path, 'wb') as f:
-                f.write(file_data)
+                if isinstance(file_data, (bytes, bytearray, memoryview)):
+                    if self.rate_limiter:
+                        self.rate_limiter.consume(size)
+                    f.write(file_data)
+                else:
+                    file_data.seek(0)
+                    while chunk := file_data.read(COPY_CHUNK_SIZE):
+                        if self.rate_limiter:
+                            self.rate_limiter.consume(len(chunk))
+                        f.write(chunk)
             return True
         return False
 
@@ -0,0 +1,261 @@
+import threading
+import time
+import traceback
+from typing import List, Optional
+
+from MDLStore.database.config_database_setup import Session
+from MDLStore.database.entities import BackupTask
+from MDLStore.database.service import EmailAccountManager
+from MDLStore.execute import MessageStore, DirectStorePipeline, build_part_selector, load_sync_marks, \
+    save_sync_marks, long_running_task, DIRECT_STORE_RESERVE, BANDWIDTH_LIMIT, DISK_WRITE_LIMIT
+from MDLStore.mailclients import IMAPConnectionPool
+from MDLStore.storage import StorageManager
+from MDLStore.utils import EmailUtils, ServerUtils, RateLimiter
+
+SETTLE_SECONDS = 2  # 收到新邮件通知后再等待的秒数，把连续到达的邮件合并为一批获取
+RETRY_SECONDS = 30  # 连接出错后重新连接前等待的秒数
+STOP_TIMEOUT = 5  # 停止持续同步时等待每个监视线程结束的秒数，监视线程是守护线程，超时后随程序退出
+
+# 正在运行的持续同步，{备份任务ID: SyncDaemon}
+_running_daemons = {}
+_running_lock = threading.Lock()
+
+
+class WatchInterrupt:
+    """IDLE和轮询等待的中断条件：持续同步停止，或有前台备份在等待该账户的连接名额"""
+
+    def __init__(self, stop_event, budget):
+        self.stop_event = stop_event
+        self.budget = budget
+
+    def is_set(self):
+        return self.stop_event.is_set() or self.budget.contended
+
+    def wait(self, timeout):
+        """
+        等待timeout秒，中断条件成立时提前结束
+        :return: 是否被中断
+        """
+        deadline = time.monotonic() + timeout
+        while not self.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self.stop_event.wait(min(remaining, 1))
+        return True
+
+
+class FolderWatcher(threading.Thread):
+    """
+    持续同步中的一个IMAP长连接。只监视一个文件夹且服务器支持IDLE时用IDLE等待推送；
+    否则每隔poll_interval秒轮询，单个文件夹发送NOOP，多个文件夹依次用STATUS检查。连接出错后自动重连。
+    同一账户的批量备份等待连接名额时断开连接让出名额，名额空出后重新连接并补齐期间到达的邮件
+    """
+
+    def __init__(self, sync_daemon, folders):
+        super().__init__(name=f'FolderWatcher-{folders[0]}', daemon=True)
+        self.sync_daemon = sync_daemon
+        self.folders = folders
+
+    def run(self):
+        stop_event = self.sync_daemon.stop_event
+        pool = self.sync_daemon.pool
+        while not stop_event.is_set():
+            client = None
+            try:
+                client = pool.acquire()
+                if stop_event.is_set():
+                    # 等待连接名额期间已停止
+                    break
+                self.watch(client)
+            except Exception as e:
+                print(f'监视文件夹{self.folders}出错{e}，{RETRY_SECONDS}秒后重新连接')
+                traceback.print_exc()
+                stop_event.wait(RETRY_SECONDS)
+            finally:
+                if client is not None:
+                    pool.discard(client)
+
+    def watch(self, client):
+        sync_daemon = self.sync_daemon
+        stop_event = sync_daemon.stop_event
+        # 连接后先获取断线期间到达的邮件
+        for folder in self.folders:
+            sync_daemon.sync_folder(client, folder, time.time())
+        single = len(self.folders) == 1
+        if single:
+            # STATUS判断文件夹未变化时saveEmails不会选中文件夹，IDLE和NOOP需要已选中的文件夹
+            client.watch_folder(self.folders[0])
+        use_idle = single and client.supports_idle()
+        print(f'开始监视文件夹{self.folders}，方式：{"IDLE" if use_idle else "轮询"}')
+
+        interrupt = WatchInterrupt(stop_event, sync_daemon.pool.budget)
+        while not interrupt.is_set():
+            if use_idle:
+                changed = client.idle(client.idle_timeout, interrupt)
+            else:
+                if interrupt.wait(client.poll_interval):
+                    break
+                changed = client.poll() if single else True
+            if not changed or interrupt.is_set():
+                continue
+            notified_at = time.time()
+            stop_event.wait(SETTLE_SECONDS)
+            for folder in self.folders:
+                sync_daemon.sync_folder(client, folder, notified_at)
+        if not stop_event.is_set():
+            print(f'文件夹{self.folders}的连接让给批量备份，名额空出后继续监视')
+
+
+class SyncDaemon:
+    """
+    持续同步模式。为备份任务的文件夹保持IMAP长连接，服务器推送或轮询发现新邮件后立即小批量获取，
+    经DirectStorePipeline写入目标磁盘并添加索引，再保存同步标记。备份延迟从每日批量备份的约24小时
+    缩短到秒级，且不需要重新扫描文件夹
+    """
+
+    def __init__(self, backup_task, drive, drive_change=False, info_callback=None,
+                 bandwidth_limit=BANDWIDTH_LIMIT, disk_write_limit=DISK_WRITE_LIMIT):
+        self.backup_task = backup_task
+        self.drive = drive
+        self.drive_change = drive_change
+        self.info_callback = info_callback
+        self.network_limiter = RateLimiter(bandwidth_limit)
+        self.write_limiter = RateLimiter(disk_write_limit)
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()  # 配置库Session不是线程安全的，保存同步标记时加锁
+        self.watchers = []
+        self.lag = {}  # 各文件夹最近一次同步的备份延迟秒数：从收到通知到邮件写入目标磁盘
+        self.session = None
+        self.email_account = None
+        self.sync_marks = None
+        self.criteria = None
+        self.part_selector = None
+        self.message_store = None
+        self.pipeline = None
+        self.pool = None
+
+    def start(self):
+        """连接邮件服务器并为各文件夹启动监视线程，立即返回"""
+        task = self.backup_task
+        self.session = Session()
+        self.email_account = EmailAccountManager(self.session).get_email_account_by_id(task.email_account_id)
+        target_drive = StorageManager().get_available_disk(self.drive, DIRECT_STORE_RESERVE, self.drive_change)
+        if target_drive is None:
+            raise RuntimeError('目标磁盘空间不足，无法持续同步，请更换目标磁盘')
+        self.sync_marks = load_sync_marks(self.session, task, self.email_account, self.drive)
+        self.criteria = EmailUtils.buildSearchQuery(task.start_date, task.end_date, task.sender,
+                                                    task.subject_keywords)
+        self.part_selector = build_part_selector(task)
+        self.message_store = MessageStore(target_drive, task, self.email_account, self.drive_change,
+                                          self.write_limiter)
+        self.pipeline = DirectStorePipeline(self.message_store)
+
+        account = self.email_account
+        client_type = ServerUtils.get_client_type(account.username)
+        self.pool = IMAPConnectionPool(client_type, account.server_address, account.port, account.username,
+                                       account.password, account.ssl_encryption,
+                                       rate_limiter=self.network_limiter, background=True)
+        for folders in self.assign_folders(list(self.sync_marks), self.pool.max_connections):
+            watcher = FolderWatcher(self, folders)
+            self.watchers.append(watcher)
+            watcher.start()
+        print(f'任务{task.task_name}开始持续同步，目标磁盘{target_drive}，连接{len(self.watchers)}个')
+
+    @staticmethod
+    def assign_folders(folders, max_connections):
+        """
+        把文件夹分配到连接上：每个连接监视一个文件夹，文件夹多于连接数时最后一个连接轮询其余全部文件夹
+        :return: 每个连接的文件夹列表
+        """
+        if len(folders) <= max_connections:
+            return [[folder] for folder in folders]
+        return [[folder] for folder in folders[:max_connections - 1]] + [folders[max_connections - 1:]]
+
+    def sync_folder(self, client, folder, notified_at):
+        """
+        增量获取文件夹的新邮件，写入目标磁盘后保存同步标记
+        :param notified_at: 收到新邮件通知的时间戳，用于计算备份延迟
+        """
+        sync_mark = self.sync_marks[folder]
+        fetched = []
+
+        def message_sink(folder_, uid, raw_email):
+            self.pipeline(folder_, uid, raw_email)
+            fetched.append(uid)
+
+        client.saveEmails(folder, self.criteria, None, None, sync_mark, message_sink, self.part_selector)
+        with self.lock:
+            save_sync_marks(self.session, self.backup_task, self.email_account, self.drive, {folder: sync_mark})
+        if not fetched:
+            return
+        lag = time.time() - notified_at
+        self.lag[folder] = lag
+        print(f'文件夹{folder}同步新邮件{len(fetched)}封，备份延迟{lag:.1f}秒')
+        if self.info_callback:
+            self.info_callback.emit(f'[{self.backup_task.task_name}]{folder}：同步新邮件{len(fetched)}封，'
+                                    f'备份延迟{lag:.1f}秒')
+
+    def stop(self, timeout=None):
+        """停止全部监视线程并断开连接"""
+        self.stop_event.set()
+        for watcher in self.watchers:
+            watcher.join(timeout)
+        if self.pool is not None:
+            self.pool.close_all()
+        if self.message_store is not None:
+            self.message_store.close()
+        if self.session is not None:
+            self.session.close()
+
+
+def start_sync_daemons(tasks: List[BackupTask], drive, drive_change, info_callback=None):
+    """
+    为备份任务列表启动持续同步，每个任务一个SyncDaemon，已在持续同步的任务先停止再重新启动
+    :return: 已启动的SyncDaemon列表，由stop_sync_daemons停止
+    """
+    stop_sync_daemons(tasks)
+    daemons = []
+    for task in tasks:
+        sync_daemon = SyncDaemon(task, drive, drive_change, info_callback)
+        try:
+            sync_daemon.start()
+        except Exception as e:
+            print(f'任务{task.task_name}持续同步启动失败{e}')
+            traceback.print_exc()
+            sync_daemon.stop()
+            continue
+        with _running_lock:
+            _running_daemons[task.task_id] = sync_daemon
+        daemons.append(sync_daemon)
+    return daemons
+
+
+def stop_sync_daemons(tasks: Optional[List[BackupTask]] = None, timeout=STOP_TIMEOUT):
+    """
+    停止持续同步
+    :param tasks: 要停止的备份任务，为None时停止全部，程序退出时调用
+    """
+    with _running_lock:
+        if tasks is None:
+            daemons = list(_running_daemons.values())
+            _running_daemons.clear()
+        else:
+            daemons = [_running_daemons.pop(task.task_id) for task in tasks if task.task_id in _running_daemons]
+    for sync_daemon in daemons:
+        print(f'任务{sync_daemon.backup_task.task_name}停止持续同步')
+        sync_daemon.stop(timeout)
+
+
+def run_backup_tasks(task_id_lists: List[BackupTask], drive, drive_change, continuous, progress_callback,
+                     detail_callback, info_callback):
+    """
+    界面执行备份任务的入口。先停止这些任务的持续同步，以免与批量备份同时写入，执行批量备份补齐后，
+    continuous为True时再为它们启动持续同步
+    """
+    stop_sync_daemons(task_id_lists)
+    result = long_running_task(task_id_lists, drive, drive_change, progress_callback, detail_callback,
+                               info_callback)
+    if continuous:
+        start_sync_daemons(task_id_lists, drive, drive_change, info_callback)
+    return result
@@ -1,19 +1,29 @@
+import binascii
 import codecs
 import hashlib
+import io
+import mmap
 import os
+import pickle
 import re
+import shutil
+import threading
+import time
 import uuid
+from dataclasses import dataclass, field
 from datetime import date, timedelta
+from typing import Optional
 import email
 from email import policy
+from email.feedparser import BytesFeedParser
+from email.parser import BytesHeaderParser
 from email.message import Message
 from email.policy import default, strict
 from email.utils import parsedate_to_datetime
 from email.header import decode_header
 
-from bs4 import BeautifulSoup
-
-from MDLStore.cloudfile import CloudFileParser
+from MDLStore.cloudfile import CLOUD_PROVIDERS, CloudFileParser
+from MDLStore.htmltext import html_to_text
 
 
 
@@ -86,9 +96,88 @@ class ServerUtils:
         """
         根据外部链接返回云附件服务提供商的名称
         :param outside_link:
-        :return: 返回名称
+        :return: 返回名称，无法识别则返回None
         """
-        pass
+        return CLOUD_PROVIDERS.provider_of(outside_link)
+
+
+class SearchQuery:
+    """
+    IMAP SEARCH条件。日期、大小和纯ASCII的FROM、SUBJECT条件可以直接拼入命令字符串；含非ASCII字符（如中文关键字）的
+    FROM、SUBJECT条件需要以CHARSET UTF-8和literal发送，由IMAPClientBase.search_messages处理
+    """
+
+    def __init__(self, date_start=None, date_end=None, sender=None, subject_keywords=None, larger=None,
+                 smaller=None):
+        self.date_start = date_start
+        self.date_end = date_end
+        self.sender = sender
+        self.subject_keywords = subject_keywords
+        self.larger = larger
+        self.smaller = smaller
+
+    def base_terms(self):
+        """日期和大小条件"""
+        terms = []
+        # 如果提供了 start_date，添加 SINCE 条件
+        if self.date_start:
+            terms.append(f'SINCE {self.date_start.strftime("%d-%b-%Y")}')
+        # 如果提供了 end_date，添加 BEFORE 条件，BEFORE不含当天所以加一天
+        if self.date_end:
+            terms.append(f'BEFORE {(self.date_end + timedelta(days=1)).strftime("%d-%b-%Y")}')
+        return terms
+
+    def header_terms(self):
+        """
+        邮件头条件
+        :return: [(键, 值)]，例如[('FROM', 'finance@'), ('SUBJECT', '发票')]
+        """
+        terms = []
+        if self.sender:
+            terms.append(('FROM', self.sender))
+        if self.subject_keywords:
+            terms.append(('SUBJECT', self.subject_keywords))
+        return terms
+
+    def size_terms(self):
+        terms = []
+        if self.larger:
+            terms.append(f'LARGER {int(self.larger)}')
+        if self.smaller:
+            terms.append(f'SMALLER {int(self.smaller)}')
+        return terms
+
+    def non_ascii_terms(self):
+        """需要以CHARSET UTF-8发送的邮件头条件"""
+        return [(key, value) for key, value in self.header_terms() if not value.isascii()]
+
+    def ascii_criteria(self):
+        """
+        只包含可直接发送的条件的搜索字符串，非ASCII条件被省略，搜索结果是完整条件结果的超集
+        """
+        terms = self.base_terms()
+        terms += [f'{key} {self.quote(value)}' for key, value in self.header_terms() if value.isascii()]
+        terms += self.size_terms()
+        return ' '.join(terms) if terms else 'ALL'
+
+    def matches(self, from_address, subject):
+        """
+        在本地按IMAP的规则（不区分大小写的子串匹配）校验邮件头条件
+        :param from_address: 解码后的From头
+        :param subject: 解码后的Subject头
+        """
+        values = {'FROM': from_address or '', 'SUBJECT': subject or ''}
+        return all(value.lower() in values[key].lower() for key, value in self.header_terms())
+
+    @staticmethod
+    def quote(value):
+        return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+    def __str__(self):
+        terms = self.base_terms()
+        terms += [f'{key} {self.quote(value)}' for key, value in self.header_terms()]
+        terms += self.size_terms()
+        return ' '.join(terms) if terms else 'ALL'
 
 
 class EmailUtils:
@@ -114,39 +203,33 @@ class EmailUtils:
         return criteria
 
     @classmethod
-    def buildCriteria2(cls, date_start=None, date_end=None):
+    def buildCriteria2(cls, date_start=None, date_end=None, sender=None, subject_keywords=None, larger=None,
+                       smaller=None):
         """
-        根据日期范围构建IMAP搜索条件字符串
+        根据日期范围、发件人、主题关键字和邮件大小构建IMAP搜索条件字符串
         :param date_start: 例如 start_date = date(2023, 1, 1)
         :param date_end: 例如 end_date = date(2023, 12, 31)
-        :return: IMAP搜索条件字符串
+        :param sender: 发件人，FROM条件
+        :param subject_keywords: 主题关键字，SUBJECT条件
+        :param larger: 邮件大于该字节数，LARGER条件
+        :param smaller: 邮件小于该字节数，SMALLER条件
+        :return: IMAP搜索条件字符串，例如 SINCE 01-Jan-2023 BEFORE 01-Jan-2024 FROM "finance@"
+        """
+        return str(cls.buildSearchQuery(date_start, date_end, sender, subject_keywords, larger, smaller))
+
+    @classmethod
+    def buildSearchQuery(cls, date_start=None, date_end=None, sender=None, subject_keywords=None, larger=None,
+                         smaller=None):
+        """
+        构建SearchQuery，参数同buildCriteria2。非ASCII关键字需要通过IMAPClientBase.search_messages发送
+        :return: SearchQuery
         """
         # 检查输入参数是否为 date 类型或 None
         if date_start and not isinstance(date_start, date):
             raise ValueError("date_start 必须是 datetime.date 类型或 None")
         if date_end and not isinstance(date_end, date):
             raise ValueError("date_end 必须是 datetime.date 类型或 None")
-
-        # 构建搜索条件字符串
-        criteria = []
-        date_end = date_end + timedelta(days=1)
-
-        # 如果提供了 start_date，添加 SINCE 条件
-        if date_start:
-            start_date_imap = date_start.strftime('%d-%b-%Y')
-            criteria.append(f'SINCE {start_date_imap}')
-
-        # 如果提供了 end_date，添加 BEFORE 条件
-        if date_end:
-            end_date_imap = date_end.strftime('%d-%b-%Y')
-            criteria.append(f'BEFORE {end_date_imap}')
-
-        # 如果都没有提供，则返回 'ALL' 以搜索全部邮件
-        if not criteria:
-            return 'ALL'
-
-        # 使用空格连接条件，返回搜索条件字符串
-        return ' '.join(criteria)
+        return SearchQuery(date_start, date_end, sender, subject_keywords, larger, smaller)
 
     @classmethod
     def encode_modified_utf7(cls, s):
@@ -206,6 +289,368 @@ class EmailUtils:
 
         return unique_filename
 
+DECODE_CHUNK_SIZE = 1024 * 1024  # 逐块解码MIME部分时每块的编码字符数
+BASE64_INVALID_RE = re.compile(r'[^A-Za-z0-9+/]')
+BASE64_INVALID_BYTES_RE = re.compile(rb'[^A-Za-z0-9+/]')
+RAW_DECODABLE_ENCODINGS = ('base64', 'quoted-printable', '', '7bit', '8bit', 'binary')  # iter_payload_chunks能逐块解码的编码
+
+
+def encode_payload_text(text):
+    """把get_payload()返回的str还原为bytes，与Message.get_payload(decode=True)的处理一致"""
+    try:
+        return text.encode('ascii')
+    except UnicodeEncodeError:
+        try:
+            return text.encode('ascii', 'surrogateescape')
+        except UnicodeEncodeError:
+            return text.encode('raw-unicode-escape')
+
+
+def encoded_payload(part):
+    """
+    非multipart部分的原始编码内容。get_payload()会为检查代理字符把整个字符串编码一遍，大附件需要多占用一份内存，
+    所以直接读取_payload。由RawMessage解析、内容仍在文件映射中的附件返回RawSpan
+    """
+    raw_span = getattr(part, 'raw_span', None)
+    if raw_span is not None:
+        return raw_span
+    payload = part._payload
+    return payload if isinstance(payload, str) else part.get_payload()
+
+
+def iter_payload_chunks(part, chunk_size=DECODE_CHUNK_SIZE):
+    """
+    逐块解码MIME部分的内容，结果与part.get_payload(decode=True)相同，但不生成完整的解码结果。
+    base64每块去掉空白后按4个字符对齐解码，quoted-printable按整行解码，7bit、8bit和binary直接转换。
+    内容为RawSpan时按块从文件映射中切片解码
+    :return: 生成bytes
+    """
+    payload = encoded_payload(part)
+    encoding = str(part.get('Content-Transfer-Encoding', '')).strip().lower()
+    raw = isinstance(payload, RawSpan)
+    if not (raw or isinstance(payload, str)) or encoding not in RAW_DECODABLE_ENCODINGS:
+        # uuencode等少见编码整体解码，RawMessage不会把这些部分留在映射中
+        yield part.get_payload(decode=True) or b''
+        return
+    pad, newline = (b'=', b'\n') if raw else ('=', '\n')
+    if encoding == 'base64':
+        # 填充符'='即为内容结尾。只按块切片，不复制整个编码字符串
+        invalid_re = BASE64_INVALID_BYTES_RE if raw else BASE64_INVALID_RE
+        end = payload.find(pad)
+        if end == -1:
+            end = len(payload)
+        remainder = pad[:0]
+        for start in range(0, end, chunk_size):
+            text = remainder + invalid_re.sub(pad[:0], payload[start:min(start + chunk_size, end)])
+            usable = len(text) - len(text) % 4
+            remainder = text[usable:]
+            if usable:
+                yield binascii.a2b_base64(text[:usable])
+        if len(remainder) > 1:
+            yield binascii.a2b_base64(remainder + pad * (-len(remainder) % 4))
+        return
+    start = 0
+    while start < len(payload):
+        end = start + chunk_size
+        if encoding == 'quoted-printable' and end < len(payload):
+            # 在行尾切分，软换行'='和'=XX'不会被切开
+            line_end = payload.rfind(newline, start, end)
+            end = line_end + 1 if line_end >= start else payload.find(newline, end) + 1 or len(payload)
+        chunk = bytes(payload[start:end]) if raw else encode_payload_text(payload[start:end])
+        yield binascii.a2b_qp(chunk) if encoding == 'quoted-printable' else chunk
+        start = end
+
+
+def payload_size(part):
+    """MIME部分解码后的字节数，base64按编码长度计算，其他编码逐块解码计数"""
+    payload = encoded_payload(part)
+    raw = isinstance(payload, RawSpan)
+    if (raw or isinstance(payload, str)) and str(part.get('Content-Transfer-Encoding', '')).strip().lower() == 'base64':
+        end = payload.find(b'=' if raw else '=')
+        if end == -1:
+            end = len(payload)
+        if raw:
+            length = end - payload.count_bytes(b'\r\n\t ', 0, end)
+        else:
+            length = end - sum(payload.count(char, 0, end) for char in '\r\n\t ')
+        return length * 3 // 4
+    return sum(len(chunk) for chunk in iter_payload_chunks(part))
+
+
+class PayloadStream(io.RawIOBase):
+    """把iter_payload_chunks包装为只能顺序读取的二进制数据流"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer:
+            self.buffer = next(self.chunks, None)
+            if self.buffer is None:
+                self.buffer = b''
+                return 0
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+
+@dataclass
+class MailAttachment:
+    """EmailParser.iter_attachments返回的一个附件"""
+    index: int  # 附件在msg.walk()中的序号，同名附件以此区分
+    filename: str
+    size: float  # 解码后的大小KB
+    stream: io.RawIOBase  # 解码后的内容，只能顺序读取一次，读取时才逐块解码
+
+
+class RawSpan:
+    """
+    RawMessage中一段原始的编码内容，偏移相对于这段内容的开头。支持iter_payload_chunks用到的查找和切片，
+    切片为文件映射上的memoryview，不复制数据
+    """
+
+    def __init__(self, raw_message, start, end):
+        self.raw_message = raw_message
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def _bounds(self, start, end):
+        start, end, _ = slice(start, end).indices(len(self))
+        return self.start + start, self.start + end
+
+    def find(self, sub, start=0, end=None):
+        position = self.raw_message.buffer.find(sub, *self._bounds(start, end))
+        return position - self.start if position != -1 else -1
+
+    def rfind(self, sub, start=0, end=None):
+        position = self.raw_message.buffer.rfind(sub, *self._bounds(start, end))
+        return position - self.start if position != -1 else -1
+
+    def count_bytes(self, chars, start=0, end=None):
+        """[start, end)中属于chars的字节数，按块统计"""
+        start, end = self._bounds(start, end)
+        total = 0
+        for chunk_start in range(start, end, DECODE_CHUNK_SIZE):
+            chunk = self.raw_message.buffer[chunk_start:min(chunk_start + DECODE_CHUNK_SIZE, end)]
+            total += len(chunk) - len(chunk.translate(None, chars))
+        return total
+
+    def __getitem__(self, key):
+        return self.raw_message.view(*self._bounds(key.start, key.stop))
+
+    def text(self):
+        """与email解析器保存的_payload相同的str"""
+        return self.raw_message.buffer[self.start:self.end].decode('ascii', 'surrogateescape')
+
+
+@dataclass
+class RawPart:
+    """RawMessage偏移表中的一个MIME部分，偏移都相对于邮件文件开头"""
+    start: int  # 头部的起始偏移
+    body_start: int  # 头部后空行之后，即载荷的起始偏移
+    end: int  # 载荷的结束偏移，不含分隔行前的换行
+    headers: Message  # 只解析了头部的Message
+
+    def is_attachment(self):
+        return RawMessage.is_raw_attachment(self.headers)
+
+
+class RawMessage:
+    """
+    以内存映射方式访问磁盘上的邮件文件。头部结束位置和MIME部分的偏移表只建立一次，头部扫描、部分边界查找和附件解码
+    都在映射上按偏移查找和切片，不把整个文件读成bytes。用完后需要close，或使用with语句
+    """
+    HEADER_END_RE = re.compile(rb'\r?\n\r?\n')
+    FEED_CHUNK_SIZE = 64 * 1024  # 向email解析器逐块输入的字节数
+
+    def __init__(self, file_path=None, file=None):
+        """
+        :param file_path: 邮件文件路径
+        :param file: 代替file_path，已打开的可读二进制文件，如大邮件分块获取的SpooledTemporaryFile（内存中的部分会先
+        写到磁盘）。close时只关闭映射，文件由调用方关闭
+        """
+        self.file_path = file_path if file is None else getattr(file, 'name', None)
+        self.own_file = file is None
+        if file is None:
+            file = open(file_path, 'rb')
+        fileno = file.fileno()
+        file.flush()
+        self.file = file
+        self.size = os.fstat(fileno).st_size
+        # 空文件不能映射，用空bytes代替，find和切片的用法相同
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+        self._header_end = None
+        self._parts = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            try:
+                self.buffer.close()
+            except BufferError:
+                pass  # 仍有未释放的memoryview，映射在其被回收后关闭
+        if self.own_file:
+            self.file.close()
+
+    def view(self, start=0, end=None):
+        """
+        文件映射上[start, end)的memoryview。映射关闭前需要释放，不要长期保存
+        """
+        return memoryview(self.buffer)[start:self.size if end is None else end]
+
+    def header_end(self, limit=None):
+        """
+        邮件头部后空行的结束偏移，找不到空行时为limit或文件长度
+        :param limit: 最多查找的字节数
+        """
+        if self._header_end is None:
+            end = self.size if limit is None else min(limit, self.size)
+            match = self.HEADER_END_RE.search(self.buffer, 0, end)
+            if match is None:
+                return end
+            self._header_end = match.end()
+        return self._header_end
+
+    def header_block(self, limit=None):
+        """邮件头部的bytes，只复制头部"""
+        return self.buffer[:self.header_end(limit)]
+
+    def sha256(self):
+        """直接在映射上计算整个文件的SHA256"""
+        return hashlib.sha256(self.buffer).hexdigest()
+
+    @property
+    def parts(self):
+        """
+        MIME部分的偏移表，按文件中的先后顺序（即msg.walk()的顺序）排列，第一项为整封邮件
+        :raise ValueError: multipart的分隔行缺失或部分头部中有无法解析的行
+        """
+        if self._parts is None:
+            parts = []
+            self._scan_part(0, self.size, parts, top=True)
+            self._parts = parts
+        return self._parts
+
+    def _scan_part(self, start, end, parts, top=False):
+        if top:
+            body_start = self.header_end()
+        elif self.buffer[start:start + 2] == b'\r\n' or self.buffer[start:start + 1] == b'\n':
+            body_start = start + (2 if self.buffer[start:start + 1] == b'\r' else 1)  # 没有头部
+        else:
+            match = self.HEADER_END_RE.search(self.buffer, start, end)
+            body_start = match.end() if match else end
+        headers = BytesHeaderParser(policy=policy.default).parsebytes(self.buffer[start:body_start])
+        if headers.get_payload():
+            # 头部中出现了不是头部字段的行，email解析器会从这一行开始当作载荷，与偏移表不一致
+            raise ValueError('MIME部分的头部无法解析')
+        parts.append(RawPart(start, body_start, end, headers))
+        if headers.get_content_maintype() == 'multipart':
+            for child_start, child_end in self._split(headers.get_boundary(), body_start, end):
+                self._scan_part(child_start, child_end, parts)
+
+    DELIMITER_TAIL_RE = re.compile(rb'(--)?[ \t]*(?:\r\n|\r|\n|\Z)')
+
+    def _split(self, boundary, start, end):
+        """按RFC 2046的分隔行切分multipart的载荷，返回各子部分的(起始偏移, 结束偏移)"""
+        if not boundary:
+            raise ValueError('multipart缺少boundary参数')
+        marker = b'--' + boundary.encode('utf-8', 'surrogateescape')
+        spans = []
+        content_start = None
+        position = self.buffer.find(marker, start, end)
+        while position != -1:
+            # 分隔行必须从行首开始，"--boundary"之后只能有"--"、空白和换行
+            tail = None
+            if position == start or self.buffer[position - 1:position] in (b'\n', b'\r'):
+                tail = self.DELIMITER_TAIL_RE.match(self.buffer, position + len(marker), end)
+            if tail is not None:
+                if content_start is not None:
+                    content_end = position
+                    # 分隔行前的换行属于分隔行
+                    if self.buffer[content_end - 2:content_end] == b'\r\n':
+                        content_end -= 2
+                    elif self.buffer[content_end - 1:content_end] in (b'\n', b'\r'):
+                        content_end -= 1
+                    spans.append((content_start, max(content_start, content_end)))
+                if tail.group(1):
+                    return spans
+                content_start = tail.end()
+                position = tail.end()
+            else:
+                position += len(marker)
+            position = self.buffer.find(marker, position, end)
+        raise ValueError('multipart缺少结束分隔行')
+
+    @staticmethod
+    def is_raw_attachment(part):
+        """
+        附件的判断与EmailParser.iter_attachments一致，且内容可以直接从映射中逐块解码。这样的部分解析时不读入载荷
+        :param part: Message，可以只解析了头部
+        """
+        disposition = part.get('Content-Disposition')
+        encoding = str(part.get('Content-Transfer-Encoding', '')).strip().lower()
+        return bool(disposition and 'attachment' in disposition and part.get_filename()
+                    and part.get_content_maintype() not in ('multipart', 'message')
+                    and encoding in RAW_DECODABLE_ENCODINGS)
+
+    @classmethod
+    def _walk_multipart(cls, part):
+        """与msg.walk()相同，但与偏移表一样不进入message/rfc822等内嵌邮件"""
+        yield part
+        if part.get_content_maintype() == 'multipart' and part.is_multipart():
+            for subpart in part.get_payload():
+                yield from cls._walk_multipart(subpart)
+
+    def _feed(self, parser, start, end):
+        for chunk_start in range(start, end, self.FEED_CHUNK_SIZE):
+            parser.feed(self.buffer[chunk_start:min(chunk_start + self.FEED_CHUNK_SIZE, end)])
+
+    def parse(self):
+        """
+        解析为email的Message。附件的载荷不输入解析器，只在对应部分上设置raw_span，读取附件时从映射中逐块解码。
+        偏移表与解析结果不一致（不规范的MIME结构）时完整解析
+        :return: Message
+        """
+        try:
+            skipped = [part for part in self.parts if part.is_attachment()]
+        except ValueError:
+            skipped = None
+        parser = BytesFeedParser(policy=policy.default)
+        if skipped is None:
+            self._feed(parser, 0, self.size)
+            return parser.close()
+        position = 0
+        for part in skipped:
+            self._feed(parser, position, part.body_start)
+            position = part.end
+        self._feed(parser, position, self.size)
+        msg = parser.close()
+
+        attachment_parts = [part for part in self._walk_multipart(msg) if self.is_raw_attachment(part)]
+        if len(attachment_parts) != len(skipped) or any(
+                part.get_payload() or part.get_filename() != raw_part.headers.get_filename()
+                for part, raw_part in zip(attachment_parts, skipped)):
+            parser = BytesFeedParser(policy=policy.default)
+            self._feed(parser, 0, self.size)
+            return parser.close()
+        for part, raw_part in zip(attachment_parts, skipped):
+            part.raw_span = RawSpan(self, raw_part.body_start, raw_part.end)
+        return msg
+
+
 def decode_filename(filename):
     """
     解码附件的文件名
@@ -229,10 +674,34 @@ class EmailParser:
     """
 
     def __init__(self, raw_email_data):
+        """
+        :param raw_email_data: 邮件原始数据bytes，或以二进制模式打开的邮件文件，例如大邮件分块获取后的临时文件。
+        传入文件时直接从文件解析，不再复制一份完整的bytes，使用期间文件需保持打开。传入RawMessage时附件内容
+        留在文件映射中，读取附件时才解码，使用期间RawMessage需保持打开
+        """
         self.raw_email = raw_email_data
-        self.msg = email.message_from_bytes(raw_email_data, policy=policy.default)
+        if isinstance(raw_email_data, (bytes, bytearray)):
+            self.raw_size = len(raw_email_data)
+            self.msg = email.message_from_bytes(raw_email_data, policy=policy.default)
+        elif isinstance(raw_email_data, RawMessage):
+            self.raw_size = raw_email_data.size
+            self.msg = raw_email_data.parse()
+        else:
+            self.raw_size = raw_email_data.seek(0, os.SEEK_END)
+            raw_email_data.seek(0)
+            self.msg = email.message_from_binary_file(raw_email_data, policy=policy.default)
         # self.msg = email.message_from_bytes(raw_email_data, policy=strict)
 
+    def load_raw_payloads(self):
+        """
+        把由RawMessage解析时留在文件映射中的附件内容读入Message，之后可以使用get_payload
+        """
+        for part in self.msg.walk():
+            raw_span = getattr(part, 'raw_span', None)
+            if raw_span is not None:
+                part.set_payload(raw_span.text())
+                del part.raw_span
+
     def get_headers(self):
         """
         获取邮件头信息
@@ -336,8 +805,12 @@ class EmailParser:
 
         return parts
 
-    def get_body_text(self):
-        body_parts = self.get_body()
+    def get_body_text(self, body_parts=None):
+        """
+        :param body_parts: get_body()的结果，已获取过时传入，避免重复解码
+        """
+        if body_parts is None:
+            body_parts = self.get_body()
         len_body = len(body_parts)
         if len_body == 0:
             return ""
@@ -346,9 +819,7 @@ class EmailParser:
         else:
             html_index = len_body - 1
         combined_str = ''.join(body_parts[:html_index + 1])
-        soup = BeautifulSoup(combined_str, 'html.parser')  # 使用内建的 html.parser
-        clean_text = soup.get_text(separator=' ', strip=True)  # 获取所有标签去除后的纯文本内容
-        return clean_text
+        return html_to_text(combined_str)  # 获取所有标签去除后的纯文本内容
 
     # def get_attachments(self, download_folder=None):
     #     """
@@ -411,6 +882,7 @@ class EmailParser:
         :param download_folder: 保存附件的文件夹，如果为 None，则不保存文件，只返回文件内容
         :return: 附件信息列表，每个元素为包含文件名和文件大小的字典
         """
+        self.load_raw_payloads()
         attachments_ = []
         for part in self.msg.walk():
             content_disposition = part.get("Content-Disposition")
@@ -528,17 +1000,39 @@ class EmailParser:
         获取当前邮件的大小KB
         :return:
         """
-        return len(self.raw_email) / 1024
+        return self.raw_size / 1024
 
     def getAttachmentSize(self):
         pass
 
+    def iter_attachments(self):
+        """
+        遍历一次MIME结构逐个返回附件，附件内容在读取stream时逐块解码，不生成完整的解码结果。附件的判断与get_attachment_by_filename一致，
+        同名的多个附件分别返回
+        :return: 生成MailAttachment
+        """
+        for index, part in enumerate(self.msg.walk()):
+            content_disposition = part.get("Content-Disposition")
+            if not (content_disposition and "attachment" in content_disposition):
+                continue
+            filename = part.get_filename()
+            if not filename:
+                continue
+            if filename.endswith(".eml") and part.is_multipart():
+                # message/rfc822附件的载荷是邮件对象列表
+                content = self.process_eml_content(part.get_payload()).encode('utf-8')
+                yield MailAttachment(index, filename, len(content) / 1024, io.BytesIO(content))
+            else:
+                yield MailAttachment(index, filename, payload_size(part) / 1024,
+                                     PayloadStream(iter_payload_chunks(part)))
+
     def get_attachment_by_filename(self, filename):
         """
         获取当前邮件中附件文件名为filename的附件文件数据。
         :param filename:
         :return: 文件数据，是经过base64或者其他编码从MIME中解析出来的文件数据。没有filename文件则返回None
         """
+        self.load_raw_payloads()
         for part in self.msg.walk():
             content_disposition = part.get("Content-Disposition")
             if content_disposition and "attachment" in content_disposition:
@@ -606,31 +1100,17 @@ class EmailParser:
         :param keyword: 文件名关键字
         :return: 一个字典列表。每一项表示一个符合条件的云附件，没有则返回None
         """
-        if body_ is None:
+        provider = CLOUD_PROVIDERS.detect(body_)  # 不含任何提供商主机名的正文在子串扫描后直接返回
+        if provider is None:
             return None
 
-        patterns = {
-            "163": r'https://mail\.163\.com/large-attachment-download/index\.html\?p=.*',
-            "126": r'https://mail\.163\.com/large-attachment-download/index\.html\?p=.*',
-            "QQ": r'https://mail\.qq\.com/cgi-bin/ftnExs_download\?k=.*',
-            "Gmail": r'https://drive\.google\.com/(file/d/|open\?id=).*',
-            "Outlook": r'https://1drv\.ms/.*',
-            "189": r'https://download\.cloud\.189\.cn/file/downloadFile\.action\?dt=.*',
-            "RUC": r'https://edisk\.qiye\.163\.com/api/biz/attachment/download\?identity=.*',
-            "Sina": r'https://mail\.sina\.com\.cn/filecenter/download\.php\?id=.*'
-        }
-
         cloud_attachments = []
-        print(f'匹配云附件类型')
-        for provider, pattern in patterns.items():
-            if re.search(pattern, body_):
-                print(f'当前匹配的provider是{provider}')
-                parser_ = CloudFileParser.create_parser(provider)
-                file_infos = parser_.get_cloud_file_info(body_)
-                for file_info in file_infos:
-                    if keyword is None or keyword.lower() in file_info.get('filename', '').lower():
-                        cloud_attachments.append(file_info)
-                break
+        print(f'当前匹配的provider是{provider}')
+        parser_ = CloudFileParser.create_parser(provider)
+        file_infos = parser_.get_cloud_file_info(body_)
+        for file_info in file_infos:
+            if keyword is None or keyword.lower() in file_info.get('filename', '').lower():
+                cloud_attachments.append(file_info)
 
         return cloud_attachments if cloud_attachments else None
 
@@ -673,7 +1153,13 @@ class EmailParser:
 
             # 打开文件并写入邮件内容
             with open(save_path, 'wb') as file:
-                file.write(self.raw_email)
+                if isinstance(self.raw_email, (bytes, bytearray)):
+                    file.write(self.raw_email)
+                elif isinstance(self.raw_email, RawMessage):
+                    file.write(self.raw_email.buffer)
+                else:
+                    self.raw_email.seek(0)
+                    shutil.copyfileobj(self.raw_email, file)
             print("邮件已成功保存到：", save_path)
         except Exception as e:
             print(f"保存邮件时出错：{e}")
@@ -745,6 +1231,239 @@ class EmailParser:
 
 
 
+class EmailHeaderScanner(EmailParser):
+    """
+    只读取邮件头部的解析器，读到第一个空行为止，不解析正文和附件。用于按日期、发件人和主题筛选邮件，
+    只有通过筛选的邮件才用EmailParser完整解析。只能使用get_headers、getSubject、getDate、getEmailFileName、
+    getSize等头部相关的方法
+    """
+    HEADER_READ_LIMIT = 1024 * 1024  # 找不到空行时最多读取的字节数，避免把损坏的大文件当作头部整体读入
+
+    def __init__(self, raw_email_data):
+        """
+        :param raw_email_data: 邮件原始数据bytes，以二进制模式打开的邮件文件，或RawMessage
+        """
+        self.raw_email = raw_email_data
+        if isinstance(raw_email_data, (bytes, bytearray)):
+            self.raw_size = len(raw_email_data)
+            match = re.search(rb'\r?\n\r?\n', raw_email_data[:self.HEADER_READ_LIMIT])
+            header_block = bytes(raw_email_data[:match.end() if match else self.HEADER_READ_LIMIT])
+        elif isinstance(raw_email_data, RawMessage):
+            self.raw_size = raw_email_data.size
+            header_block = raw_email_data.header_block(self.HEADER_READ_LIMIT)
+        else:
+            self.raw_size = raw_email_data.seek(0, os.SEEK_END)
+            raw_email_data.seek(0)
+            lines = []
+            read = 0
+            while read < self.HEADER_READ_LIMIT:
+                line = raw_email_data.readline()
+                if not line:
+                    break
+                lines.append(line)
+                read += len(line)
+                if line in (b'\r\n', b'\n'):
+                    break
+            header_block = b''.join(lines)
+        self.msg = BytesHeaderParser(policy=policy.default).parsebytes(header_block)
+
+
+@dataclass
+class ParsedMessage:
+    """
+    一封邮件解析后的紧凑记录：邮件头、解码后的正文文本、附件表和云附件链接。每封邮件只解析一次，
+    全文、附件和云附件的保存和索引都使用这份记录，可由ParsedMessageCache保存到磁盘
+    """
+    headers: dict
+    message_id: Optional[str]
+    subject: str
+    from_address: Optional[str]
+    to_addresses: Optional[str]
+    cc_addresses: Optional[str]
+    bcc_addresses: Optional[str]
+    received_date: Optional[date]
+    file_name: str  # 保存EML文件使用的文件名
+    size: float  # 邮件大小KB
+    body_text: str  # 去除HTML标签后的正文文本，用于索引
+    attachments: list  # 附件表，每项为{'index': 附件序号, 'filename': 文件名, 'file_size': KB}
+    cloud_links: list  # 正文中识别出的全部云附件信息，过期状态为解析时的结果
+    parser: Optional[EmailParser] = field(default=None, repr=False, compare=False)  # 解析用的EmailParser，不缓存
+
+    @classmethod
+    def from_parser(cls, email_parser):
+        """由已完整解析的EmailParser生成记录，并保留email_parser用于读取附件内容"""
+        headers = email_parser.get_headers()
+        body_parts = email_parser.get_body()
+        cloud_links = []
+        if body_parts:
+            html_index = int(len(body_parts) / 2) - 1 if len(body_parts) >= 3 else len(body_parts) - 1
+            cloud_links = email_parser.get_cloud_attachments(body_parts[html_index]) or []
+        return cls(
+            headers={name: str(value) for name, value in headers.items()},
+            message_id=email_parser.getEmailMessageUID(headers),
+            subject=email_parser.getSubject(headers),
+            from_address=email_parser.getFrom(headers),
+            to_addresses=email_parser.getTo(headers),
+            cc_addresses=email_parser.getCc(headers),
+            bcc_addresses=email_parser.getBcc(headers),
+            received_date=email_parser.getDate(headers),
+            file_name=email_parser.getEmailFileName(headers),
+            size=email_parser.getSize(),
+            body_text=email_parser.get_body_text(body_parts),
+            attachments=[{'index': attachment.index, 'filename': attachment.filename, 'file_size': attachment.size}
+                         for attachment in email_parser.iter_attachments()],
+            cloud_links=cloud_links,
+            parser=email_parser,
+        )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['parser'] = None
+        return state
+
+    def attachments_by_keyword(self, keyword):
+        """文件名中包含keyword的附件，与EmailParser.get_attachments_by_keyword一致"""
+        return [item for item in self.attachments if item['filename'] and keyword in item['filename']]
+
+    def cloud_attachments(self, keyword):
+        """文件名中包含keyword的云附件，keyword为空时返回全部"""
+        if not keyword:
+            return list(self.cloud_links)
+        return [item for item in self.cloud_links if keyword.lower() in item.get('filename', '').lower()]
+
+    def iter_attachments(self, raw_email):
+        """
+        逐个返回附件及其解码后的内容，见EmailParser.iter_attachments。记录来自缓存或子进程时才重新解析邮件
+        :param raw_email: 邮件原始数据bytes，以二进制模式打开的邮件文件，或RawMessage
+        """
+        if self.parser is None:
+            self.parser = EmailParser(raw_email)
+        return self.parser.iter_attachments()
+
+
+class ParsedMessageCache:
+    """
+    ParsedMessage的磁盘缓存，以邮件原始数据的SHA256哈希为键。重新运行备份任务时直接读取记录，
+    不再解析邮件。云附件的过期状态在解析时确定，所以记录只保留max_age秒
+    """
+    VERSION = 2  # ParsedMessage字段变化时递增，旧记录自动失效
+
+    def __init__(self, cache_dir, max_age=24 * 3600):
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(raw_email, chunk_size=1024 * 1024):
+        """邮件原始数据的SHA256哈希，raw_email为文件时读取后回到开头"""
+        if isinstance(raw_email, (bytes, bytearray)):
+            return hashlib.sha256(raw_email).hexdigest()
+        if isinstance(raw_email, RawMessage):
+            return raw_email.sha256()
+        sha256 = hashlib.sha256()
+        raw_email.seek(0)
+        for chunk in iter(lambda: raw_email.read(chunk_size), b''):
+            sha256.update(chunk)
+        raw_email.seek(0)
+        return sha256.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f'{key}.v{self.VERSION}.pkl')
+
+    def get(self, key):
+        """:return: 缓存的ParsedMessage，不存在、过期或损坏时为None"""
+        path = self.path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                return None
+            with open(path, 'rb') as file:
+                message = pickle.load(file)
+        except (OSError, pickle.PickleError, EOFError, AttributeError, TypeError):
+            return None
+        return message if isinstance(message, ParsedMessage) else None
+
+    def put(self, key, message):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            with open(temp_path, 'wb') as file:
+                pickle.dump(message, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f'写入解析缓存失败{e}')
+
+    def parse(self, raw_email):
+        """
+        读取缓存的记录，未缓存时解析邮件并写入缓存
+        :param raw_email: 邮件原始数据bytes，以二进制模式打开的邮件文件，或RawMessage
+        :return: ParsedMessage
+        """
+        key = self.key(raw_email)
+        message = self.get(key)
+        if message is None:
+            message = ParsedMessage.from_parser(EmailParser(raw_email))
+            self.put(key, message)
+        return message
+
+    def prune(self):
+        """删除过期的记录"""
+        now = time.time()
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if now - os.path.getmtime(path) > self.max_age:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+
+def parse_message_file(file_path, cache_dir=None):
+    """
+    解析邮件文件为ParsedMessage，可作为进程池的任务在子进程中执行，返回结果时不带EmailParser
+    （EmailParser引用的文件映射在返回前关闭）
+    :param cache_dir: ParsedMessageCache的目录，为None时不使用缓存
+    """
+    with RawMessage(file_path) as raw_message:
+        if cache_dir is None:
+            message = ParsedMessage.from_parser(EmailParser(raw_message))
+        else:
+            message = ParsedMessageCache(cache_dir).parse(raw_message)
+    message.parser = None
+    return message
+
+
+class RateLimiter:
+    """
+    令牌桶限速器，可由多个线程共享同一份预算。rate为每秒允许通过的字节数，0表示不限速。
+    单次消耗超过桶容量时先记为欠账，调用线程等待欠账还清
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """
+        消耗amount字节的预算，预算不足时阻塞到可用为止
+        :param amount: 字节数
+        """
+        if self.rate <= 0 or amount <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
 class CommonUtils:
 
     @staticmethod